@@ -0,0 +1,68 @@
+"""
+Throughput of `manage.py import_recipes` on a generated catalogue: recipes with a
+few ingredients and tags each, drawn from a vocabulary that mostly has to be created.
+
+    python -m benchmarks.bulk_import [--recipes 100000] [--format csv]
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+
+from .common import setup
+
+setup()
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from recipes.models import Recipe
+
+def write_catalogue(path, recipes, fmt):
+    rng = random.Random(1)
+    ingredients = [f"ingredient {i}" for i in range(20_000)]
+    tags = [f"tag {i}" for i in range(200)]
+    rows = (
+        {
+            "title": f"Recipe {i}",
+            "instructions": "Mix everything, then bake until golden. " * 4,
+            "cook_time_in_minutes": rng.randrange(5, 240),
+            "difficulty": rng.choice("EMH"),
+            "is_public": rng.random() < 0.9,
+            "ingredients": rng.sample(ingredients, 6),
+            "tags": rng.sample(tags, 2),
+        }
+        for i in range(recipes)
+    )
+    with open(path, "w", newline="") as file:
+        if fmt == "csv":
+            writer = csv.DictWriter(file, fieldnames=["title", "instructions", "cook_time_in_minutes", "difficulty", "is_public", "ingredients", "tags"])
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({**row, "ingredients": ";".join(row["ingredients"]), "tags": ";".join(row["tags"])})
+        else:
+            for row in rows:
+                file.write(json.dumps(row) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipes", type=int, default=100_000)
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    args = parser.parse_args()
+
+    User.objects.create_user("partner")
+    path = os.path.join(tempfile.mkdtemp(), f"catalogue.{args.format}")
+    write_catalogue(path, args.recipes, args.format)
+    print(f"{args.recipes} recipes, {os.path.getsize(path) / 1e6:.1f} MB of {args.format.upper()}")
+
+    started = time.perf_counter()
+    call_command("import_recipes", path, chef="partner")
+    elapsed = time.perf_counter() - started
+    assert Recipe.objects.count() == args.recipes
+    print(f"{'import_recipes':<40} {args.recipes / elapsed:9.0f} recipes/s")
+
+if __name__ == "__main__":
+    main()
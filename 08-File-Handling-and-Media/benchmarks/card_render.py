@@ -0,0 +1,55 @@
+"""
+Render time of the recipe cards on an 8- and 50-item list page, with and
+without the card fragment cache.
+
+    python -m benchmarks.card_render
+"""
+from .common import setup, timeit, report
+
+setup()
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.template import engines
+
+from recipes.cache import render_recipe_cards
+from recipes.models import Recipe, Ingredient
+
+INGREDIENTS_PER_RECIPE = 8
+
+# What `recipe_list.html` did before cards were cached: prefetch every row's ingredients and render inline.
+UNCACHED = engines["django"].from_string(
+    "{% for recipe in recipes %}{% include 'recipes/recipe_card.html' %}{% endfor %}"
+)
+
+def seed(count):
+    user = User.objects.create_user("bench")
+    ingredients = Ingredient.objects.bulk_create(Ingredient(name=f"ingredient {i}") for i in range(100))
+    for i in range(count):
+        recipe = Recipe.objects.create(title=f"Recipe {i}", chef=user.chef, instructions="Mix.")
+        recipe.ingredients.set(ingredients[i:i + INGREDIENTS_PER_RECIPE])
+
+def page(size):
+    return Recipe.objects.select_related("chef")[:size]
+
+def main():
+    seed(50)
+    for size in (8, 50):
+        uncached = timeit(lambda: UNCACHED.render({"recipes": page(size).prefetch_related("ingredients")}))
+
+        def cold():
+            cache.clear()
+            render_recipe_cards(page(size))
+        cold_ms = timeit(cold)
+
+        render_recipe_cards(page(size))
+        warm = timeit(lambda: render_recipe_cards(page(size)))
+
+        print(f"-- {size} recipes per page")
+        report("uncached (prefetch + render)", uncached)
+        report("card cache, cold", cold_ms)
+        report("card cache, warm", warm)
+        print(f"{'speedup (warm vs uncached)':<40} {uncached / warm:9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Shared setup for the benchmark scripts.
+
+Each script boots Django against a throwaway test database, so running a
+benchmark never touches `db.sqlite3`. Run them from the project root, e.g.:
+
+    python -m benchmarks.card_render
+"""
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+def setup():
+    """ Configure Django and create an empty test database. """
+    sys.path.insert(0, str(BASE_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cookbook.settings")
+
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+def timeit(fn, repeat=20):
+    """ Run `fn` `repeat` times and return the median wall time in milliseconds. """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def report(label, ms):
+    print(f"{label:<40} {ms:9.2f} ms")
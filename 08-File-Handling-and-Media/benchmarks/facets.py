@@ -0,0 +1,77 @@
+"""
+Time the recipe list's facet counts (`recipes.facets`): counting them after a change,
+and what they add to every other request once cached.
+
+    python -m benchmarks.facets [--recipes 1000000] [--tags 200] [--chefs 10000]
+"""
+import argparse
+import itertools
+import random
+
+from .common import setup, timeit, report
+
+setup()
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection
+from django.http import QueryDict
+
+from recipes.facets import count_facets, facet_links, invalidate, normalise_filters
+from recipes.management.commands.import_recipes import insert_links
+from recipes.models import Chef, Recipe, Tag
+
+def seed(recipes, tags, chefs):
+    users = User.objects.bulk_create(User(username=f"chef{i}") for i in range(chefs))
+    # `bulk_create` skips the signal that creates a chef per user.
+    chef_ids = [chef.pk for chef in Chef.objects.bulk_create(Chef(user=user, name=user.username) for user in users)]
+    tag_ids = [tag.pk for tag in Tag.objects.bulk_create(Tag(name=f"tag {i}") for i in range(tags))]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(tags)))
+    rng = random.Random(1)
+    for start in range(0, recipes, 10_000):
+        batch = Recipe.objects.bulk_create(
+            Recipe(
+                title=f"Recipe {i}", instructions="Mix.", chef_id=rng.choice(chef_ids),
+                cook_time_in_minutes=rng.randint(5, 120), difficulty=rng.choice("EMH"),
+                is_public=rng.random() < 0.7,
+            )
+            for i in range(start, min(start + 10_000, recipes))
+        )
+        insert_links(Recipe._meta.get_field("tags"), [
+            (recipe.pk, pk) for recipe in batch for pk in set(rng.choices(tag_ids, cum_weights=cum_weights, k=rng.randint(1, 4)))
+        ])
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    return users[0]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipes", type=int, default=1_000_000)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--chefs", type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f"Seeding {args.recipes} recipes with {args.tags} tags...")
+    user = seed(args.recipes, args.tags, args.chefs)
+
+    for query in ("", "tag=tag+3", "tag=tag+3&difficulty=E&time=15-30"):
+        params = QueryDict(query)
+        filters = normalise_filters(params)
+        qs = Recipe.objects.select_related("chef")
+        if "tag" in filters:
+            qs = qs.filter(tags__name__iexact=filters["tag"]).distinct()
+        if "difficulty" in filters:
+            qs = qs.filter(difficulty=filters["difficulty"], cook_time_in_minutes__gte=16, cook_time_in_minutes__lte=30)
+        for label, viewer in (("anonymous", AnonymousUser()), ("chef", user)):
+            def facets():
+                return facet_links(params, filters, count_facets(qs, filters, viewer))
+
+            def cold():
+                invalidate()
+                facets()
+
+            print(f"-- ?{query} ({label})")
+            report("after a change (median)", timeit(cold, repeat=3))
+            report("cached (median)", timeit(facets, repeat=200))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Peak memory of building the derivatives of one large upload, before and after
+decoding with `recipes.imaging.decode_image()` (pixel limit, JPEG draft mode,
+in-place EXIF rotation, no redundant conversions).
+
+Each run happens in a fresh forked process and reports how far its peak RSS
+rose above what it started with.
+
+    python -m benchmarks.image_memory [--megapixels 50]
+"""
+import argparse
+import multiprocessing
+import resource
+import tempfile
+
+from .common import setup
+
+setup()
+
+from django.core.files.storage import FileSystemStorage
+from PIL import Image, ImageOps
+
+from recipes.imaging import DERIVATIVE_FORMATS, DERIVATIVE_WIDTHS, encode, render_derivatives
+
+def make_photo(path, megapixels):
+    width = int((megapixels * 1_000_000 * 3 / 2) ** 0.5)
+    height = width * 2 // 3
+    # Noise compresses poorly, like a real photo, and keeps the file size realistic.
+    img = Image.merge("RGB", [Image.effect_noise((width, height), sigma) for sigma in (40, 60, 80)])
+    img.save(path, "JPEG", quality=90)
+
+def before(storage, name):
+    # `render_derivatives()` as it decoded images until now: full resolution, then copied twice.
+    with storage.open(name) as original:
+        img = ImageOps.exif_transpose(Image.open(original))
+        img.load()
+    img = img.convert("RGB")
+    for width in sorted({min(width, img.width) for width in DERIVATIVE_WIDTHS}):
+        height = max(1, round(img.height * width / img.width))
+        resized = img.resize((width, height), Image.Resampling.LANCZOS)
+        for fmt in DERIVATIVE_FORMATS + ["jpeg"]:
+            encode(resized, fmt)
+
+def after(storage, name):
+    render_derivatives(storage, name)
+
+def peak_rss_mb(fn, *args):
+    """ Run `fn(*args)` in a forked process; return how many MB its peak RSS rose. """
+    def child(conn):
+        start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        conn.send((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start) / 1024)
+
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=child, args=(child_conn,))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megapixels", type=float, default=50)
+    args = parser.parse_args()
+
+    from django.conf import settings
+
+    settings.MEDIA_ROOT = tempfile.mkdtemp()
+    storage = FileSystemStorage(location=settings.MEDIA_ROOT)
+    name = "photo.jpg"
+    # Build the photo in a child too, so this process stays small.
+    process = multiprocessing.get_context("fork").Process(target=make_photo, args=(storage.path(name), args.megapixels))
+    process.start()
+    process.join()
+    with Image.open(storage.path(name)) as img:
+        print(f"{img.width}×{img.height} JPEG, {storage.size(name) / 1e6:.1f} MB, widths {DERIVATIVE_WIDTHS}")
+
+    for label, fn in (("before: full decode", before), ("after: decode_image()", after)):
+        print(f"{label:<40} {peak_rss_mb(fn, storage, name):9.1f} MB peak RSS")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Time `manage.py compute_ingredient_pairings` and a "goes well with" lookup.
+Ingredients are drawn with a skewed distribution, as in real recipes.
+
+    python -m benchmarks.ingredient_pairings [--recipes 1000000] [--ingredients 100000]
+"""
+import argparse
+import itertools
+import random
+import time
+
+from .common import setup, timeit, report
+
+setup()
+
+from django.core.management import call_command
+from django.db import connection
+
+from recipes.management.commands.import_recipes import insert_links
+from recipes.models import Ingredient, Recipe
+from recipes.pairings import suggest_pairings
+
+def seed(recipes, ingredients):
+    ingredient_ids = [obj.pk for obj in Ingredient.objects.bulk_create(Ingredient(name=f"ingredient {i}") for i in range(ingredients))]
+    # Zipf-like weights: the n-th most common ingredient is n times rarer than the first.
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(ingredients)))
+    rng = random.Random(1)
+    for start in range(0, recipes, 10_000):
+        batch = Recipe.objects.bulk_create(
+            Recipe(title=f"Recipe {i}", instructions="Mix.") for i in range(start, min(start + 10_000, recipes))
+        )
+        insert_links(Recipe._meta.get_field("ingredients"), [
+            (recipe.pk, pk) for recipe in batch for pk in set(rng.choices(ingredient_ids, cum_weights=cum_weights, k=rng.randint(4, 12)))
+        ])
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    return ingredient_ids
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipes", type=int, default=1_000_000)
+    parser.add_argument("--ingredients", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(f"Seeding {args.recipes} recipes over {args.ingredients} ingredients...")
+    ingredient_ids = seed(args.recipes, args.ingredients)
+
+    started = time.monotonic()
+    call_command("compute_ingredient_pairings")
+    report("compute_ingredient_pairings", (time.monotonic() - started) * 1000)
+
+    rng = random.Random(2)
+    common = ingredient_ids[:1000]
+    report("suggest_pairings, 5 chosen (median)", timeit(lambda: suggest_pairings(rng.sample(common, 5)), repeat=200))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Time indexing recipe instructions for near-duplicate detection, and checking one new
+recipe against the index. One recipe in twenty is a copy of an earlier one with a few
+words changed.
+
+    python -m benchmarks.near_duplicates [--recipes 1000000] [--words 150]
+"""
+import argparse
+import random
+import time
+
+from .common import setup, timeit, report
+
+setup()
+
+from django.core.management import call_command
+
+from recipes.duplicates import check_recipe
+from recipes.models import NearDuplicate, Recipe
+
+VOCABULARY = [f"word{i}" for i in range(5000)]
+
+def seed(recipes, words):
+    rng = random.Random(1)
+    texts = []
+    for start in range(0, recipes, 10_000):
+        batch = []
+        for i in range(start, min(start + 10_000, recipes)):
+            if texts and rng.random() < 0.05:
+                text = rng.choice(texts).split()
+                for _ in range(3):
+                    text[rng.randrange(len(text))] = rng.choice(VOCABULARY)
+                text = " ".join(text)
+            else:
+                text = " ".join(rng.choices(VOCABULARY, k=words))
+                if len(texts) < 10_000:
+                    texts.append(text)
+            batch.append(Recipe(title=f"Recipe {i}", instructions=text))
+        # `bulk_create` skips the save signal, like an import.
+        Recipe.objects.bulk_create(batch)
+    return texts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipes", type=int, default=1_000_000)
+    parser.add_argument("--words", type=int, default=150)
+    args = parser.parse_args()
+
+    print(f"Seeding {args.recipes} recipes of {args.words} words...")
+    texts = seed(args.recipes, args.words)
+
+    started = time.monotonic()
+    call_command("find_duplicate_recipes")
+    report("find_duplicate_recipes", (time.monotonic() - started) * 1000)
+    print(f"{NearDuplicate.objects.count()} near-duplicate(s) flagged")
+
+    rng = random.Random(2)
+    recipe = Recipe.objects.create(title="New", instructions=rng.choice(texts))
+    samples = iter([" ".join(rng.choices(VOCABULARY, k=args.words)) for _ in range(200)])
+
+    def check():
+        recipe.instructions = next(samples)
+        check_recipe(recipe)
+
+    report("check_recipe (median)", timeit(check, repeat=100))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Time building the MinHash/LSH similarity index and looking up a recipe's similar recipes.
+Ingredients are drawn with a skewed distribution, so a few (salt, oil, ...) appear in
+most recipes and fill some buckets with a large share of all recipes.
+
+    python -m benchmarks.similar_recipes [--recipes 1000000] [--ingredients 5000]
+"""
+import argparse
+import random
+import time
+
+from .common import setup, timeit, report
+
+setup()
+
+from django.core.management import call_command
+from django.db import connection
+
+from recipes.management.commands.import_recipes import insert_links
+from recipes.models import Ingredient, Recipe, Tag
+from recipes.similarity import related_recipes
+
+def seed(recipes, ingredients):
+    ingredient_ids = [obj.pk for obj in Ingredient.objects.bulk_create(Ingredient(name=f"ingredient {i}") for i in range(ingredients))]
+    tag_ids = [obj.pk for obj in Tag.objects.bulk_create(Tag(name=f"tag {i}") for i in range(50))]
+    # Zipf-like weights: the n-th most common ingredient is n times rarer than the first.
+    weights = [1 / (rank + 1) for rank in range(ingredients)]
+    rng = random.Random(1)
+    for start in range(0, recipes, 10_000):
+        batch = Recipe.objects.bulk_create(
+            Recipe(title=f"Recipe {i}", instructions="Mix.") for i in range(start, min(start + 10_000, recipes))
+        )
+        insert_links(Recipe._meta.get_field("ingredients"), [
+            (recipe.pk, pk) for recipe in batch for pk in set(rng.choices(ingredient_ids, weights, k=rng.randint(4, 12)))
+        ])
+        insert_links(Recipe._meta.get_field("tags"), [
+            (recipe.pk, pk) for recipe in batch for pk in rng.sample(tag_ids, rng.randint(0, 3))
+        ])
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipes", type=int, default=1_000_000)
+    parser.add_argument("--ingredients", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"Seeding {args.recipes} recipes over {args.ingredients} ingredients...")
+    seed(args.recipes, args.ingredients)
+
+    started = time.monotonic()
+    call_command("build_similarity_index")
+    report("build index", (time.monotonic() - started) * 1000)
+
+    rng = random.Random(2)
+    pks = list(Recipe.objects.values_list("pk", flat=True))
+    samples = iter([Recipe(pk=rng.choice(pks)) for _ in range(1000)])
+    report("related_recipes (median)", timeit(lambda: related_recipes(next(samples)), repeat=200))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare the old `Q(is_public=True) | Q(chef=chef)` filter with
+`Recipe.objects.visible_to(user)` for a logged-in chef.
+
+    python -m benchmarks.visibility [--recipes 1000000] [--chefs 10000]
+"""
+import argparse
+import random
+
+from .common import setup, timeit, report
+
+setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from recipes.models import Chef, Recipe
+
+PAGE_SIZE = 8
+
+def seed(recipes, chefs):
+    users = User.objects.bulk_create(User(username=f"chef{i}") for i in range(chefs))
+    # `bulk_create` skips the signal that creates a chef per user.
+    chef_ids = [chef.pk for chef in Chef.objects.bulk_create(Chef(user=user, name=user.username) for user in users)]
+    rng = random.Random(1)
+    start = timezone.now()
+    batch = []
+    for i in range(recipes):
+        batch.append(Recipe(
+            title=f"Recipe {i}",
+            chef_id=rng.choice(chef_ids),
+            instructions="Mix.",
+            is_public=rng.random() < 0.7,
+        ))
+        if len(batch) == 10_000:
+            Recipe.objects.bulk_create(batch)
+            batch = []
+    Recipe.objects.bulk_create(batch)
+    # Spread creation times out so ordering by `created_at` is meaningful.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE recipes_recipe SET created_at = datetime(%s, '-' || id || ' seconds')",
+            [start.strftime("%Y-%m-%d %H:%M:%S")],
+        )
+        cursor.execute("ANALYZE")
+    return users[0]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipes", type=int, default=1_000_000)
+    parser.add_argument("--chefs", type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f"Seeding {args.recipes} recipes for {args.chefs} chefs...")
+    user = seed(args.recipes, args.chefs)
+    chef = Chef.objects.get(user=user)
+
+    queries = {
+        "OR filter": Recipe.objects.select_related("chef").filter(Q(is_public=True) | Q(chef=chef)),
+        "visible_to (UNION ALL)": Recipe.objects.select_related("chef").visible_to(user),
+    }
+    for label, qs in queries.items():
+        print(f"-- {label}")
+        for line in qs[:PAGE_SIZE].explain().splitlines():
+            print(f"   {line}")
+        report("first page", timeit(lambda: list(qs[:PAGE_SIZE]), repeat=5))
+        report("page 100", timeit(lambda: list(qs[99 * PAGE_SIZE:100 * PAGE_SIZE]), repeat=5))
+        report("count", timeit(qs.count, repeat=5))
+
+if __name__ == "__main__":
+    main()
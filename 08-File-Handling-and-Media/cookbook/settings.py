@@ -47,6 +47,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'recipes.middleware.ChefMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -121,6 +122,101 @@ STATIC_URL = 'static/'
 # Media files
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+# Store recipe images once per distinct content, named by SHA-256 (see `recipes/storage.py`).
+# Otherwise they keep their names, sharded into `ab/cd/` subdirectories; `manage.py shard_media`
+# moves files uploaded before sharding.
+RECIPE_MEDIA_CONTENT_ADDRESSED = True
+# Media is served by `recipes.views.media_file`, which checks access. Set to "x-sendfile" (Apache,
+# lighttpd) or "x-accel-redirect" (nginx) to let the web server send the bytes; for nginx, map
+# RECIPE_MEDIA_ACCEL_REDIRECT_PREFIX onto MEDIA_ROOT in an `internal` location.
+RECIPE_MEDIA_SENDFILE = None
+RECIPE_MEDIA_ACCEL_REDIRECT_PREFIX = "/protected-media/"
+
+# Caching
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'cookbook',
+    }
+}
+
+# Seconds rendered recipe fragments (detail bodies, list cards) are kept in the cache.
+RECIPE_DETAIL_CACHE_TIMEOUT = 60 * 60
+RECIPE_CARD_CACHE_TIMEOUT = 60 * 60
+# Seconds the chef behind `request.chef` is cached per user.
+RECIPE_CHEF_CACHE_TIMEOUT = 60 * 60
+
+# Recipe views are buffered in memory and flushed every INTERVAL seconds or THRESHOLD views.
+RECIPE_VIEWS_FLUSH_INTERVAL = 10
+RECIPE_VIEWS_FLUSH_THRESHOLD = 500
+# Trending recipes: a view loses half its weight every HALF_LIFE seconds.
+RECIPE_TRENDING_HALF_LIFE = 24 * 60 * 60
+RECIPE_TRENDING_CACHE_TIMEOUT = 60
+
+# "Similar recipes" on a recipe's page (`recipes/similarity.py`): up to COUNT public recipes sharing
+# at least MIN_SIMILARITY of their ingredients and tags (Jaccard similarity).
+RECIPE_RELATED_COUNT = 6
+RECIPE_RELATED_MIN_SIMILARITY = 0.2
+
+# Ingredient and tag suggestions on the recipe form (`recipes/autocomplete.py`) come from an index
+# in each process's memory, rebuilt when names change or at the latest every MAX_AGE seconds.
+RECIPE_AUTOCOMPLETE_SUGGESTIONS = 10
+RECIPE_AUTOCOMPLETE_MAX_AGE = 5 * 60
+
+# "Goes well with" suggestions on the recipe form (`recipes/pairings.py`, rebuilt by
+# `manage.py compute_ingredient_pairings`): the TOP pairings are kept per ingredient, among
+# ingredients used together in at least MIN_RECIPES recipes.
+RECIPE_PAIRING_MIN_RECIPES = 5
+RECIPE_PAIRING_TOP = 20
+RECIPE_PAIRING_SUGGESTIONS = 8
+
+# Counts per tag, difficulty and cook time in the recipe list sidebar (`recipes/facets.py`),
+# cached per filter state until a change that affects them. Only the TAGS most common tags
+# are shown. Outdated counts are served for up to REBUILD_TIMEOUT while one request recounts.
+RECIPE_FACET_CACHE_TIMEOUT = 60 * 60
+RECIPE_FACET_TAGS = 20
+RECIPE_FACET_REBUILD_TIMEOUT = 60
+
+# Recipes sharing at least MIN_SIMILARITY of their instructions' 3-word sequences with another
+# are flagged for review in the admin (`recipes/duplicates.py`); instructions of fewer than
+# MIN_WORDS words are never compared.
+RECIPE_DUPLICATE_MIN_SIMILARITY = 0.7
+RECIPE_DUPLICATE_MIN_WORDS = 20
+
+# Background image jobs (`manage.py process_image_jobs`): retries back off from RETRY_DELAY
+# seconds, doubling each time, and a job locked longer than LOCK_TIMEOUT is assumed abandoned.
+RECIPE_IMAGE_JOB_MAX_ATTEMPTS = 5
+RECIPE_IMAGE_JOB_RETRY_DELAY = 30
+RECIPE_IMAGE_JOB_LOCK_TIMEOUT = 10 * 60
+
+# Every uploaded image gets a copy at each of these widths, in each of these formats (AVIF only
+# if Pillow can encode it) plus a JPEG/PNG fallback, served through `{% picture %}`.
+RECIPE_IMAGE_WIDTHS = [200, 400, 800, 1600]
+RECIPE_IMAGE_FORMATS = ["avif", "webp"]
+# Gallery images are shrunk to fit this box. After changing any of these three settings,
+# run `manage.py regenerate_images` to bring existing images up to date.
+RECIPE_GALLERY_MAX_SIZE = (800, 800)
+# Longer side of the blurred preview inlined into pages while an image loads; images stored
+# before it existed get theirs from `manage.py regenerate_images`.
+RECIPE_IMAGE_PLACEHOLDER_SIZE = 20
+# "queue" leaves gallery uploads to the background worker; "inline" processes all images of a
+# request concurrently on THREADS threads before the recipe is saved, so they are ready at once.
+RECIPE_GALLERY_PROCESSING = "queue"
+RECIPE_GALLERY_PROCESSING_THREADS = 4
+# Limits on the zip archives of photos a chef can add to a gallery at once.
+RECIPE_GALLERY_ZIP_MAX_SIZE = 500 * 1024 * 1024
+RECIPE_GALLERY_ZIP_MAX_FILES = 500
+RECIPE_GALLERY_ZIP_MAX_ENTRY_SIZE = 50 * 1024 * 1024
+# Uploads with more pixels than this are refused from their header, before any decoding.
+RECIPE_IMAGE_MAX_PIXELS = 100_000_000
+
+# Resumable uploads (`recipes/uploads.py`): files of up to MAX_SIZE bytes, sent in chunks of at
+# most CHUNK_SIZE bytes. Unfinished or unused uploads are deleted after EXPIRY seconds.
+RECIPE_CHUNKED_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+RECIPE_CHUNKED_UPLOAD_CHUNK_SIZE = 1024 * 1024
+RECIPE_CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Chef, Ingredient, Tag, Recipe, RecipeImage
+from django.utils import timezone
+from .cache import touch_recipes
+from .facets import invalidate as invalidate_facets
+from .models import Chef, Ingredient, Tag, Recipe, RecipeImage, ImageJob, NearDuplicate
 
 @admin.register(Chef)
 class ChefAdmin(admin.ModelAdmin):
@@ -19,6 +22,7 @@ class TagAdmin(admin.ModelAdmin):
 class RecipeImageInline(admin.TabularInline):
     model = RecipeImage
     extra = 1
+    readonly_fields = ("status",)
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
@@ -27,3 +31,40 @@ class RecipeAdmin(admin.ModelAdmin):
     list_filter = ("difficulty", "tags")
     search_fields = ("title", "chef__name", "ingredients__name")
     filter_horizontal = ("ingredients", "tags")
+
+
+@admin.register(ImageJob)
+class ImageJobAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "status", "attempts", "run_after", "created_at")
+    list_filter = ("status", "content_type")
+    readonly_fields = ("last_error",)
+    actions = ["retry_jobs"]
+
+    @admin.action(description="Retry selected jobs now")
+    def retry_jobs(self, request, queryset):
+        queryset.update(status="pending", attempts=0, run_after=timezone.now(), locked_at=None)
+
+@admin.register(NearDuplicate)
+class NearDuplicateAdmin(admin.ModelAdmin):
+    list_display = ("recipe", "original", "similarity", "status", "created_at")
+    list_filter = ("status",)
+    list_select_related = ("recipe", "original")
+    search_fields = ("recipe__title", "original__title")
+    raw_id_fields = ("recipe", "original")
+    actions = ["mark_duplicate", "mark_duplicate_and_make_private", "mark_distinct"]
+
+    @admin.action(description="Confirm as duplicates")
+    def mark_duplicate(self, request, queryset):
+        queryset.update(status="duplicate")
+
+    @admin.action(description="Confirm as duplicates and make the copies private")
+    def mark_duplicate_and_make_private(self, request, queryset):
+        recipe_ids = list(queryset.values_list("recipe_id", flat=True))
+        queryset.update(status="duplicate")
+        Recipe.objects.filter(pk__in=recipe_ids).update(is_public=False)
+        touch_recipes(recipe_ids)
+        invalidate_facets()
+
+    @admin.action(description="Mark as not duplicates")
+    def mark_distinct(self, request, queryset):
+        queryset.update(status="distinct")
@@ -0,0 +1,105 @@
+"""
+Ingredient and tag name suggestions for the recipe form, answered from memory.
+
+Each process keeps a sorted list of search keys per model: every name, casefolded, and
+every part of it from the start of a word on, so "oil" finds "Olive oil" too. A prefix
+is looked up with `bisect`, without touching the database.
+
+Saving or deleting an ingredient or tag stores a new generation token in the cache (see
+`recipes.models`). A process rebuilds its index on the next lookup once the token has
+changed, or at the latest MAX_AGE seconds after the last build, in case the cache isn't
+shared between processes. Lookups read an immutable snapshot, so the threads of a
+process share one index without locking; only rebuilds take the lock.
+"""
+import bisect
+import re
+import threading
+import time
+import uuid
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+SUGGESTIONS = getattr(settings, "RECIPE_AUTOCOMPLETE_SUGGESTIONS", 10)
+MAX_AGE = getattr(settings, "RECIPE_AUTOCOMPLETE_MAX_AGE", 5 * 60)
+
+# Where words start inside a name: after a space, hyphen, comma, ...
+_WORD_START = re.compile(r"(?<=\W)\w")
+
+def _generation_key(model):
+    return f"recipes:autocomplete:{model._meta.label_lower}"
+
+def invalidate(model):
+    """ Make every process rebuild its index of `model` before its next lookup. """
+    # A fresh token rather than a counter: if the cache drops the key, a counter could
+    # come back to the value an index was built at.
+    cache.set(_generation_key(model), uuid.uuid4().hex, None)
+
+class _Snapshot(NamedTuple):
+    keys: list
+    ids: list
+    names: dict
+    generation: str
+    built_at: float
+
+class PrefixIndex:
+    """ In-memory prefix index over the `name`s of `model`'s rows. """
+
+    def __init__(self, model):
+        self.model = model
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self, snapshot, generation):
+        return snapshot is None or snapshot.generation != generation or time.monotonic() - snapshot.built_at > MAX_AGE
+
+    def _current(self):
+        generation = cache.get(_generation_key(self.model))
+        snapshot = self._snapshot
+        if self._is_stale(snapshot, generation):
+            with self._lock:
+                # Another thread may have rebuilt it while this one waited.
+                snapshot = self._snapshot
+                if self._is_stale(snapshot, generation):
+                    snapshot = self._snapshot = self._build(generation)
+        return snapshot
+
+    def _build(self, generation):
+        entries, names = [], {}
+        for pk, name in self.model.objects.order_by().values_list("pk", "name").iterator(chunk_size=10_000):
+            names[pk] = name
+            folded = name.casefold()
+            entries.append((folded, pk))
+            entries.extend((folded[match.start():], pk) for match in _WORD_START.finditer(folded))
+        entries.sort()
+        return _Snapshot(
+            keys=[key for key, _ in entries], ids=[pk for _, pk in entries], names=names,
+            generation=generation, built_at=time.monotonic(),
+        )
+
+    def search(self, prefix, limit=SUGGESTIONS):
+        """ Up to `limit` `(id, name)` pairs whose name, or a word in it, starts with `prefix`. """
+        prefix = prefix.strip().casefold()
+        if not prefix:
+            return []
+        snapshot = self._current()
+        results, seen = [], set()
+        index = bisect.bisect_left(snapshot.keys, prefix)
+        while index < len(snapshot.keys) and len(results) < limit and snapshot.keys[index].startswith(prefix):
+            pk = snapshot.ids[index]
+            if pk not in seen:
+                seen.add(pk)
+                results.append((pk, snapshot.names[pk]))
+            index += 1
+        return results
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def prefix_index(model):
+    """ The process-wide `PrefixIndex` of `model` (`Ingredient` or `Tag`). """
+    if model not in _indexes:
+        with _indexes_lock:
+            _indexes.setdefault(model, PrefixIndex(model))
+    return _indexes[model]
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import prefetch_related_objects
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+# Seconds a rendered recipe fragment stays cached. Entries are keyed by `updated_at`,
+# so edits roll the key over and stale entries simply expire.
+DETAIL_CACHE_TIMEOUT = getattr(settings, "RECIPE_DETAIL_CACHE_TIMEOUT", 60 * 60)
+CARD_CACHE_TIMEOUT = getattr(settings, "RECIPE_CARD_CACHE_TIMEOUT", 60 * 60)
+CHEF_CACHE_TIMEOUT = getattr(settings, "RECIPE_CHEF_CACHE_TIMEOUT", 60 * 60)
+
+def detail_cache_key(pk, updated_at):
+    """ Cache key for the rendered body of a recipe's detail page. """
+    return f"recipes:detail:{pk}:{updated_at.timestamp()}"
+
+def card_cache_key(pk, updated_at):
+    """ Cache key for the rendered card/table row of a recipe in list pages. """
+    return f"recipes:card:{pk}:{updated_at.timestamp()}"
+
+def render_recipe_cards(recipes):
+    """
+    Return the rendered card of each recipe, in order.
+    All cards are fetched in one cache round trip; only the misses get their
+    ingredients loaded and are re-rendered.
+    """
+    recipes = list(recipes)
+    keys = [card_cache_key(recipe.pk, recipe.updated_at) for recipe in recipes]
+    cards = cache.get_many(keys)
+
+    missing = [(key, recipe) for key, recipe in zip(keys, recipes) if key not in cards]
+    if missing:
+        from .imaging import attach_derivatives
+
+        prefetch_related_objects([recipe for _, recipe in missing], "ingredients")
+        attach_derivatives([recipe.image for _, recipe in missing])
+        fresh = {
+            key: render_to_string("recipes/recipe_card.html", {"recipe": recipe})
+            for key, recipe in missing
+        }
+        cache.set_many(fresh, CARD_CACHE_TIMEOUT)
+        cards.update(fresh)
+    return [cards[key] for key in keys]
+
+def touch_recipes(pks):
+    """
+    Bump `updated_at` on the given recipes so every cache entry keyed by it rolls over.
+    Used for changes that `auto_now` does not see (e.g. M2M edits).
+    """
+    from .models import Recipe
+
+    pks = [pk for pk in pks if pk is not None]
+    if not pks:
+        return None
+    now = timezone.now()
+    Recipe.objects.filter(pk__in=pks).update(updated_at=now)
+    return now
+
+def forget_recipe(recipe):
+    """ Drop the cached detail fragment of a recipe (e.g. once it is deleted). """
+    if recipe.pk is not None and recipe.updated_at is not None:
+        cache.delete(detail_cache_key(recipe.pk, recipe.updated_at))
+
+def chef_cache_key(user_id):
+    return f"recipes:chef:{user_id}"
+
+def get_chef_for_user(user):
+    """
+    Return the chef of an authenticated user, from the cache when possible.
+    Users get their chef from a signal when they're created; older accounts get one here.
+    """
+    from .models import Chef
+
+    key = chef_cache_key(user.pk)
+    chef = cache.get(key)
+    if chef is None:
+        chef, _ = Chef.objects.get_or_create(user=user)
+        cache.set(key, chef, CHEF_CACHE_TIMEOUT)
+    return chef
+
+def forget_chef(chef):
+    cache.delete(chef_cache_key(chef.user_id))
@@ -0,0 +1,130 @@
+"""
+Write-behind view counters and the trending list built from them.
+
+Views are tallied in process memory and flushed to the database as a batch
+of atomic increments, either every RECIPE_VIEWS_FLUSH_INTERVAL seconds or as
+soon as RECIPE_VIEWS_FLUSH_THRESHOLD views are pending. Each worker process
+only ever adds its own tally, so several workers never double count, and a
+crash loses at most the views of one flush interval.
+
+Trending scores use forward decay: a view at time `t` weighs
+`2 ** ((t - EPOCH) / HALF_LIFE)`, so the score of every recipe is a plain sum
+that can be incremented without reading it first, and ordering by it is the
+same as ordering by exponentially decayed view counts. The sum is stored as
+its base-2 logarithm so it never overflows.
+"""
+import atexit
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least, Log, Power
+
+FLUSH_INTERVAL = getattr(settings, "RECIPE_VIEWS_FLUSH_INTERVAL", 10)
+FLUSH_THRESHOLD = getattr(settings, "RECIPE_VIEWS_FLUSH_THRESHOLD", 500)
+TRENDING_HALF_LIFE = getattr(settings, "RECIPE_TRENDING_HALF_LIFE", 24 * 60 * 60)
+TRENDING_EPOCH = getattr(settings, "RECIPE_TRENDING_EPOCH", datetime(2025, 1, 1, tzinfo=timezone.utc)).timestamp()
+TRENDING_SIZE = getattr(settings, "RECIPE_TRENDING_SIZE", 5)
+TRENDING_CACHE_TIMEOUT = getattr(settings, "RECIPE_TRENDING_CACHE_TIMEOUT", 60)
+TRENDING_CACHE_KEY = "recipes:trending"
+
+logger = logging.getLogger(__name__)
+
+def log_weight(views, at):
+    """ log2 of the forward-decayed weight of `views` views seen at unix time `at`. """
+    return math.log2(views) + (at - TRENDING_EPOCH) / TRENDING_HALF_LIFE
+
+def log2_add(field, log_value):
+    """ Expression for `log2(2 ** field + 2 ** log_value)`, computed without overflowing. """
+    high = Greatest(F(field), Value(log_value))
+    low = Least(F(field), Value(log_value))
+    return high + Log(2, 1 + Power(2, low - high))
+
+class ViewCounter:
+    """ Per-process buffer of recipe views with a background flusher thread. """
+
+    def __init__(self, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self._pending = Counter()
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record(self, recipe_id, views=1):
+        with self._lock:
+            self._pending[recipe_id] += views
+            self._pending_total += views
+            total = self._pending_total
+            if self._thread is None:
+                self._start()
+        if total >= self.threshold:
+            self._wake.set()
+
+    def flush(self):
+        """ Write all pending views to the database. Returns the number of views written. """
+        with self._lock:
+            batch, self._pending = self._pending, Counter()
+            self._pending_total = 0
+        if not batch:
+            return 0
+
+        from .models import Recipe
+
+        now = time.time()
+        try:
+            with transaction.atomic():
+                for recipe_id, views in batch.items():
+                    Recipe.objects.filter(pk=recipe_id).update(
+                        view_count=F("view_count") + views,
+                        trending_score=log2_add("trending_score", log_weight(views, now)),
+                    )
+        except Exception:
+            # Put the batch back so the next flush retries it.
+            with self._lock:
+                self._pending.update(batch)
+                self._pending_total += sum(batch.values())
+            raise
+        return sum(batch.values())
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="recipe-view-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not flush recipe views; retrying on the next interval.")
+            finally:
+                connection.close()
+
+view_counter = ViewCounter()
+
+def record_view(recipe_id):
+    view_counter.record(recipe_id)
+
+def trending_recipes():
+    """ Public recipes with the highest decayed view counts, cached for a short while. """
+    from .models import Recipe
+
+    def build():
+        return list(
+            Recipe.objects.filter(is_public=True, view_count__gt=0)
+            .order_by("-trending_score")
+            .values("pk", "title", "view_count")[:TRENDING_SIZE]
+        )
+    return cache.get_or_set(TRENDING_CACHE_KEY, build, TRENDING_CACHE_TIMEOUT)
@@ -0,0 +1,174 @@
+"""
+Near-duplicate detection over recipe instructions, for copy-pasted recipes with minor
+edits.
+
+Instructions are normalised (case, accents, punctuation and spacing dropped) and cut
+into shingles of SHINGLE_SIZE consecutive words. Two recipes are near-duplicates when
+at least MIN_SIMILARITY of their shingles are shared (Jaccard similarity): changing a
+couple of words in a 100-word text still leaves about 90% of them in common.
+
+To find those without comparing every pair, the shingles get a MinHash signature, cut
+into BANDS bands that are stored as bucket keys (`InstructionBucket`), as for similar
+recipes (see `recipes.similarity`). With 10 bands of 6 rows, texts that are 90% alike
+almost always share a bucket, texts that are 80% alike with 95% probability and texts
+that are 40% alike with 4%; the few candidates a lookup returns are compared exactly.
+
+Matches are recorded as `NearDuplicate` rows for moderators to review in the admin:
+one per copy, against the earlier recipe it matches best, so a text copied n times
+gives n - 1 rows rather than one per pair. New and edited recipes are checked when they are saved (see
+`recipes.models.check_instructions_on_save`); `manage.py find_duplicate_recipes`
+indexes and checks existing recipes.
+"""
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .similarity import bucket_keys, jaccard, minhash
+
+SHINGLE_SIZE = 3
+# Changing this invalidates the stored buckets; run `manage.py find_duplicate_recipes` after.
+BANDS = 10
+MIN_SIMILARITY = getattr(settings, "RECIPE_DUPLICATE_MIN_SIMILARITY", 0.7)
+# Instructions shorter than this ("Mix.", "See video") are too generic to compare.
+MIN_WORDS = getattr(settings, "RECIPE_DUPLICATE_MIN_WORDS", 20)
+# Bucket rows read per key looked up. Only instructions copied hundreds of times fill a
+# bucket this far, and a handful of those is enough to flag a copy.
+MAX_CANDIDATES = getattr(settings, "RECIPE_DUPLICATE_MAX_CANDIDATES", 100)
+# Keys looked up per query; SQLite allows at most 500 SELECTs in a compound one.
+KEYS_PER_QUERY = 250
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+def normalize(text):
+    """ Words of `text`, lowercased, without accents or punctuation. """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _NON_WORD.sub(" ", text).split()
+
+def shingles(text):
+    """ The distinct SHINGLE_SIZE-word sequences of `text`; empty if it is too short to compare. """
+    words = normalize(text)
+    if len(words) < MIN_WORDS:
+        return set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def instruction_keys(shingle_set):
+    """ Bucket keys of a set of shingles. """
+    # Shingles rarely recur, so caching their hashes would only evict ingredients'.
+    return bucket_keys(minhash(shingle_set, cached=False), bands=BANDS) if shingle_set else set()
+
+def index_instructions(keys):
+    """ Replace the buckets of the recipes in `{recipe id: bucket keys}`. """
+    from .models import InstructionBucket
+
+    rows = [(pk, key) for pk, recipe_keys in keys.items() for key in recipe_keys]
+    quote = connection.ops.quote_name
+    table = quote(InstructionBucket._meta.db_table)
+    columns = ", ".join(quote(InstructionBucket._meta.get_field(name).column) for name in ("recipe", "key"))
+    with transaction.atomic(), connection.cursor() as cursor:
+        InstructionBucket.objects.filter(recipe_id__in=list(keys)).delete()
+        cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s)", rows)
+
+def _bucket_members(keys):
+    """
+    `(key, recipe id)` for up to MAX_CANDIDATES recipes in each bucket of `keys`. Each
+    bucket is read on its own with a LIMIT, so one that boilerplate ("Preheat the oven
+    ...") fills can't crowd out the others; as in `recipes.similarity._band_members()`,
+    the ORM can't express LIMIT inside a UNION on SQLite.
+    """
+    from .models import InstructionBucket
+
+    quote = connection.ops.quote_name
+    table = quote(InstructionBucket._meta.db_table)
+    recipe_column = quote(InstructionBucket._meta.get_field("recipe").column)
+    key_column = quote(InstructionBucket._meta.get_field("key").column)
+    bucket = (
+        f"SELECT * FROM (SELECT {key_column}, {recipe_column} FROM {table} "
+        f"WHERE {key_column} = %s LIMIT %s) AS bucket{{}}"
+    )
+    rows = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(keys), KEYS_PER_QUERY):
+            chunk = keys[start:start + KEYS_PER_QUERY]
+            sql = " UNION ALL ".join(bucket.format(index) for index in range(len(chunk)))
+            cursor.execute(sql, [value for key in chunk for value in (key, MAX_CANDIDATES)])
+            rows.extend(cursor.fetchall())
+    return rows
+
+def find_near_duplicates(shingle_sets, keys):
+    """
+    `(recipe id, other recipe id, similarity)` for every indexed recipe at least
+    MIN_SIMILARITY alike to one of `{recipe id: shingles}` with `{recipe id: bucket keys}`.
+    One query per KEYS_PER_QUERY bucket keys, and one for the candidates' instructions.
+    """
+    from .models import Recipe
+
+    owners = {}
+    for pk, recipe_keys in keys.items():
+        for key in recipe_keys:
+            owners.setdefault(key, set()).add(pk)
+    if not owners:
+        return []
+    pairs = {(pk, other) for key, other in _bucket_members(list(owners)) for pk in owners[key] if pk != other}
+    others = {other for _, other in pairs} - set(shingle_sets)
+    texts = dict(Recipe.objects.filter(pk__in=others).values_list("pk", "instructions")) if others else {}
+    other_sets = {pk: shingles(text) for pk, text in texts.items()}
+    matches = []
+    for pk, other in sorted(pairs):
+        other_set = shingle_sets[other] if other in shingle_sets else other_sets.get(other, set())
+        if (similarity := jaccard(shingle_sets[pk], other_set)) >= MIN_SIMILARITY:
+            matches.append((pk, other, similarity))
+    return matches
+
+def flag_near_duplicates(matches):
+    """
+    Record `find_near_duplicates()` matches for moderation: each copy once, against the
+    original it is most alike (the earliest of equally alike ones). Copies with a flag
+    still awaiting review are left as they are.
+    """
+    from .models import NearDuplicate
+
+    best = {}
+    for pk, other, similarity in matches:
+        # The later recipe is the copy.
+        recipe_id, original_id = max(pk, other), min(pk, other)
+        if recipe_id not in best or (similarity, -original_id) > (best[recipe_id][1], -best[recipe_id][0]):
+            best[recipe_id] = (original_id, similarity)
+    pending = set(
+        NearDuplicate.objects.filter(recipe_id__in=list(best), status="pending").values_list("recipe_id", flat=True)
+    )
+    flags = [
+        NearDuplicate(recipe_id=recipe_id, original_id=original_id, similarity=similarity)
+        for recipe_id, (original_id, similarity) in best.items() if recipe_id not in pending
+    ]
+    NearDuplicate.objects.bulk_create(flags, ignore_conflicts=True)
+    return len(flags)
+
+def check_recipe(recipe):
+    """
+    Update the buckets of `recipe`'s instructions and flag the recipes it nearly
+    duplicates. A few queries; nothing is written when its buckets haven't changed.
+    """
+    from .models import InstructionBucket, NearDuplicate, Recipe
+
+    shingle_set = shingles(recipe.instructions)
+    keys = instruction_keys(shingle_set)
+    if keys == set(InstructionBucket.objects.filter(recipe=recipe).values_list("key", flat=True)):
+        return
+    with transaction.atomic():
+        # Flags no one has looked at yet were about the old text, whichever side it was on.
+        stale = NearDuplicate.objects.filter(Q(recipe=recipe) | Q(original=recipe), status="pending")
+        copies = set(stale.exclude(recipe=recipe).values_list("recipe_id", flat=True))
+        stale.delete()
+        index_instructions({recipe.pk: keys})
+        shingle_sets, key_sets = {recipe.pk: shingle_set}, {recipe.pk: keys}
+        # Copies of the old text may copy another recipe as well; they are matched again.
+        for pk, instructions in Recipe.objects.filter(pk__in=copies).values_list("pk", "instructions"):
+            shingle_sets[pk] = shingles(instructions)
+            key_sets[pk] = set()
+        for pk, key in InstructionBucket.objects.filter(recipe_id__in=copies).values_list("recipe_id", "key"):
+            key_sets[pk].add(key)
+        flag_near_duplicates(find_near_duplicates(shingle_sets, key_sets))
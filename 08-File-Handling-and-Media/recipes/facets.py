@@ -0,0 +1,182 @@
+"""
+Facet counts for the recipe list sidebar: how many of the current results carry each
+tag, have each difficulty and fall in each cook-time range.
+
+Each visibility branch takes the same three queries, however many tags there are: one
+grouped over the tags through table, one for those tags' names, and one grouped over
+(difficulty, cook-time range) pairs, from which both of those facets are summed. As in
+`RecipeQuerySet.visible_to()`, a user's results are public recipes plus their own
+private ones, so the public counts are shared by everybody and only the (small)
+private ones are counted per user.
+
+Counting visits every matching recipe: at a million recipes it takes 0.4 to 2.4
+seconds depending on the filters (`benchmarks/facets.py`), against 1 or 2 ms for cached
+counts. So counts are cached under the normalised filter state, together with the
+generation token they were counted at. Only changes that can move a recipe in or out
+of a facet store a new token (see `recipes.models`); edits to instructions or images,
+view counts and `updated_at` touches don't. Counts of an older generation are still
+served while one request counts them again, so on a site with steady edits it's one
+request per filter state and change that waits, not every one.
+"""
+import hashlib
+import json
+import string
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, Value, When
+
+FACET_CACHE_TIMEOUT = getattr(settings, "RECIPE_FACET_CACHE_TIMEOUT", 60 * 60)
+# Only the most common tags of the results are listed.
+FACET_TAGS = getattr(settings, "RECIPE_FACET_TAGS", 20)
+# Seconds other requests serve outdated counts while one counts them again, at most.
+FACET_REBUILD_TIMEOUT = getattr(settings, "RECIPE_FACET_REBUILD_TIMEOUT", 60)
+
+# `(value of the "time" filter, label, fewest minutes, most minutes)`, in order.
+COOK_TIME_RANGES = [
+    ("under-15", "15 minutes or less", 0, 15),
+    ("15-30", "16 to 30 minutes", 16, 30),
+    ("30-60", "31 to 60 minutes", 31, 60),
+    ("over-60", "Over an hour", 61, None),
+]
+
+# The GET parameters that narrow down the recipe list.
+FILTERS = ("tag", "ingredient", "chef", "q", "difficulty", "time")
+
+_GENERATION_KEY = "recipes:facets:generation"
+# Only ASCII letters are folded: that's as far as SQLite's case-insensitive matching
+# goes, so two filters that fold alike always match the same recipes.
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def invalidate():
+    """ Orphan every cached facet count. """
+    # A fresh token rather than a counter, as in `recipes.autocomplete`.
+    cache.set(_GENERATION_KEY, uuid.uuid4().hex, None)
+
+def _generation():
+    generation = cache.get(_GENERATION_KEY)
+    if generation is None:
+        cache.add(_GENERATION_KEY, uuid.uuid4().hex, None)
+        generation = cache.get(_GENERATION_KEY)
+    return generation
+
+def normalise_filters(params):
+    """
+    The recipe list filters in `params` (a `QueryDict`), trimmed and lower-cased, with
+    unknown difficulties and cook-time ranges left out. Filter with these rather than
+    the raw parameters, so that requests sharing cached counts list the same recipes.
+    """
+    from .models import DIFFICULTY_CHOICES
+
+    filters = {}
+    for name in FILTERS:
+        value = params.get(name, "").strip().translate(_ASCII_LOWER)
+        if value:
+            filters[name] = value
+    difficulty = filters.pop("difficulty", "").upper()
+    if difficulty in dict(DIFFICULTY_CHOICES):
+        filters["difficulty"] = difficulty
+    if filters.get("time") not in {value for value, _, _, _ in COOK_TIME_RANGES}:
+        filters.pop("time", None)
+    return filters
+
+def cook_time_bounds(value):
+    """ `(fewest, most)` minutes of the cook-time range `value`; `most` is None for the last one. """
+    for key, _, low, high in COOK_TIME_RANGES:
+        if key == value:
+            return low, high
+    raise KeyError(value)
+
+def _cook_time_range():
+    return Case(
+        *(When(cook_time_in_minutes__lte=high, then=Value(value)) for value, _, _, high in COOK_TIME_RANGES[:-1]),
+        default=Value(COOK_TIME_RANGES[-1][0]),
+    )
+
+def _count(recipes):
+    """ `{"tag": {name: count}, "difficulty": {...}, "time": {...}}` over `recipes`, in three queries. """
+    from .models import Recipe, Tag
+
+    if recipes.query.distinct:
+        # Tag and ingredient filters join rows that would be counted more than once.
+        recipes = Recipe.objects.filter(pk__in=recipes.values("pk"))
+    # Grouped by id alone, without joining names into the sort; names are a lookup by primary key.
+    tags = dict(
+        Recipe.tags.through.objects.filter(recipe__in=recipes.values("pk"))
+        .values_list("tag_id").annotate(count=Count("*")).order_by()
+    )
+    names = Tag.objects.filter(pk__in=list(tags)).values_list("pk", "name")
+    counts = {"tag": {name: tags[pk] for pk, name in names}, "difficulty": {}, "time": {}}
+    pairs = recipes.values("difficulty", time=_cook_time_range()).annotate(count=Count("*")).order_by()
+    for row in pairs:
+        for name in ("difficulty", "time"):
+            counts[name][row[name]] = counts[name].get(row[name], 0) + row["count"]
+    return counts
+
+def _visible_parts(recipes, user):
+    """ Disjoint parts of `recipes` that `user` may see, by cache scope (cf. `visible_to()`). """
+    if user.is_authenticated and user.is_staff:
+        return {"all": recipes}
+    parts = {"public": recipes.filter(is_public__in=[True])}
+    if user.is_authenticated:
+        parts[f"user{user.pk}"] = recipes.filter(is_public__in=[False], chef__user=user)
+    return parts
+
+def count_facets(recipes, filters, user):
+    """
+    Facet counts of the recipes `user` may see among `recipes`, which must be filtered
+    by exactly `filters` (from `normalise_filters()`) and not yet by `visible_to()`.
+    """
+    state = hashlib.sha1(json.dumps(sorted(filters.items())).encode()).hexdigest()
+    generation = _generation()
+    parts = {f"recipes:facets:{state}:{scope}": part for scope, part in _visible_parts(recipes, user).items()}
+    cached = cache.get_many(parts)
+    current, fresh = {}, {}
+    for key, part in parts.items():
+        entry = cached.get(key)
+        up_to_date = entry is not None and entry[0] == generation
+        # Outdated counts are served while another request counts them again.
+        if up_to_date or (entry is not None and not cache.add(f"{key}:rebuild", True, FACET_REBUILD_TIMEOUT)):
+            current[key] = entry[1]
+        else:
+            current[key] = _count(part)
+            fresh[key] = (generation, current[key])
+    if fresh:
+        cache.set_many(fresh, FACET_CACHE_TIMEOUT)
+        cache.delete_many([f"{key}:rebuild" for key in fresh])
+
+    totals = {"tag": {}, "difficulty": {}, "time": {}}
+    for counts in current.values():
+        for name, values in counts.items():
+            for value, count in values.items():
+                totals[name][value] = totals[name].get(value, 0) + count
+    return totals
+
+def facet_links(params, filters, totals):
+    """
+    The sidebar of the recipe list: `(title, [(label, count, url, selected)])` per facet,
+    where `url` adds the value to the current filters in `params`, or takes it off again.
+    """
+    from .models import DIFFICULTY_CHOICES
+
+    def link(name, value, label, count):
+        selected = filters.get(name) == (value.translate(_ASCII_LOWER) if name == "tag" else value)
+        query = params.copy()
+        query.pop("page", None)
+        if selected:
+            query.pop(name, None)
+        else:
+            query[name] = value
+        return label, count, f"?{query.urlencode()}", selected
+
+    tags = sorted(totals["tag"].items(), key=lambda item: (-item[1], item[0]))[:FACET_TAGS]
+    facets = [
+        ("Tags", [(name, name, count) for name, count in tags]),
+        ("Difficulty", [(value, label, totals["difficulty"].get(value, 0)) for value, label in DIFFICULTY_CHOICES]),
+        ("Cook time", [(value, label, totals["time"].get(value, 0)) for value, label, _, _ in COOK_TIME_RANGES]),
+    ]
+    return [
+        (title, [link(name, value, label, count) for value, label, count in values if count])
+        for name, (title, values) in zip(("tag", "difficulty", "time"), facets)
+    ]
@@ -1,25 +1,142 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from django.core.validators import FileExtensionValidator
+from django.urls import reverse
 
-from .models import Recipe, RecipeImage, Chef, Ingredient, Tag
+from .gallery_import import ZIP_MAX_SIZE
+from .models import Recipe, RecipeImage, Chef, Ingredient, Tag, ChunkedUpload
+from .uploads import upload_file
 
-class RecipeForm(forms.ModelForm):
+class ChunkedImageMixin:
+    """
+    Lets a model form take its `image` from a completed chunked upload, referenced by id
+    in the hidden `image_upload` field, instead of from the files of its own request.
+    Call `discard_upload()` once the form's data has been saved.
+    """
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        self.chunked_upload = None
+        self.fields["image_upload"] = forms.UUIDField(required=False, widget=forms.HiddenInput)
+        # The image may come from either field, so `clean()` checks for it instead.
+        self.image_required = self.fields["image"].required
+        self.fields["image"].required = False
+
+    def clean_image_upload(self):
+        upload_id = self.cleaned_data.get("image_upload")
+        if upload_id is None:
+            return None
+        try:
+            return ChunkedUpload.objects.get(pk=upload_id, user=self.user, status="complete")
+        except (ChunkedUpload.DoesNotExist, ValueError, TypeError):
+            raise forms.ValidationError("This upload doesn't exist or hasn't finished yet.")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        upload = cleaned_data.get("image_upload")
+        if upload is not None:
+            try:
+                # Same checks as a regular upload; Pillow reads the file from disk.
+                cleaned_data["image"] = forms.ImageField().clean(upload_file(upload))
+                self.chunked_upload = upload
+            except forms.ValidationError as error:
+                self.add_error("image", error)
+        elif self.image_required and not cleaned_data.get("image"):
+            self.add_error("image", forms.Field.default_error_messages["required"])
+        return cleaned_data
+
+    def discard_upload(self):
+        """ Delete the chunked upload the image came from, now that it has been stored. """
+        if self.chunked_upload is not None:
+            self.cleaned_data["image"].close()
+            self.chunked_upload.delete()
+            self.chunked_upload = None
+
+class AutocompleteSelectMultiple(forms.SelectMultiple):
+    """
+    Multiple select that renders only the chosen options, so the page doesn't grow with
+    the table. `recipes/autocomplete.js` turns it into a text box that suggests names
+    from the JSON view named `url_name`, and, with `suggest_url_name`, offers what the
+    view of that name suggests for the current choice.
+    """
+    def __init__(self, url_name, suggest_url_name=None, attrs=None):
+        super().__init__(attrs)
+        self.url_name = url_name
+        self.suggest_url_name = suggest_url_name
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context["widget"]["attrs"]["data-autocomplete-url"] = reverse(self.url_name)
+        if self.suggest_url_name:
+            context["widget"]["attrs"]["data-suggest-url"] = reverse(self.suggest_url_name)
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        # Rather than iterating over every choice, load just the selected ones.
+        pks = [pk for pk in value if str(pk).isdigit()]
+        selected = self.choices.queryset.filter(pk__in=pks) if pks else []
+        return [
+            (None, [self.create_option(name, obj.pk, str(obj), True, index)], index)
+            for index, obj in enumerate(selected)
+        ]
+
+class ModelIdsField(forms.ModelMultipleChoiceField):
+    """ Multiple choice field that checks all submitted ids with one `pk__in` query. """
+
+    def _check_values(self, value):
+        try:
+            pks = {int(pk) for pk in value}
+        except (TypeError, ValueError):
+            raise forms.ValidationError(self.error_messages["invalid_list"], code="invalid_list")
+        queryset = self.queryset.filter(pk__in=pks)
+        # Evaluated here, so saving the form reuses the rows.
+        missing = pks - {obj.pk for obj in queryset}
+        if missing:
+            raise forms.ValidationError(
+                self.error_messages["invalid_choice"], code="invalid_choice", params={"value": min(missing)},
+            )
+        return queryset
+
+class RecipeForm(ChunkedImageMixin, forms.ModelForm):
     class Meta:
         model = Recipe
         fields = ["title", "chef", "ingredients", "tags", "instructions", "cook_time_in_minutes", "difficulty", "is_public", "image"]
+        field_classes = {
+            "ingredients": ModelIdsField,
+            "tags": ModelIdsField,
+        }
         widgets = {
             "instructions": forms.Textarea(attrs={"rows": 6}),
-            "ingredients": forms.CheckboxSelectMultiple(),
-            "tags": forms.CheckboxSelectMultiple(),
+            "ingredients": AutocompleteSelectMultiple("ingredient_autocomplete", "ingredient_pairings"),
+            "tags": AutocompleteSelectMultiple("tag_autocomplete"),
         }
 
+class RecipeImageForm(ChunkedImageMixin, forms.ModelForm):
+    class Meta:
+        model = RecipeImage
+        fields = ("image",)
+
 RecipeImageFormSet = forms.modelformset_factory(
     RecipeImage,
+    form=RecipeImageForm,
     fields=("image",),
     extra=3,
 )
 
+class GalleryZipForm(forms.Form):
+    """ A zip archive of photos to add to a recipe's gallery; see `recipes.gallery_import`. """
+    archive = forms.FileField(
+        validators=[FileExtensionValidator(allowed_extensions=["zip"])],
+        help_text="JPEG and PNG photos; folders inside the archive are fine.",
+    )
+
+    def clean_archive(self):
+        archive = self.cleaned_data["archive"]
+        if archive.size > ZIP_MAX_SIZE:
+            raise forms.ValidationError(f"The archive is larger than {ZIP_MAX_SIZE // (1024 * 1024)} MB.")
+        return archive
+
 class SignUpForm(UserCreationForm):
     first_name = forms.CharField(max_length=30, required=False)
     last_name = forms.CharField(max_length=30, required=False)
@@ -0,0 +1,117 @@
+"""
+Adding a whole photo library to a recipe's gallery from one zip archive.
+
+Entries are read one at a time straight out of the archive; nothing is extracted to
+disk. Each image goes through the same checks and pipeline as a gallery upload on a
+pool of threads, with only a few entries in memory at once, and the rows are written
+together at the end.
+"""
+import posixpath
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from .cache import touch_recipes
+from .imaging import (
+    GALLERY_PROCESSING, GALLERY_PROCESSING_THREADS, image_metadata, render_missing_derivatives,
+    save_derivatives, store_gallery_upload,
+)
+from .models import ImageJob, RecipeImage
+
+# Limits against archives that would take too long to import or expand to far more than they weigh.
+ZIP_MAX_SIZE = getattr(settings, "RECIPE_GALLERY_ZIP_MAX_SIZE", 500 * 1024 * 1024)
+ZIP_MAX_FILES = getattr(settings, "RECIPE_GALLERY_ZIP_MAX_FILES", 500)
+ZIP_MAX_ENTRY_SIZE = getattr(settings, "RECIPE_GALLERY_ZIP_MAX_ENTRY_SIZE", 50 * 1024 * 1024)
+
+def _skipped(name):
+    """ Folders and the metadata files archivers add (`__MACOSX/`, `.DS_Store`, ...). """
+    return name.endswith("/") or name.startswith("__MACOSX/") or posixpath.basename(name).startswith(".")
+
+def _store_entry(archive, info):
+    """ Worker: validate the image in an archive entry like an upload and store it. Returns its name and `image_metadata()`. """
+    if info.file_size > ZIP_MAX_ENTRY_SIZE:
+        raise ValidationError(f"The file is larger than {ZIP_MAX_ENTRY_SIZE // (1024 * 1024)} MB.")
+    with archive.open(info) as entry:
+        # The size in the header may be wrong; never read more than the limit.
+        data = entry.read(ZIP_MAX_ENTRY_SIZE + 1)
+    if len(data) > ZIP_MAX_ENTRY_SIZE:
+        raise ValidationError(f"The file is larger than {ZIP_MAX_ENTRY_SIZE // (1024 * 1024)} MB.")
+    field = RecipeImage._meta.get_field("image")
+    upload = SimpleUploadedFile(posixpath.basename(info.filename), data)
+    for validator in field.validators:
+        validator(upload)
+    name = store_gallery_upload(upload)
+    return name, image_metadata(field.storage, name)
+
+def import_gallery_zip(recipe, file):
+    """
+    Add every image in the zip archive `file` to `recipe`'s gallery, stored already
+    optimised and shrunk to fit GALLERY_MAX_SIZE. Derivatives are built right away in
+    "inline" GALLERY_PROCESSING mode and left to the background worker otherwise.
+    Returns the new `RecipeImage`s and `(entry name, message)` for each refused entry.
+    Raises `ValidationError` if `file` isn't a usable archive.
+    """
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise ValidationError("The file is not a zip archive.", code="invalid_zip")
+    entries = [info for info in archive.infolist() if not _skipped(info.filename)]
+    if not entries:
+        raise ValidationError("The archive contains no files.", code="empty_zip")
+    if len(entries) > ZIP_MAX_FILES:
+        raise ValidationError(
+            "The archive contains %(count)s files; at most %(max)s can be imported at once.",
+            params={"count": len(entries), "max": ZIP_MAX_FILES}, code="too_many_files",
+        )
+
+    stored, failures = {}, []
+    with archive, ThreadPoolExecutor(max_workers=GALLERY_PROCESSING_THREADS) as pool:
+        pending = {}
+        tasks = iter(enumerate(entries))
+        while True:
+            # Only a few entries are read into memory at a time.
+            while len(pending) < GALLERY_PROCESSING_THREADS * 2 and (task := next(tasks, None)) is not None:
+                pending[pool.submit(_store_entry, archive, task[1])] = task
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, info = pending.pop(future)
+                try:
+                    stored[index] = future.result()
+                except ValidationError as error:
+                    failures.append((info.filename, " ".join(error.messages)))
+                except Exception as error:
+                    # Damaged or encrypted entries, images Pillow chokes on, ...
+                    failures.append((info.filename, str(error) or type(error).__name__))
+
+        derivatives = {}
+        if GALLERY_PROCESSING == "inline":
+            derivatives = render_missing_derivatives(pool, [name for name, _ in stored.values()])
+
+    status = "ready" if GALLERY_PROCESSING == "inline" else "pending"
+    images = [
+        RecipeImage(
+            recipe=recipe, image=name, status=status,
+            image_width=metadata[0], image_height=metadata[1], image_placeholder=metadata[2],
+        )
+        for _, (name, metadata) in sorted(stored.items())
+    ]
+    with transaction.atomic():
+        # `bulk_create` skips `RecipeImage.save()`, so the jobs are queued here.
+        images = RecipeImage.objects.bulk_create(images)
+        for source, rows in derivatives.items():
+            save_derivatives(source, rows)
+        if status == "pending":
+            content_type = ContentType.objects.get_for_model(RecipeImage)
+            ImageJob.objects.bulk_create(
+                ImageJob(content_type=content_type, object_id=image.pk, field_name="image") for image in images
+            )
+        transaction.on_commit(lambda: touch_recipes([recipe.pk]))
+    failures.sort()
+    return images, failures
@@ -0,0 +1,379 @@
+"""
+Processing of uploaded recipe images. This normally runs in the background
+worker (`manage.py process_image_jobs`); with RECIPE_GALLERY_PROCESSING set to
+"inline", gallery uploads are processed during the request instead, on a
+thread pool (see `process_gallery_uploads()`).
+"""
+import base64
+import copy
+import hashlib
+import io
+import json
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import ExifTags, Image, ImageChops, ImageOps, JpegImagePlugin, features
+
+from .cache import touch_recipes
+from .models import ImageDerivative, Recipe, RecipeImage, delete_media_if_unreferenced
+from .validators import check_pixels
+
+# Gallery images larger than this are shrunk to fit.
+GALLERY_MAX_SIZE = tuple(getattr(settings, "RECIPE_GALLERY_MAX_SIZE", (800, 800)))
+# "queue" (an `ImageJob` per gallery image) or "inline" (all of them concurrently, in the request).
+GALLERY_PROCESSING = getattr(settings, "RECIPE_GALLERY_PROCESSING", "queue")
+GALLERY_PROCESSING_THREADS = getattr(settings, "RECIPE_GALLERY_PROCESSING_THREADS", 4)
+DERIVATIVE_PREFIX = "derivatives"
+
+# Widths (in pixels) of the derivatives built for every uploaded image.
+DERIVATIVE_WIDTHS = getattr(settings, "RECIPE_IMAGE_WIDTHS", [200, 400, 800, 1600])
+# Modern formats served through `<source>`; AVIF only when this Pillow build can encode it.
+DERIVATIVE_FORMATS = [
+    fmt for fmt in getattr(settings, "RECIPE_IMAGE_FORMATS", ["avif", "webp"]) if features.check(fmt)
+]
+ENCODER_OPTIONS = {
+    "avif": {"quality": 55},
+    "webp": {"quality": 80, "method": 4},
+    "jpeg": {"quality": 82, "optimize": True, "progressive": True},
+    "png": {"optimize": True},
+}
+# Re-encoded copies must be at least this much smaller to replace a stored image, so repeated
+# runs don't keep re-encoding JPEGs for a few bytes.
+MIN_SAVING = 0.01
+# Longer side, in pixels, of the preview inlined into pages while the real image loads.
+PLACEHOLDER_SIZE = getattr(settings, "RECIPE_IMAGE_PLACEHOLDER_SIZE", 20)
+CONTENT_TYPES = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+EXTENSIONS = {"avif": "avif", "webp": "webp", "jpeg": "jpg", "png": "png"}
+
+def pipeline_fingerprint():
+    """ Short hash of the settings derivatives are built with; rows with another one are out of date. """
+    config = json.dumps([DERIVATIVE_WIDTHS, DERIVATIVE_FORMATS, ENCODER_OPTIONS], sort_keys=True)
+    return hashlib.sha256(config.encode()).hexdigest()[:16]
+
+PIPELINE_FINGERPRINT = pipeline_fingerprint()
+
+def process_image(instance, field_name):
+    """ Run the upload pipeline for the image stored in `instance.<field_name>`. """
+    field_file = getattr(instance, field_name)
+    if not field_file:
+        return
+    optimize_image(instance, field_name, GALLERY_MAX_SIZE if isinstance(instance, RecipeImage) else None)
+    # A duplicate upload of a stored file already has its derivatives.
+    if not ImageDerivative.objects.filter(source=field_file.name, fingerprint=PIPELINE_FINGERPRINT).exists():
+        generate_derivatives(field_file)
+    metadata = image_metadata(field_file.storage, field_file.name)
+    save_image_metadata(type(instance).objects.filter(pk=instance.pk), field_name, metadata)
+    # Cached pages were rendered with the original image; make them pick up the derivatives.
+    touch_recipes([instance.recipe_id if isinstance(instance, RecipeImage) else instance.pk])
+
+def optimize_image(instance, field_name, max_size=None):
+    """
+    Recompress the image in `instance.<field_name>`, shrinking it to fit `max_size` if given.
+    The result is stored as a new file (the original may be shared with other rows) and
+    the row is repointed.
+    """
+    field_file = getattr(instance, field_name)
+    name = optimize_file(field_file.storage, field_file.name, max_size)
+    if name is None:
+        return
+    old_file = copy.copy(field_file)
+    field_file.name = name
+    type(instance).objects.filter(pk=instance.pk).update(**{field_name: name})
+    delete_media_if_unreferenced(old_file)
+
+def optimize_file(storage, name, max_size=None):
+    """ Store `optimized_copy()` of the image `name` and return its name, or None if there's nothing to gain. """
+    with storage.open(name) as source:
+        content = optimized_copy(source, max_size)
+    if content is None:
+        return None
+    return storage.save(name, content)
+
+def fits_within(storage, name, max_size):
+    """ Whether the stored image `name` fits `max_size`, read from its header alone. """
+    with storage.open(name) as file:
+        width, height = Image.open(file).size
+    return width <= max_size[0] and height <= max_size[1]
+
+# JPEG segments that only carry metadata: APP1 (EXIF, XMP), APP13 (IPTC) and comments.
+# APP2 (the ICC profile) and APP14 (Adobe's colour transform) change how the pixels look.
+_JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+
+def strip_jpeg_metadata(data):
+    """
+    The JPEG `data` without its metadata segments. Everything else is copied byte for
+    byte, the compressed image included. Data that can't be parsed is returned as it is.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return data
+    kept, position = [data[:2]], 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker.
+            position += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan: only image data follows.
+            break
+        end = position + 2 + int.from_bytes(data[position + 2:position + 4], "big")
+        if end < position + 4 or end > len(data):
+            return data
+        if marker not in _JPEG_METADATA_MARKERS:
+            kept.append(data[position:end])
+        position = end
+    else:
+        return data
+    kept.append(data[position:])
+    return b"".join(kept)
+
+def optimized_copy(file, max_size=None):
+    """
+    Copy the image in `file` for storage, shrunk to fit `max_size` if given, with EXIF
+    orientation applied to the pixels and the metadata dropped (the ICC profile is kept).
+    Shrunk or rotated JPEGs are re-encoded progressive with optimised Huffman tables,
+    reusing their own quantisation tables. Decoding and encoding a JPEG again is never
+    quite lossless, so from one that fits as it is only the metadata segments are cut
+    out (see `strip_jpeg_metadata()`). PNGs become palette images when that loses no
+    colour. Returns a `ContentFile`, or None when there is no metadata to drop, nothing to
+    shrink and the copy wouldn't be at least MIN_SAVING smaller.
+    """
+    img = Image.open(file)
+    check_pixels(img.size)
+    img_format = img.format
+    shrink = max_size is not None and (img.width > max_size[0] or img.height > max_size[1])
+    rotate = img_format == "JPEG" and img.getexif().get(ExifTags.Base.Orientation, 1) != 1
+    if img_format == "JPEG" and not (shrink or rotate):
+        file.seek(0)
+        data = file.read()
+        stripped = strip_jpeg_metadata(data)
+        return None if stripped == data else ContentFile(stripped)
+    if img_format not in ("JPEG", "PNG") and not shrink:
+        return None
+
+    options = {"icc_profile": img.info.get("icc_profile")}
+    if img_format == "JPEG":
+        options.update(optimize=True, progressive=True, qtables=img.quantization)
+        subsampling = JpegImagePlugin.get_sampling(img)
+        if subsampling != -1:
+            options["subsampling"] = subsampling
+        if shrink:
+            # As `thumbnail()` would: decode at no less than twice the target size.
+            img.draft(None, (2 * max(max_size),) * 2)
+    elif img_format == "PNG":
+        options["optimize"] = True
+    img.load()
+    ImageOps.exif_transpose(img, in_place=True)
+    if shrink:
+        img.thumbnail(max_size)
+    if img_format == "PNG":
+        img = palettize(img)
+
+    buffer = io.BytesIO()
+    img.save(buffer, img_format, **options)
+    if img_format == "PNG" and not shrink and buffer.tell() > file.size * (1 - MIN_SAVING):
+        return None
+    return ContentFile(buffer.getvalue())
+
+def palettize(img):
+    """ `img` as a palette image if it has at most 256 colours, checked pixel for pixel; otherwise `img`. """
+    if img.mode not in ("RGB", "RGBA") or img.getcolors(256) is None:
+        return img
+    method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+    palette = img.quantize(colors=256, method=method)
+    if ImageChops.difference(palette.convert(img.mode), img).getbbox() is not None:
+        return img
+    return palette
+
+def replace_media(old_name, new_name):
+    """
+    Point every row using the stored file `old_name` at `new_name`, a re-encoded copy of it,
+    handing over its derivatives, then delete the old file once nothing uses it.
+    """
+    with transaction.atomic():
+        recipe_ids = set(Recipe.objects.filter(image=old_name).values_list("pk", flat=True))
+        recipe_ids.update(RecipeImage.objects.filter(image=old_name).values_list("recipe_id", flat=True))
+        Recipe.objects.filter(image=old_name).update(image=new_name)
+        RecipeImage.objects.filter(image=old_name).update(image=new_name)
+        # The copy looks the same, so the derivatives still fit it.
+        if not ImageDerivative.objects.filter(source=new_name).exists():
+            ImageDerivative.objects.filter(source=old_name).update(source=new_name)
+    delete_media_if_unreferenced(Recipe(image=old_name).image)
+    touch_recipes(recipe_ids)
+
+def decode_image(file, min_size=None):
+    """
+    Decode the image in `file` without holding more pixels than needed: the pixel count
+    is checked from the header before anything is decoded, and JPEGs are decoded
+    straight at 1/2, 1/4 or 1/8 scale (libjpeg's DCT scaling) when the result still
+    covers `min_size`. A 50-megapixel photo needed for 1600px derivatives is decoded
+    at 1/2 scale, a quarter of the memory.
+    """
+    img = Image.open(file)
+    check_pixels(img.size)
+    if min_size is not None and img.format == "JPEG":
+        img.draft(None, min_size)
+    img.load()
+    return img
+
+def image_metadata(storage, name):
+    """
+    `(width, height, placeholder)` of the stored image `name`: its size as displayed (after
+    EXIF rotation) and a preview at most PLACEHOLDER_SIZE pixels across, as a WebP data URI
+    of a few hundred bytes that pages inline until the real image arrives. Only the header
+    is needed for the size, and JPEGs are decoded at 1/8 scale for the preview.
+    """
+    with storage.open(name) as file:
+        img = Image.open(file)
+        check_pixels(img.size)
+        width, height = img.size
+        if img.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+            width, height = height, width
+        img.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+        preview = ImageOps.exif_transpose(img)
+    preview = preview.convert("RGBA" if has_alpha(preview) else "RGB")
+    buffer = io.BytesIO()
+    preview.save(buffer, "WEBP", quality=40)
+    return width, height, f"data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+def save_image_metadata(queryset, field_name, metadata):
+    """ Store `image_metadata()` on the rows of `queryset` in their `<field_name>_*` fields. """
+    width, height, placeholder = metadata
+    queryset.update(**{
+        f"{field_name}_width": width, f"{field_name}_height": height, f"{field_name}_placeholder": placeholder,
+    })
+
+def has_alpha(img):
+    return img.mode in ("RGBA", "LA") or "transparency" in img.info
+
+def derivative_name(source, width, fmt):
+    stem = posixpath.splitext(source)[0]
+    return posixpath.join(DERIVATIVE_PREFIX, f"{stem}-{width}w.{EXTENSIONS[fmt]}")
+
+def encode(img, fmt):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt.upper(), **ENCODER_OPTIONS[fmt])
+    return buffer.getvalue()
+
+def generate_derivatives(field_file):
+    """
+    Build a copy of the image at each of DERIVATIVE_WIDTHS (never upscaled) in every
+    modern format plus a fallback format, and record them as `ImageDerivative` rows.
+    """
+    derivatives = render_derivatives(field_file.storage, field_file.name)
+    save_derivatives(field_file.name, derivatives)
+    return derivatives
+
+def render_derivatives(source_storage, source):
+    """
+    The file half of `generate_derivatives()`: write the derivative files of the image
+    `source` and return their (unsaved) rows. Touches no database, so it can run in a
+    worker process (see `manage.py regenerate_images`).
+    """
+    # Derivatives are named after their source, not their content, so they use plain storage.
+    storage = default_storage
+    # A square box, so the largest derivative is covered whichever way EXIF rotates the image.
+    largest = max(DERIVATIVE_WIDTHS)
+    with source_storage.open(source) as original:
+        img = decode_image(original, (largest, largest))
+    ImageOps.exif_transpose(img, in_place=True)
+    # PNG keeps transparency for browsers without AVIF/WebP; everything else falls back to JPEG.
+    mode, fallback = ("RGBA", "png") if has_alpha(img) else ("RGB", "jpeg")
+    if img.mode != mode:
+        img = img.convert(mode)
+
+    formats = DERIVATIVE_FORMATS + [fallback]
+    widths = sorted({min(width, img.width) for width in DERIVATIVE_WIDTHS})
+
+    derivatives = []
+    for width in widths:
+        height = max(1, round(img.height * width / img.width))
+        resized = img if width == img.width else img.resize((width, height), Image.Resampling.LANCZOS)
+        for fmt in formats:
+            data = encode(resized, fmt)
+            name = derivative_name(source, width, fmt)
+            storage.delete(name)
+            name = storage.save(name, ContentFile(data))
+            derivatives.append(ImageDerivative(
+                source=source, width=width, height=height, format=fmt, file=name, size=len(data),
+                fingerprint=PIPELINE_FINGERPRINT,
+            ))
+    return derivatives
+
+def save_derivatives(source, derivatives):
+    """ Replace the `ImageDerivative` rows of `source`, deleting files no longer in use. """
+    stale = ImageDerivative.objects.filter(source=source)
+    for old in stale.exclude(file__in=[d.file.name for d in derivatives]):
+        old.file.delete(save=False)
+    stale.delete()
+    ImageDerivative.objects.bulk_create(derivatives)
+
+def store_gallery_upload(upload, max_size=GALLERY_MAX_SIZE):
+    """ Store a gallery upload already optimised and shrunk to fit `max_size`, as the worker would leave it. Returns its name. """
+    field = RecipeImage._meta.get_field("image")
+    content = optimized_copy(upload, max_size) or upload
+    upload.seek(0)
+    return field.storage.save(field.generate_filename(None, upload.name), content, max_length=field.max_length)
+
+def process_gallery_uploads(uploads):
+    """
+    The inline alternative to an `ImageJob` per gallery image: optimise and store every
+    upload, then build the derivatives of those without current ones, all on a thread
+    pool (Pillow releases the GIL while decoding, resizing and encoding). Writes no rows;
+    returns the stored names, in order, the `image_metadata()` of each of them and the
+    derivatives of each new source, for `save_gallery_images()`.
+    """
+    storage = RecipeImage._meta.get_field("image").storage
+    with ThreadPoolExecutor(max_workers=GALLERY_PROCESSING_THREADS) as pool:
+        names = list(pool.map(store_gallery_upload, uploads))
+        derivatives = render_missing_derivatives(pool, names)
+        distinct = list(dict.fromkeys(names))
+        metadata = dict(zip(distinct, pool.map(lambda name: image_metadata(storage, name), distinct)))
+    return names, metadata, derivatives
+
+def render_missing_derivatives(pool, names):
+    """
+    Render the derivatives of those gallery images `names` without current ones on the
+    executor `pool`. Returns `{source: unsaved rows}` for `save_derivatives()`.
+    """
+    storage = RecipeImage._meta.get_field("image").storage
+    # Identical uploads share a file, and a stored duplicate already has its derivatives.
+    current = set(
+        ImageDerivative.objects.filter(source__in=names, fingerprint=PIPELINE_FINGERPRINT)
+        .values_list("source", flat=True)
+    )
+    sources = [name for name in dict.fromkeys(names) if name not in current]
+    return dict(zip(sources, pool.map(lambda source: render_derivatives(storage, source), sources)))
+
+def save_gallery_images(recipe, names, metadata, derivatives):
+    """ Record the output of `process_gallery_uploads()`: one `bulk_create` for the images. """
+    RecipeImage.objects.bulk_create(
+        RecipeImage(
+            recipe=recipe, image=name, status="ready", image_width=metadata[name][0],
+            image_height=metadata[name][1], image_placeholder=metadata[name][2],
+        )
+        for name in names
+    )
+    for source, rows in derivatives.items():
+        save_derivatives(source, rows)
+
+def attach_derivatives(field_files):
+    """
+    Load the derivatives of several images with one query and attach them to each
+    file as `_derivatives`, where the `{% picture %}` tag looks for them.
+    """
+    field_files = [field_file for field_file in field_files if field_file]
+    by_source = {}
+    for derivative in ImageDerivative.objects.filter(source__in={f.name for f in field_files}):
+        by_source.setdefault(derivative.source, []).append(derivative)
+    for field_file in field_files:
+        field_file._derivatives = by_source.get(field_file.name, [])
+
+def get_derivatives(field_file):
+    if not hasattr(field_file, "_derivatives"):
+        attach_derivatives([field_file])
+    return field_file._derivatives
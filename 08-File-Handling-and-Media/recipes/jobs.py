@@ -0,0 +1,104 @@
+"""
+Worker side of the `ImageJob` queue.
+
+SQLite has no `SELECT ... FOR UPDATE SKIP LOCKED`, so a worker claims a job
+with a conditional UPDATE and only runs it if that UPDATE changed a row.
+Several workers can therefore poll the same table safely. A job whose worker
+died mid-run is picked up again once its lock is older than LOCK_TIMEOUT, which
+counts as an attempt: an image that crashes the worker itself (out of memory, a
+segfault in a decoder) fails for good after MAX_ATTEMPTS instead of taking a
+worker down every LOCK_TIMEOUT forever.
+"""
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .imaging import process_image
+from .models import ImageJob
+
+MAX_ATTEMPTS = getattr(settings, "RECIPE_IMAGE_JOB_MAX_ATTEMPTS", 5)
+# Seconds before the first retry; doubled after every failed attempt.
+RETRY_DELAY = getattr(settings, "RECIPE_IMAGE_JOB_RETRY_DELAY", 30)
+LOCK_TIMEOUT = getattr(settings, "RECIPE_IMAGE_JOB_LOCK_TIMEOUT", 10 * 60)
+
+logger = logging.getLogger(__name__)
+
+def _runnable(now):
+    stale = now - timedelta(seconds=LOCK_TIMEOUT)
+    return Q(status="pending", run_after__lte=now) | Q(status="running", locked_at__lt=stale, attempts__lt=MAX_ATTEMPTS)
+
+def _fail_abandoned(now):
+    """ Mark failed the jobs whose worker died on their last attempt. Returns how many. """
+    stale = now - timedelta(seconds=LOCK_TIMEOUT)
+    failed = 0
+    for job in ImageJob.objects.filter(status="running", locked_at__lt=stale, attempts__gte=MAX_ATTEMPTS):
+        # Conditional, like claiming, in case another worker got there first.
+        if ImageJob.objects.filter(pk=job.pk, status="running", locked_at=job.locked_at).update(
+            status="failed", locked_at=None, last_error="The worker stopped while running this job.",
+        ):
+            logger.error("Image job %s abandoned on attempt %s; giving up.", job.pk, job.attempts)
+            if job.target is not None:
+                _set_status(job.target, "failed")
+            failed += 1
+    return failed
+
+def claim_job():
+    """ Atomically take the next runnable job, or return None when there is none. """
+    now = timezone.now()
+    _fail_abandoned(now)
+    candidates = ImageJob.objects.filter(_runnable(now)).values_list("pk", flat=True)[:10]
+    for pk in candidates:
+        claimed = ImageJob.objects.filter(_runnable(now), pk=pk).update(
+            status="running", locked_at=now, attempts=F("attempts") + 1
+        )
+        if claimed:
+            return ImageJob.objects.get(pk=pk)
+    return None
+
+def _set_status(target, status):
+    if hasattr(target, "status"):
+        type(target).objects.filter(pk=target.pk).update(status=status)
+
+def run_job(job):
+    """ Run a claimed job. Returns True if it succeeded. """
+    target = job.target
+    if target is None:
+        # The object went away after the job was queued.
+        job.delete()
+        return True
+
+    try:
+        process_image(target, job.field_name)
+    except Exception:
+        logger.exception("Image job %s failed (attempt %s).", job.pk, job.attempts)
+        job.last_error = traceback.format_exc()
+        job.locked_at = None
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = "failed"
+            _set_status(target, "failed")
+        else:
+            job.status = "pending"
+            job.run_after = timezone.now() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        job.save(update_fields=["status", "run_after", "locked_at", "last_error"])
+        return False
+
+    _set_status(target, "ready")
+    job.delete()
+    return True
+
+def run_pending_jobs(limit=None):
+    """ Run jobs until the queue has nothing runnable (or `limit` jobs ran). Returns (succeeded, failed). """
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        job = claim_job()
+        if job is None:
+            break
+        if run_job(job):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe, SimilarityBucket
+from recipes.similarity import index_recipes
+
+class Command(BaseCommand):
+    help = (
+        "Build the MinHash/LSH buckets behind the \"Similar recipes\" section (see `recipes.similarity`) "
+        "for every recipe, in batches. Needed once for recipes created before the index existed, and "
+        "after changing the signature settings; edits keep it up to date afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000, help="Recipes indexed per transaction.")
+
+    def handle(self, *args, batch_size, **options):
+        started = time.monotonic()
+        indexed, last_pk = 0, 0
+        while pks := list(Recipe.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:batch_size]):
+            last_pk = pks[-1]
+            # Replaces the recipes' buckets, so the index stays usable while it is rebuilt.
+            index_recipes(pks)
+            indexed += len(pks)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} recipe(s) into {SimilarityBucket.objects.count()} bucket(s) in {elapsed:.1f}s."
+        ))
@@ -0,0 +1,153 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.models import ImageDerivative, Recipe, RecipeImage
+
+def referenced_sources(names):
+    """ The subset of `names` used as a recipe cover or gallery image. """
+    names = list(names)
+    live = set(Recipe.objects.filter(image__in=names).values_list("image", flat=True))
+    live.update(RecipeImage.objects.filter(image__in=names).values_list("image", flat=True))
+    return live
+
+class MediaWalker:
+    """
+    Walks a directory tree with `os.scandir()` on a pool of threads, one directory per task,
+    and hands out its files in chunks of `(relative name, mtime, size)`. The chunk queue is
+    bounded, so however many files there are, only a few chunks are held in memory at once.
+    """
+
+    def __init__(self, root, workers, chunk_size=1000, exclude=()):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.exclude = {os.path.abspath(path) for path in exclude}
+        self.errors = []
+        self._chunks = queue.Queue(maxsize=workers * 4)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def __iter__(self):
+        self._submit(self.root)
+        try:
+            while (chunk := self._chunks.get()) is not None:
+                yield chunk
+        finally:
+            # Unblock any thread still waiting to hand over a chunk if iteration stopped early.
+            self._stopped.set()
+            self._pool.shutdown(cancel_futures=True)
+
+    def _submit(self, directory):
+        if self._stopped.is_set():
+            return
+        with self._lock:
+            self._outstanding += 1
+        self._pool.submit(self._scan, directory)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _scan(self, directory):
+        try:
+            chunk = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if self._stopped.is_set():
+                        return
+                    if entry.is_dir(follow_symlinks=False):
+                        if os.path.abspath(entry.path) not in self.exclude:
+                            self._submit(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        name = os.path.relpath(entry.path, self.root).replace(os.sep, "/")
+                        chunk.append((name, stat.st_mtime, stat.st_size))
+                        if len(chunk) >= self.chunk_size:
+                            self._put(chunk)
+                            chunk = []
+            if chunk:
+                self._put(chunk)
+        except OSError as error:
+            self.errors.append(error)
+        finally:
+            with self._lock:
+                self._outstanding -= 1
+                finished = self._outstanding == 0
+            if finished:
+                self._put(None)
+
+class Command(BaseCommand):
+    help = (
+        "Delete (or move to --quarantine) files in MEDIA_ROOT that no recipe, gallery image or "
+        "derivative of one refers to, once they are older than --grace-hours."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace-hours", type=float, default=24.0, help="Leave files younger than this alone.")
+        parser.add_argument("--quarantine", help="Move garbage into this directory instead of deleting it.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed.")
+        parser.add_argument("--workers", type=int, default=8, help="Threads scanning directories.")
+
+    def handle(self, *args, grace_hours, quarantine, dry_run, workers, **options):
+        root = os.path.abspath(settings.MEDIA_ROOT)
+        if not os.path.isdir(root):
+            raise CommandError(f"MEDIA_ROOT ({root}) is not a directory.")
+        if quarantine:
+            quarantine = os.path.abspath(quarantine)
+            os.makedirs(quarantine, exist_ok=True)
+        cutoff = time.time() - grace_hours * 60 * 60
+
+        started = time.monotonic()
+        scanned = removed = removed_bytes = 0
+        walker = MediaWalker(root, workers, exclude=[quarantine] if quarantine else [])
+        for chunk in walker:
+            scanned += len(chunk)
+            # Young files may belong to an upload or job still in progress.
+            old = {name: size for name, mtime, size in chunk if mtime < cutoff}
+            if not old:
+                continue
+            for name in self._garbage(old, dry_run):
+                removed += 1
+                removed_bytes += old[name]
+                if dry_run:
+                    self.stdout.write(f"Would remove {name}")
+                elif quarantine:
+                    os.renames(os.path.join(root, name), os.path.join(quarantine, name))
+                else:
+                    try:
+                        os.remove(os.path.join(root, name))
+                    except FileNotFoundError:
+                        pass
+
+        for error in walker.errors:
+            self.stderr.write(f"Could not scan {error.filename}: {error.strerror}")
+        elapsed = time.monotonic() - started
+        verb = "Would remove" if dry_run else "Quarantined" if quarantine else "Removed"
+        self.stdout.write(self.style.SUCCESS(
+            f"Scanned {scanned} files in {elapsed:.1f}s ({scanned / max(elapsed, 1e-9):.0f} files/s). "
+            f"{verb} {removed} unreferenced file(s), {removed_bytes / 1e6:.1f} MB."
+        ))
+
+    def _garbage(self, candidates, dry_run):
+        """ The names among `candidates` that nothing refers to. """
+        live = referenced_sources(candidates)
+        # Derivatives are live while their source is.
+        derived = dict(ImageDerivative.objects.filter(file__in=list(candidates)).values_list("file", "source"))
+        live_sources = referenced_sources(set(derived.values()))
+        live.update(file for file, source in derived.items() if source in live_sources)
+
+        dead_derivatives = [file for file, source in derived.items() if source not in live_sources]
+        if dead_derivatives and not dry_run:
+            ImageDerivative.objects.filter(file__in=dead_derivatives).delete()
+        return [name for name in candidates if name not in live]
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.pairings import MIN_RECIPES, TOP_PAIRINGS, compute_pairings
+
+class Command(BaseCommand):
+    help = (
+        "Count how often each pair of ingredients appears in the same recipe, score the pairs by "
+        "normalised PMI and store each ingredient's best pairings for the recipe form's "
+        "\"Goes well with\" suggestions (see `recipes.pairings`). Run it periodically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=TOP_PAIRINGS, help="Pairings kept per ingredient.")
+        parser.add_argument(
+            "--min-recipes", type=int, default=MIN_RECIPES, help="Recipes a pair must appear in to be scored.",
+        )
+
+    def handle(self, *args, top, min_recipes, **options):
+        started = time.monotonic()
+        stored = compute_pairings(top=top, min_recipes=min_recipes)
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {stored} pairing(s) in {time.monotonic() - started:.1f}s."
+        ))
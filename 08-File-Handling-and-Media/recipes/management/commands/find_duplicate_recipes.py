@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.duplicates import (
+    find_near_duplicates, flag_near_duplicates, index_instructions, instruction_keys, shingles,
+)
+from recipes.models import NearDuplicate, Recipe
+
+class Command(BaseCommand):
+    help = (
+        "Index the instructions of every recipe and flag near-duplicates for moderation "
+        "(see `recipes.duplicates`), in batches. Saved recipes are checked as they are saved; "
+        "this is for recipes that weren't, e.g. imported ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000, help="Recipes checked per batch.")
+
+    def handle(self, *args, batch_size, **options):
+        started = time.monotonic()
+        flagged_before = NearDuplicate.objects.count()
+        checked, last_pk = 0, 0
+        while rows := list(Recipe.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", "instructions")[:batch_size]):
+            last_pk = rows[-1][0]
+            shingle_sets = {pk: shingles(instructions) for pk, instructions in rows}
+            keys = {pk: instruction_keys(shingle_set) for pk, shingle_set in shingle_sets.items()}
+            # Each batch is matched against itself and everything indexed before it, so every
+            # copy is found once it comes round.
+            index_instructions(keys)
+            flag_near_duplicates(find_near_duplicates(shingle_sets, keys))
+            checked += len(rows)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} recipe(s) in {elapsed:.1f}s; "
+            f"{NearDuplicate.objects.count() - flagged_before} new near-duplicate(s) flagged."
+        ))
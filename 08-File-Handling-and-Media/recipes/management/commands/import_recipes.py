@@ -0,0 +1,264 @@
+import csv
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes.autocomplete import invalidate as invalidate_autocomplete
+from recipes.facets import invalidate as invalidate_facets
+from recipes.models import DIFFICULTY_CHOICES, Chef, ImageJob, Ingredient, Recipe, Tag
+from recipes.similarity import index_recipes
+from recipes.validators import validate_image_upload
+
+# Characters read from the input at a time.
+READ_SIZE = 1024 * 1024
+# Difficulty may be given as its code ("E") or its label ("Easy").
+DIFFICULTIES = {
+    **{code.lower(): code for code, _ in DIFFICULTY_CHOICES},
+    **{label.lower(): code for code, label in DIFFICULTY_CHOICES},
+}
+TITLE_MAX_LENGTH = Recipe._meta.get_field("title").max_length
+# Spellings of `is_public` in CSV files.
+BOOLEANS = {
+    **dict.fromkeys(["1", "true", "t", "yes", "y", "on"], True),
+    **dict.fromkeys(["0", "false", "f", "no", "n", "off"], False),
+}
+# Separator of the names in a CSV `ingredients` or `tags` cell.
+LIST_SEPARATOR = ";"
+# Whitespace and commas between the objects of a JSON array.
+JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+def read_csv(file):
+    """ Rows of a CSV file with a header line, as dicts. """
+    yield from csv.DictReader(file)
+
+def read_json(file):
+    """
+    Objects of a JSON array, or of JSON Lines, decoded one at a time as the file is read,
+    so the file never has to fit in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof, array = "", 0, False, None
+    while True:
+        position = JSON_SEPARATORS.match(buffer, position).end()
+        if array is None and position < len(buffer):
+            array = buffer[position] == "["
+            position += array
+            continue
+        if array and buffer.startswith("]", position):
+            return
+        try:
+            obj, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as error:
+            if eof:
+                if position < len(buffer):
+                    raise CommandError(f"Invalid JSON: {error}")
+                return
+            chunk = file.read(READ_SIZE)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield obj
+
+def split_names(value, max_length):
+    """ Names, distinct ignoring case, from a JSON list or a `LIST_SEPARATOR`-separated CSV cell. """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(LIST_SEPARATOR)
+    names = {}
+    for name in value:
+        name = str(name).strip()
+        if name:
+            names.setdefault(name.casefold(), name)
+    names = list(names.values())
+    for name in names:
+        if len(name) > max_length:
+            raise ValidationError(f"“{name}” is longer than {max_length} characters.")
+    return names
+
+def store_image(path):
+    """ Validate the image at `path` like an upload and store it. Returns its stored name. """
+    field = Recipe._meta.get_field("image")
+    with open(path, "rb") as file:
+        upload = File(file, name=os.path.basename(path))
+        validate_image_upload(upload)
+        return field.storage.save(field.generate_filename(None, upload.name), upload, max_length=field.max_length)
+
+def insert_links(field, pairs):
+    """
+    Insert `(recipe id, other id)` rows into the through table of the M2M `field` with a
+    single `executemany()`. At several rows per recipe, building a model instance for
+    each row for `bulk_create()` would cost more than everything else in the import.
+    """
+    quote = connection.ops.quote_name
+    table = quote(field.remote_field.through._meta.db_table)
+    columns = f"{quote(field.m2m_column_name())}, {quote(field.m2m_reverse_name())}"
+    with connection.cursor() as cursor:
+        cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s)", pairs)
+
+class NameMap:
+    """
+    Case-insensitive name → id map of every `Ingredient` or `Tag`, loaded once, so rows
+    resolve their names without queries. Missing names are created in bulk.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = {name.casefold(): pk for pk, name in model.objects.values_list("pk", "name").iterator()}
+        self.created = 0
+
+    def resolve(self, names):
+        missing = {}
+        for name in names:
+            if name.casefold() not in self.ids:
+                missing.setdefault(name.casefold(), name)
+        if missing:
+            # Another process may add the same names meanwhile; their rows are used then.
+            self.model.objects.bulk_create([self.model(name=name) for name in missing.values()], ignore_conflicts=True)
+            for pk, name in self.model.objects.filter(name__in=list(missing.values())).values_list("pk", "name"):
+                self.ids[name.casefold()] = pk
+            self.created += len(missing)
+            # `bulk_create` sends no `post_save`.
+            invalidate_autocomplete(self.model)
+
+    def __getitem__(self, name):
+        return self.ids[name.casefold()]
+
+class Command(BaseCommand):
+    help = (
+        "Import recipes for one chef from a CSV or JSON file, streamed and written in bulk. Columns/keys: "
+        "title, instructions, cook_time_in_minutes, difficulty, is_public, ingredients, tags and image "
+        f"(a file name under --images). In CSV, ingredients and tags are separated by “{LIST_SEPARATOR}”."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV, JSON array or JSON Lines file.")
+        parser.add_argument("--chef", required=True, help="Username of the chef the recipes belong to.")
+        parser.add_argument("--format", choices=["csv", "json"], help="Input format (default: from the file extension).")
+        parser.add_argument("--images", help="Directory the `image` column's file names are relative to.")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Recipes written per transaction.")
+        parser.add_argument("--workers", type=int, default=8, help="Threads storing images.")
+
+    def handle(self, *args, path, chef, format, images, batch_size, workers, **options):
+        try:
+            self.chef = Chef.objects.get(user__username=chef)
+        except Chef.DoesNotExist:
+            raise CommandError(f"No chef with the username “{chef}”.")
+        format = format or ("csv" if path.lower().endswith(".csv") else "json")
+        self.images = images
+        self.ingredients, self.tags = NameMap(Ingredient), NameMap(Tag)
+        self.content_type = ContentType.objects.get_for_model(Recipe)
+        self.stats = {"imported": 0, "failed": 0, "images": 0}
+
+        started = time.monotonic()
+        with open(path, newline="", encoding="utf-8-sig") as file, ThreadPoolExecutor(max_workers=workers) as self.pool:
+            rows = read_csv(file) if format == "csv" else read_json(file)
+            batch = []
+            # Error messages number records from 1 (in CSV files, from the line after the header).
+            for number, row in enumerate(rows, start=1):
+                if (parsed := self._parse(number, row)) is not None:
+                    batch.append(parsed)
+                if len(batch) >= batch_size:
+                    self._write(batch)
+                    batch = []
+            self._write(batch)
+
+        elapsed = time.monotonic() - started
+        stats = self.stats
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['imported']} recipe(s) in {elapsed:.1f}s ({stats['imported'] / max(elapsed, 1e-9):.0f}/s) "
+            f"with {stats['images']} image(s); {stats['failed']} row(s) failed. Created "
+            f"{self.ingredients.created} ingredient(s) and {self.tags.created} tag(s)."
+        ))
+
+    def _error(self, number, message):
+        self.stats["failed"] += 1
+        self.stderr.write(f"Record {number}: {message}")
+
+    def _parse(self, number, row):
+        """ `(number, recipe, ingredient names, tag names, image future)` for a record, or None if it is invalid. """
+        if not isinstance(row, dict):
+            self._error(number, "not an object.")
+            return None
+        try:
+            # The checks of `Recipe.clean_fields()`, without its per-field overhead.
+            title = str(row.get("title") or "").strip()
+            if not title or len(title) > TITLE_MAX_LENGTH:
+                raise ValidationError(f"The title must have 1 to {TITLE_MAX_LENGTH} characters.")
+            instructions = str(row.get("instructions") or "")
+            if not instructions.strip():
+                raise ValidationError("The instructions are missing.")
+            cook_time = Recipe._meta.get_field("cook_time_in_minutes").to_python(row.get("cook_time_in_minutes") or 0)
+            if cook_time < 0:
+                raise ValidationError("The cook time can't be negative.")
+            difficulty = DIFFICULTIES.get(str(row.get("difficulty") or "M").strip().lower())
+            if difficulty is None:
+                raise ValidationError(f"Unknown difficulty “{row['difficulty']}”.")
+            is_public = row.get("is_public")
+            if is_public is None or is_public == "":
+                is_public = True
+            elif not isinstance(is_public, bool):
+                is_public = BOOLEANS.get(str(is_public).strip().lower())
+                if is_public is None:
+                    raise ValidationError(f"“{row['is_public']}” is not a yes/no value.")
+            recipe = Recipe(
+                chef=self.chef, title=title, instructions=instructions, cook_time_in_minutes=cook_time,
+                difficulty=difficulty, is_public=is_public,
+            )
+            ingredients = split_names(row.get("ingredients"), Ingredient._meta.get_field("name").max_length)
+            tags = split_names(row.get("tags"), Tag._meta.get_field("name").max_length)
+        except ValidationError as error:
+            self._error(number, " ".join(error.messages))
+            return None
+        image = None
+        if row.get("image"):
+            if not self.images:
+                self._error(number, "has an image but no --images directory was given.")
+                return None
+            # Stored in the background while the rest of the batch is read.
+            image = self.pool.submit(store_image, os.path.join(self.images, row["image"]))
+        return number, recipe, ingredients, tags, image
+
+    def _write(self, batch):
+        if not batch:
+            return
+        rows = []
+        for number, recipe, ingredients, tags, image in batch:
+            if image is not None:
+                try:
+                    recipe.image = image.result()
+                except (ValidationError, OSError) as error:
+                    self._error(number, f"image: {' '.join(getattr(error, 'messages', [str(error)]))}")
+                    continue
+            rows.append((recipe, ingredients, tags))
+        self.ingredients.resolve(name for _, ingredients, _ in rows for name in ingredients)
+        self.tags.resolve(name for _, _, tags in rows for name in tags)
+
+        with transaction.atomic():
+            # `bulk_create` skips `Recipe.save()`, so image jobs are queued below.
+            recipes = Recipe.objects.bulk_create([recipe for recipe, _, _ in rows])
+            insert_links(Recipe._meta.get_field("ingredients"), [
+                (recipe.pk, self.ingredients[name])
+                for recipe, (_, ingredients, _) in zip(recipes, rows) for name in ingredients
+            ])
+            insert_links(Recipe._meta.get_field("tags"), [
+                (recipe.pk, self.tags[name]) for recipe, (_, _, tags) in zip(recipes, rows) for name in tags
+            ])
+            ImageJob.objects.bulk_create([
+                ImageJob(content_type=self.content_type, object_id=recipe.pk, field_name="image")
+                for recipe in recipes if recipe.image
+            ])
+            # `insert_links()` sends no `m2m_changed`, so the similarity index is updated here.
+            index_recipes([recipe.pk for recipe in recipes])
+            # Nor a `post_save` to reset the recipe list's facet counts.
+            transaction.on_commit(invalidate_facets)
+        self.stats["imported"] += len(recipes)
+        self.stats["images"] += sum(1 for recipe in recipes if recipe.image)
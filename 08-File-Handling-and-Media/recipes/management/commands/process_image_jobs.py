@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from recipes.jobs import run_pending_jobs
+
+class Command(BaseCommand):
+    help = "Run queued recipe image jobs. Polls for new jobs until stopped, unless --once is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit as soon as the queue is empty.")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds to wait when the queue is empty.")
+
+    def handle(self, *args, once, poll_interval, **options):
+        while True:
+            close_old_connections()
+            succeeded, failed = run_pending_jobs()
+            if succeeded or failed:
+                self.stdout.write(f"Processed {succeeded} image job(s), {failed} failed.")
+            if once:
+                return
+            time.sleep(poll_interval)
@@ -0,0 +1,88 @@
+import os
+import posixpath
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from recipes.imaging import optimized_copy, replace_media
+from recipes.models import Recipe, RecipeImage
+from recipes.storage import recipe_image_storage
+
+from .regenerate_images import _init_worker
+
+def recompress(name, dry_run):
+    """ Worker: store `optimized_copy()` of the image `name` if it is smaller. Only touches files. """
+    storage = recipe_image_storage()
+    size = storage.size(name)
+    with storage.open(name) as source:
+        content = optimized_copy(source)
+    if content is None:
+        return {"name": name, "new_name": None, "before": size, "after": size}
+    new_name = None if dry_run else storage.save(name, content)
+    return {"name": name, "new_name": new_name, "before": size, "after": content.size}
+
+class Command(BaseCommand):
+    help = (
+        "Recompress every stored recipe and gallery image as the upload pipeline would without "
+        "resizing (see `recipes.imaging.optimized_copy`): metadata is dropped, PNGs are palettized "
+        "where no colour is lost and JPEG pixels are left as they are. Only smaller copies are kept; "
+        "reports the bytes saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes (default: one per CPU).")
+        parser.add_argument("--dry-run", action="store_true", help="Measure the savings without storing anything.")
+
+    def handle(self, *args, workers, dry_run, **options):
+        names = set(Recipe.objects.exclude(image="").exclude(image=None).values_list("image", flat=True).iterator())
+        names.update(RecipeImage.objects.values_list("image", flat=True).iterator())
+        self.stdout.write(f"Recompressing {len(names)} image(s) with {workers} worker(s)...")
+
+        # Per extension: [images, improved, bytes before, bytes after].
+        totals = defaultdict(lambda: [0, 0, 0, 0])
+        failed = 0
+        started = time.monotonic()
+        # Forked workers must not share the parent's database connections.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            pending = {}
+            tasks = iter(sorted(names))
+            while True:
+                # Keep a bounded number of tasks in flight rather than queueing them all.
+                while len(pending) < workers * 4 and (name := next(tasks, None)) is not None:
+                    pending[pool.submit(recompress, name, dry_run)] = name
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        failed += 1
+                        self.stderr.write(f"{name}: {error}")
+                        continue
+                    if result["new_name"]:
+                        replace_media(name, result["new_name"])
+                    total = totals[posixpath.splitext(name)[1].lower()]
+                    total[0] += 1
+                    total[1] += result["after"] < result["before"]
+                    total[2] += result["before"]
+                    total[3] += result["after"]
+
+        elapsed = time.monotonic() - started
+        for extension, (count, improved, before, after) in sorted(totals.items()):
+            self.stdout.write(
+                f"{extension or '(none)':<8} {count:>7} images, {improved:>7} smaller: "
+                f"{before / 1e6:10.1f} MB -> {after / 1e6:10.1f} MB"
+            )
+        count, improved, before, after = (sum(column) for column in zip(*totals.values())) if totals else (0, 0, 0, 0)
+        verb = "Would save" if dry_run else "Saved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {(before - after) / 1e6:.1f} MB of {before / 1e6:.1f} MB "
+            f"({(before - after) / max(before, 1):.1%}) across {count} images in {elapsed:.1f}s; "
+            f"{improved} recompressed, {failed} failed."
+        ))
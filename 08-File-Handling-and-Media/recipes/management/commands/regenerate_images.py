@@ -0,0 +1,192 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from recipes.cache import touch_recipes
+from recipes.imaging import (
+    GALLERY_MAX_SIZE, PIPELINE_FINGERPRINT, fits_within, image_metadata, optimize_file, render_derivatives,
+    save_derivatives, save_image_metadata,
+)
+from recipes.models import ImageDerivative, Recipe, RecipeImage, delete_media_if_unreferenced
+from recipes.storage import recipe_image_storage
+
+def _init_worker():
+    # With the "spawn" start method, workers begin without a configured Django.
+    if not apps.ready:
+        import django
+        django.setup()
+
+def regenerate(name, max_size, render_original, need_metadata):
+    """
+    Worker: optimise the image `name` and shrink it to fit `max_size` (gallery images only), then build
+    the derivatives and `image_metadata()` of the resulting file where needed. A gallery image that
+    fits and needs nothing else is only opened for its header. Only touches files; the parent process
+    records the results in the database.
+    """
+    storage = recipe_image_storage()
+    result = {"name": name, "shrunk": None, "derivatives": None, "metadata": None, "bytes": 0}
+    if max_size is not None and (render_original or need_metadata or not fits_within(storage, name, max_size)):
+        result["shrunk"] = optimize_file(storage, name, max_size)
+    if result["shrunk"] or render_original:
+        result["derivatives"] = render_derivatives(storage, result["shrunk"] or name)
+        result["bytes"] = storage.size(name)
+    if result["shrunk"] or need_metadata:
+        result["metadata"] = image_metadata(storage, result["shrunk"] or name)
+    return result
+
+class Checkpoint:
+    """
+    Append-only log of finished tasks, so an interrupted run picks up where it stopped.
+    It starts with the settings it was written under and is ignored once those change.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as log:
+                if log.readline().rstrip("\n") == version:
+                    self.done = {line.rstrip("\n") for line in log}
+        if not self.done:
+            with open(path, "w") as log:
+                log.write(version + "\n")
+        self._log = open(path, "a")
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, key):
+        self.done.add(key)
+        self._log.write(key + "\n")
+        self._log.flush()
+
+    def close(self):
+        self._log.close()
+
+    def finish(self):
+        self.close()
+        os.remove(self.path)
+
+class Command(BaseCommand):
+    help = (
+        "Re-run the image pipeline over every recipe and gallery image after its settings change: "
+        "shrink gallery images that no longer fit RECIPE_GALLERY_MAX_SIZE, rebuild out-of-date "
+        "derivatives and fill in missing placeholders, in parallel across processes. Interrupted runs resume from a checkpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes (default: one per CPU).")
+        parser.add_argument(
+            "--checkpoint", default=os.path.join(settings.BASE_DIR, "regenerate_images.checkpoint"),
+            help="File recording finished images, deleted after a complete run.",
+        )
+        parser.add_argument("--force", action="store_true", help="Rebuild every image, current or not.")
+        parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress reports.")
+
+    def handle(self, *args, workers, checkpoint, force, report_every, **options):
+        covers = set(Recipe.objects.exclude(image="").exclude(image=None).values_list("image", flat=True).iterator())
+        gallery = set(RecipeImage.objects.values_list("image", flat=True).iterator())
+        current = set() if force else set(
+            ImageDerivative.objects.filter(fingerprint=PIPELINE_FINGERPRINT).values_list("source", flat=True).iterator()
+        )
+        # Images stored before placeholders existed.
+        no_placeholder = covers & set(Recipe.objects.filter(image_placeholder="").values_list("image", flat=True).iterator())
+        no_placeholder |= set(RecipeImage.objects.filter(image_placeholder="").values_list("image", flat=True).iterator())
+
+        version = f"{PIPELINE_FINGERPRINT} {GALLERY_MAX_SIZE[0]}x{GALLERY_MAX_SIZE[1]}"
+        if force and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.checkpoint = Checkpoint(checkpoint, version)
+        # Covers only need derivatives; gallery images may also need shrinking, which can only
+        # be found out from their header. A gallery image that fits and is also a cover is left
+        # to the cover task.
+        tasks = [
+            (f"cover:{name}", (name, None, name not in current, name in no_placeholder))
+            for name in sorted((covers - current) | (covers & no_placeholder))
+        ]
+        tasks += [
+            (f"gallery:{name}", (
+                name, GALLERY_MAX_SIZE, name not in covers and name not in current,
+                name not in covers and name in no_placeholder,
+            ))
+            for name in sorted(gallery)
+        ]
+        tasks = [(key, task) for key, task in tasks if key not in self.checkpoint]
+        skipped = len(covers | gallery) - len({task[0] for _, task in tasks})
+        self.stdout.write(f"{len(tasks)} image(s) to check, {skipped} already current.")
+
+        self.total = len(tasks)
+        self.stats = {"done": 0, "failed": 0, "bytes": 0, "derivatives": 0, "shrunk": 0, "unchanged": 0}
+        self.started = self.last_report = time.monotonic()
+        # Forked workers must not share the parent's database connections.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            pending = {}
+            for key, task in tasks:
+                # Keep a bounded number of tasks in flight rather than queueing them all.
+                if len(pending) >= workers * 4:
+                    self._collect(pending, report_every)
+                pending[pool.submit(regenerate, *task)] = key
+            while pending:
+                self._collect(pending, report_every)
+
+        self._report(final=True)
+        if self.stats["failed"]:
+            self.checkpoint.close()
+            self.stdout.write(self.style.WARNING("Run the command again to retry the failed images."))
+        else:
+            self.checkpoint.finish()
+
+    def _collect(self, pending, report_every):
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            key = pending.pop(future)
+            try:
+                self._record(future.result())
+            except Exception as error:
+                self.stats["failed"] += 1
+                self.stderr.write(f"{key}: {error}")
+                continue
+            self.stats["done"] += 1
+            self.checkpoint.add(key)
+        if time.monotonic() - self.last_report >= report_every:
+            self._report()
+
+    def _record(self, result):
+        name, shrunk = result["name"], result["shrunk"]
+        if not shrunk and result["derivatives"] is None and result["metadata"] is None:
+            # Already current: leave the rows, and the cached pages keyed by `updated_at`, alone.
+            self.stats["unchanged"] += 1
+            return
+        if shrunk:
+            RecipeImage.objects.filter(image=name).update(image=shrunk)
+            delete_media_if_unreferenced(RecipeImage(image=name).image)
+            self.stats["shrunk"] += 1
+        if result["derivatives"] is not None:
+            save_derivatives(shrunk or name, result["derivatives"])
+            self.stats["derivatives"] += len(result["derivatives"])
+        if result["metadata"] is not None:
+            for model in (Recipe, RecipeImage):
+                save_image_metadata(model.objects.filter(image=shrunk or name), "image", result["metadata"])
+        self.stats["bytes"] += result["bytes"]
+        # Cached pages still point at the old files.
+        names = [name, shrunk] if shrunk else [name]
+        recipe_ids = set(Recipe.objects.filter(image__in=names).values_list("pk", flat=True))
+        recipe_ids.update(RecipeImage.objects.filter(image__in=names).values_list("recipe_id", flat=True))
+        touch_recipes(recipe_ids)
+
+    def _report(self, final=False):
+        self.last_report = time.monotonic()
+        elapsed = max(self.last_report - self.started, 1e-9)
+        stats = self.stats
+        line = (
+            f"{stats['done'] + stats['failed']}/{self.total} images ({stats['failed']} failed) in {elapsed:.1f}s: "
+            f"{stats['done'] / elapsed:.1f} images/s, {stats['bytes'] / elapsed / 1e6:.1f} MB/s read; "
+            f"{stats['shrunk']} shrunk, {stats['derivatives']} derivatives written, {stats['unchanged']} unchanged."
+        )
+        self.stdout.write(self.style.SUCCESS(line) if final else line)
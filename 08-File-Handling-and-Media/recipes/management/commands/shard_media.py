@@ -0,0 +1,125 @@
+import hashlib
+import os
+import posixpath
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.cache import touch_recipes
+from recipes.imaging import derivative_name
+from recipes.models import ImageDerivative, Recipe, RecipeImage
+from recipes.storage import shard_path
+
+from .collect_media_garbage import referenced_sources
+
+def sharded_name(name):
+    """
+    Where the flat file `name` moves to. The shard comes from a hash of the old name, so
+    every run (and every row sharing the file) agrees on it.
+    """
+    directory, filename = posixpath.split(name)
+    return shard_path(directory, filename, hashlib.sha256(name.encode()).hexdigest())
+
+def link(root, old, new):
+    """
+    Give the file `old` a second name `new`: a hard link, or a copy on filesystems without
+    them. `old` stays until no row refers to it. Returns False if `old` is missing.
+    """
+    source, target = os.path.join(root, old), os.path.join(root, new)
+    if os.path.exists(target):
+        # Linked by an interrupted run.
+        return True
+    if not os.path.exists(source):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        # Copy under a temporary name, so an interrupted copy is never taken for a finished one.
+        partial = f"{target}.partial"
+        shutil.copy2(source, partial)
+        os.replace(partial, target)
+    return True
+
+class Command(BaseCommand):
+    help = (
+        "Move recipe and gallery images stored flat under their field's `upload_to` directory "
+        "into the sharded layout of `recipes.storage.ShardedUploadTo`, rewriting the rows in "
+        "batches. Files are linked in parallel; interrupted runs can simply be started again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Rows rewritten per transaction.")
+        parser.add_argument("--workers", type=int, default=8, help="Threads moving files.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the files that would move.")
+
+    def handle(self, *args, batch_size, workers, dry_run, **options):
+        self.root = os.path.abspath(settings.MEDIA_ROOT)
+        if not os.path.isdir(self.root):
+            raise CommandError(f"MEDIA_ROOT ({self.root}) is not a directory.")
+        self.stats = {"rows": 0, "files": 0, "missing": 0}
+        # A cover may reuse a gallery image's file and the other way round.
+        prefixes = {model._meta.get_field("image").upload_to.prefix for model in (Recipe, RecipeImage)}
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as self.pool:
+            for model, fields in ((Recipe, ["pk", "image"]), (RecipeImage, ["pk", "image", "recipe_id"])):
+                # The database records the progress: rows already moved are no longer flat.
+                last_pk = 0
+                while rows := list(model.objects.filter(pk__gt=last_pk).order_by("pk").only(*fields)[:batch_size]):
+                    last_pk = rows[-1].pk
+                    flat = [row for row in rows if row.image and posixpath.dirname(row.image.name) in prefixes]
+                    if flat:
+                        self._move(model, flat, dry_run)
+
+        elapsed = time.monotonic() - started
+        verb = "Would move" if dry_run else "Moved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {self.stats['files']} file(s) for {self.stats['rows']} row(s) in {elapsed:.1f}s; "
+            f"{self.stats['missing']} missing file(s) left in place."
+        ))
+
+    def _move(self, model, rows, dry_run):
+        moves = {row.image.name: sharded_name(row.image.name) for row in rows}
+        derivatives = list(ImageDerivative.objects.filter(source__in=list(moves)))
+        if dry_run:
+            self.stats["rows"] += len(rows)
+            self.stats["files"] += len(moves) + len(derivatives)
+            return
+        # The derivatives' names follow their source, so they move along with it.
+        derivative_moves = {
+            derivative.file.name: derivative_name(moves[derivative.source], derivative.width, derivative.format)
+            for derivative in derivatives
+        }
+        pairs = list(moves.items()) + list(derivative_moves.items())
+        linked = dict(zip((old for old, _ in pairs), self.pool.map(lambda pair: link(self.root, *pair), pairs)))
+
+        rows = [row for row in rows if linked[row.image.name]]
+        self.stats["missing"] += sum(not ok for ok in linked.values())
+        for row in rows:
+            row.image.name = moves[row.image.name]
+        stale = {old for old in moves if linked[old]}
+        for derivative in derivatives:
+            if linked[derivative.source]:
+                derivative.source = moves[derivative.source]
+                if linked[derivative.file.name]:
+                    stale.add(derivative.file.name)
+                    derivative.file.name = derivative_moves[derivative.file.name]
+        with transaction.atomic():
+            model.objects.bulk_update(rows, ["image"])
+            ImageDerivative.objects.bulk_update(derivatives, ["source", "file"])
+        self.stats["rows"] += len(rows)
+        self.stats["files"] += sum(linked.values())
+
+        # Drop the old names now that nothing refers to them. A row of the other model may
+        # still share a file until its own batch comes round.
+        for old in stale - referenced_sources(stale):
+            try:
+                os.remove(os.path.join(self.root, old))
+            except FileNotFoundError:
+                pass
+        # Cached pages still point at the old files.
+        touch_recipes({row.pk if model is Recipe else row.recipe_id for row in rows})
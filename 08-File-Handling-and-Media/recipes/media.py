@@ -0,0 +1,163 @@
+"""
+Serving uploaded media, in development and in production.
+
+Every stored file belongs to one or more recipes, as their cover image, a
+gallery image, or a derivative of either, and is only served when one of
+those recipes is visible to the user: images of private recipes stay private.
+
+Responses carry an ETag and Last-Modified so browsers revalidate with a 304,
+honour single `Range` requests (resumed downloads, seeking), and mark
+content-addressed blobs as immutable. With RECIPE_MEDIA_SENDFILE set, Django
+only checks access and hands the file to the front-end server through
+`X-Sendfile` (Apache, lighttpd) or `X-Accel-Redirect` (nginx), so the Python
+worker never streams the bytes itself.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .imaging import DERIVATIVE_PREFIX
+from .models import ImageDerivative, Recipe, RecipeImage
+from .storage import is_immutable
+
+# None (Django streams the file), "x-sendfile" or "x-accel-redirect".
+SENDFILE = getattr(settings, "RECIPE_MEDIA_SENDFILE", None)
+# The nginx `internal` location that maps onto MEDIA_ROOT, for "x-accel-redirect".
+ACCEL_REDIRECT_PREFIX = getattr(settings, "RECIPE_MEDIA_ACCEL_REDIRECT_PREFIX", "/protected-media/")
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def media_access(name, user):
+    """
+    Return `(allowed, public)` for the stored file `name`: whether `user` may see it,
+    and whether everyone may (so shared caches can keep it too).
+    """
+    source = name
+    if name.startswith(DERIVATIVE_PREFIX + "/"):
+        source = ImageDerivative.objects.filter(file=name).values_list("source", flat=True).first()
+        if source is None:
+            return False, False
+    owners = list(Recipe.objects.filter(image=source).values_list("is_public", "chef__user_id"))
+    owners += RecipeImage.objects.filter(image=source).values_list("recipe__is_public", "recipe__chef__user_id")
+
+    public = any(is_public for is_public, _ in owners)
+    if public or (owners and user.is_authenticated and user.is_staff):
+        return True, public
+    allowed = user.is_authenticated and any(user_id == user.pk for _, user_id in owners)
+    return allowed, False
+
+def parse_range(header, size):
+    """
+    Return the `(first, last)` byte positions asked for by a `Range` header, or None to
+    send the whole file (no header, or one we don't support such as several ranges).
+    Raises ValueError when the range lies entirely outside the file.
+    """
+    match = RANGE_RE.match(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # A suffix range: the last N bytes.
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range.")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        if first >= size:
+            raise ValueError("Range starts after the end of the file.")
+        return None
+    return first, last
+
+def _read_range(file, first, length):
+    with file:
+        file.seek(first)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def file_response(request, full_path, size, etag, last_modified, content_type):
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    # A stale If-Range means the client's partial copy is outdated: send everything.
+    if if_range is None or if_range in (etag, http_date(last_modified)):
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if byte_range is None:
+        # FileResponse lets the WSGI server use `sendfile()` where it can.
+        return FileResponse(open(full_path, "rb"), content_type=content_type)
+    first, last = byte_range
+    response = StreamingHttpResponse(
+        _read_range(open(full_path, "rb"), first, last - first + 1), status=206, content_type=content_type,
+    )
+    response["Content-Length"] = last - first + 1
+    response["Content-Range"] = f"bytes {first}-{last}/{size}"
+    return response
+
+def sendfile_response(name, full_path, content_type):
+    # The front-end server takes care of ranges and the body; Django has already checked access.
+    response = HttpResponse(content_type=content_type)
+    if SENDFILE == "x-accel-redirect":
+        response["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX + quote(name)
+    else:
+        response["X-Sendfile"] = full_path
+    return response
+
+def serve_media(request, path):
+    """ Respond with the stored file `path` (relative to MEDIA_ROOT) if the user may see it. """
+    name = posixpath.normpath(path)
+    if name != path or name.startswith(("/", "../")):
+        raise Http404("Not found.")
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, name)
+        file_stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404("Not found.")
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404("Not found.")
+    # Files the user may not see are reported missing rather than forbidden.
+    allowed, public = media_access(name, request.user)
+    if not allowed:
+        raise Http404("Not found.")
+
+    etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+    last_modified = int(file_stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if SENDFILE:
+            response = sendfile_response(name, full_path, content_type)
+        else:
+            response = file_response(request, full_path, file_stat.st_size, etag, last_modified, content_type)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    scope = "public" if public else "private"
+    if is_immutable(name):
+        response["Cache-Control"] = f"{scope}, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        # Derivatives are rebuilt under the same name, so they are revalidated with the ETag.
+        response["Cache-Control"] = f"{scope}, no-cache"
+    return response
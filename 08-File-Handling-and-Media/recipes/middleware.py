@@ -0,0 +1,23 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cache import get_chef_for_user
+
+def get_chef(request):
+    if not hasattr(request, "_cached_chef"):
+        user = request.user
+        request._cached_chef = get_chef_for_user(user) if user.is_authenticated else None
+    return request._cached_chef
+
+class ChefMiddleware:
+    """
+    Set `request.chef` to the logged-in user's chef (None for anonymous users).
+    It's resolved lazily, at most once per request, and comes from the cache when it can.
+    Must come after `AuthenticationMiddleware`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.chef = SimpleLazyObject(lambda: get_chef(request))
+        return self.get_response(request)
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_recipe_view_count_trending'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['is_public', '-created_at', 'title'], name='recipe_public_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['chef', '-created_at', 'title'], name='recipe_chef_created_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_image_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('format', models.CharField(max_length=10)),
+                ('file', models.FileField(max_length=255, upload_to='')),
+                ('size', models.PositiveIntegerField(help_text='File size in bytes.')),
+            ],
+            options={
+                'ordering': ['source', 'format', 'width'],
+                'constraints': [models.UniqueConstraint(fields=('source', 'format', 'width'), name='unique_image_derivative')],
+            },
+        ),
+    ]
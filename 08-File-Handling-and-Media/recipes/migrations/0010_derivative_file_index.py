@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_chunked_uploads'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imagederivative',
+            name='file',
+            field=models.FileField(db_index=True, max_length=255, upload_to=''),
+        ),
+    ]
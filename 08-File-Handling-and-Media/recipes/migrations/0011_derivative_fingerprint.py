@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_derivative_file_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagederivative',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+    ]
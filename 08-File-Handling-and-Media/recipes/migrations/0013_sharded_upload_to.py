@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:44
+
+import django.core.validators
+import recipes.storage
+import recipes.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_image_upload_validation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, null=True, storage=recipes.storage.recipe_image_storage, upload_to=recipes.storage.ShardedUploadTo('recipes'), validators=[recipes.validators.validate_image_upload]),
+        ),
+        migrations.AlterField(
+            model_name='recipeimage',
+            name='image',
+            field=models.ImageField(db_index=True, storage=recipes.storage.recipe_image_storage, upload_to=recipes.storage.ShardedUploadTo('recipes/gallery'), validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png']), recipes.validators.validate_image_upload]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_image_placeholders'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarityBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField()),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarity_buckets', to='recipes.recipe')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', 'recipe'], name='similarity_bucket_key_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_similarity_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstructionBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField()),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='instruction_buckets', to='recipes.recipe')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', 'recipe'], name='instruction_bucket_key_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='NearDuplicate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('similarity', models.FloatField(help_text="Share of the instructions' word sequences the two recipes have in common.")),
+                ('status', models.CharField(choices=[('pending', 'Pending review'), ('duplicate', 'Duplicate'), ('distinct', 'Not a duplicate')], default='pending', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('original', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recipes.recipe')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='near_duplicates', to='recipes.recipe')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', '-created_at'], name='near_duplicate_status_idx')],
+                'constraints': [models.UniqueConstraint(fields=('recipe', 'original'), name='unique_near_duplicate')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0016_near_duplicates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngredientPairing',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(help_text='Normalised pointwise mutual information, from -1 to 1.')),
+                ('recipe_count', models.PositiveIntegerField(help_text='Recipes using both ingredients.')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pairings', to='recipes.ingredient')),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recipes.ingredient')),
+            ],
+            options={
+                'ordering': ['ingredient', '-score'],
+                'indexes': [models.Index(fields=['ingredient', '-score', 'other'], name='ingredient_pairing_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ingredient', 'other'), name='unique_ingredient_pairing')],
+            },
+        ),
+    ]
@@ -1,12 +1,24 @@
-from django.db import models
+import os
+import tempfile
+import uuid
+
+from django.db import models, transaction
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.validators import FileExtensionValidator
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
 
-from PIL import Image
-import os
+from .autocomplete import invalidate as invalidate_autocomplete
+from .cache import forget_chef, forget_recipe, touch_recipes
+from .duplicates import check_recipe
+from .facets import invalidate as invalidate_facets
+from .similarity import index_recipes
+from .storage import ShardedUploadTo, recipe_image_storage
+from .validators import validate_image_upload
 
 DIFFICULTY_CHOICES = [
     ("E", "Easy"),
@@ -14,6 +26,34 @@ DIFFICULTY_CHOICES = [
     ("H", "Hard")
 ]
 
+IMAGE_STATUS_CHOICES = [
+    ("pending", "Pending"),
+    ("ready", "Ready"),
+    ("failed", "Failed"),
+]
+
+JOB_STATUS_CHOICES = [
+    ("pending", "Pending"),
+    ("running", "Running"),
+    ("failed", "Failed"),
+]
+
+DUPLICATE_STATUS_CHOICES = [
+    ("pending", "Pending review"),
+    ("duplicate", "Duplicate"),
+    ("distinct", "Not a duplicate"),
+]
+
+UPLOAD_STATUS_CHOICES = [
+    ("uploading", "Uploading"),
+    ("complete", "Complete"),
+]
+
+CHUNKED_UPLOAD_DIR = getattr(
+    settings, "RECIPE_CHUNKED_UPLOAD_DIR",
+    os.path.join(settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(), "recipe-uploads"),
+)
+
 class Chef(models.Model):
     """ 
     Model representing a recipe's author/chef.
@@ -54,6 +94,99 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+class IngredientPairing(models.Model):
+    """
+    An ingredient that goes well with another, from how often recipes use them together.
+    Rebuilt as a whole by `manage.py compute_ingredient_pairings`.
+    """
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name="pairings")
+    other = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField(help_text="Normalised pointwise mutual information, from -1 to 1.")
+    recipe_count = models.PositiveIntegerField(help_text="Recipes using both ingredients.")
+
+    class Meta:
+        ordering = ["ingredient", "-score"]
+        constraints = [
+            models.UniqueConstraint(fields=["ingredient", "other"], name="unique_ingredient_pairing"),
+        ]
+        indexes = [
+            # Serves an ingredient's best pairings in order, without reading the table.
+            models.Index(fields=["ingredient", "-score", "other"], name="ingredient_pairing_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.ingredient_id} + {self.other_id} ({self.score:.2f})"
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Tag)
+def reload_name_suggestions(sender, **kwargs):
+    """ Name suggestions are served from memory (`recipes.autocomplete`); have every process reload them. """
+    transaction.on_commit(lambda: invalidate_autocomplete(sender))
+
+# Fields of `Recipe` the recipe list filters and counts by (see `recipes.facets`).
+FACET_FIELDS = ("title", "chef_id", "difficulty", "cook_time_in_minutes", "is_public")
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender="recipes.Recipe")
+@receiver(post_delete, sender="recipes.Recipe")
+def reload_facet_counts(sender, instance, signal, created=False, **kwargs):
+    """
+    Cached facet counts of the recipe list (`recipes.facets`) may no longer add up.
+    Recounting is slow, so changes that can't move a recipe between facets are let
+    through: a new tag or ingredient has no recipes yet, and a recipe saved without
+    changing its FACET_FIELDS (a new image, edited instructions) stays where it was.
+    """
+    if signal is post_save:
+        if sender is not Recipe and created:
+            return
+        if sender is Recipe and not created and not getattr(instance, "_facets_changed", True):
+            return
+    transaction.on_commit(invalidate_facets)
+
+class RecipeQuerySet(models.QuerySet):
+    # Disjoint querysets whose counts add up to this one's, set by `visible_to()`.
+    _count_parts = None
+
+    def visible_to(self, user):
+        """
+        Restrict recipes to those `user` may see: everything for staff, public recipes
+        for everyone else, plus their own private recipes when logged in.
+
+        Rather than `Q(is_public=True) | Q(chef=...)`, which makes the database scan and
+        sort every visible row, the two disjoint cases are combined with UNION ALL.
+        Each branch walks its own (is_public|chef, created_at) index in order, so a page
+        of results is merged straight from both indexes. Apply other filters first:
+        a combined queryset only supports ordering, slicing and counting afterwards.
+        """
+        if user.is_authenticated and user.is_staff:
+            return self
+        # `__in` rather than `=True`: Django emits a bare boolean column for the latter,
+        # which SQLite won't match against an index.
+        public = self.filter(is_public__in=[True])
+        if not user.is_authenticated:
+            return public
+        own_private = self.filter(is_public__in=[False], chef__user=user)
+        ordering = self.query.order_by or self.model._meta.ordering
+        combined = public.order_by().union(own_private.order_by(), all=True).order_by(*ordering)
+        combined._count_parts = (public, own_private)
+        return combined
+
+    def count(self):
+        # Counting each branch on its own index beats counting the wrapped UNION.
+        if self._count_parts and self._result_cache is None and not self.query.is_sliced:
+            return sum(part.count() for part in self._count_parts)
+        return super().count()
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._count_parts = self._count_parts
+        return clone
+
 class Recipe(models.Model):
     """ Model representing a recipe, relating to its chef/author, composed ingredients, and related tags. """
     title = models.CharField(max_length=200)
@@ -66,38 +199,314 @@ class Recipe(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_public = models.BooleanField(default=True)
-    image = models.ImageField(upload_to="recipes/", blank=True, null=True)  # Requires `pillow`
+    image = models.ImageField(
+        upload_to=ShardedUploadTo("recipes"), storage=recipe_image_storage, validators=[validate_image_upload],
+        blank=True, null=True, db_index=True,
+    )  # Requires `pillow`
+    # Filled in by the image pipeline (`recipes.imaging.image_metadata()`), for layout and a blurred preview.
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_placeholder = models.TextField(blank=True, editable=False)
+    # Written in batches by `recipes.counters`, never through `save()`.
+    view_count = models.PositiveIntegerField(default=0, editable=False)
+    trending_score = models.FloatField(default=0, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ["-created_at", "title"]
+        indexes = [
+            # Serve `Recipe.objects.visible_to()` pages straight from the index, in `ordering` order.
+            models.Index(fields=["is_public", "-created_at", "title"], name="recipe_public_created_idx"),
+            models.Index(fields=["chef", "-created_at", "title"], name="recipe_chef_created_idx"),
+            models.Index(fields=["is_public", "-trending_score"], name="recipe_trending_idx"),
+        ]
     
     def __str__(self):
         return self.title
     
     def get_absolute_url(self):
         return reverse("recipe_detail", args=[str(self.id)])
+
+    def save(self, *args, **kwargs):
+        # A new cover image gets its derivatives built by the background worker.
+        new_image = bool(self.image) and not self.image._committed
+        if new_image or not self.image:
+            self.image_width = self.image_height = None
+            self.image_placeholder = ""
+        update_fields = kwargs.get("update_fields")
+        old = Recipe.objects.filter(pk=self.pk).values("image", *FACET_FIELDS).first() if self.pk is not None else None
+        old_image = old["image"] if old and (update_fields is None or "image" in update_fields) else None
+        # Read by `reload_facet_counts`, which leaves the cached counts alone otherwise.
+        self._facets_changed = old is None or any(old[name] != getattr(self, name) for name in FACET_FIELDS)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if new_image:
+                ImageJob.enqueue(self, "image")
+            # A replaced or cleared cover goes once nothing else uses it.
+            if old_image and old_image != self.image.name:
+                old_file = Recipe(image=old_image).image
+                transaction.on_commit(lambda: delete_media_if_unreferenced(old_file))
+
+    def is_visible_to(self, user):
+        """ Public recipes are visible to everyone; private ones only to their chef and staff. """
+        if self.is_public:
+            return True
+        if not user.is_authenticated:
+            return False
+        return user.is_staff or (self.chef is not None and self.chef.user_id == user.pk)
+
+@receiver(post_save, sender=Chef)
+def touch_recipes_on_chef_change(sender, instance, created, **kwargs):
+    forget_chef(instance)
+    # Cached renders show the chef's name, which the recipe list can be filtered by.
+    if not created:
+        instance.recipes.update(updated_at=timezone.now())
+        transaction.on_commit(invalidate_facets)
+
+@receiver(post_delete, sender=Chef)
+def forget_deleted_chef(sender, instance, **kwargs):
+    forget_chef(instance)
+    transaction.on_commit(invalidate_facets)
+
+@receiver(post_delete, sender=Recipe)
+def forget_deleted_recipe(sender, instance, **kwargs):
+    forget_recipe(instance)
+    if instance.image:
+        transaction.on_commit(lambda: delete_media_if_unreferenced(instance.image))
+
+@receiver(post_save, sender=Recipe)
+def check_instructions_on_save(sender, instance, raw, update_fields, **kwargs):
+    """ Flag new and edited recipes whose instructions nearly duplicate another's. """
+    if raw or (update_fields is not None and "instructions" not in update_fields):
+        return
+    check_recipe(instance)
+
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def touch_recipe_on_m2m_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    M2M edits don't go through `Recipe.save()`, so bump `updated_at` by hand
+    to invalidate cached renders of every affected recipe, and rebuild their
+    similarity buckets and the facet counts once the change is committed.
+    """
+    if reverse and action == "pre_clear":
+        # Remember which recipes lose this ingredient/tag before the rows are gone.
+        instance._cleared_recipe_pks = list(instance.recipes.values_list("pk", flat=True))
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        pks = [instance.pk]
+        touched_at = touch_recipes(pks)
+        if touched_at:
+            instance.updated_at = touched_at
+    elif action == "post_clear":
+        pks = instance.__dict__.pop("_cleared_recipe_pks", [])
+        touch_recipes(pks)
+    else:
+        pks = list(pk_set or [])
+        touch_recipes(pks)
+    transaction.on_commit(lambda: index_recipes(pks))
+    transaction.on_commit(invalidate_facets)
     
+class SimilarityBucket(models.Model):
+    """
+    One band of a recipe's MinHash signature, hashed (see `recipes.similarity`).
+    Recipes sharing a `key` are candidates for each other's "Similar recipes".
+    """
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="similarity_buckets")
+    key = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            # Lookups by key read the recipe ids straight from the index.
+            models.Index(fields=["key", "recipe"], name="similarity_bucket_key_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.recipe_id}: {self.key}"
+
+class InstructionBucket(models.Model):
+    """
+    One band of the MinHash signature of a recipe's instructions, hashed (see
+    `recipes.duplicates`). Recipes sharing a `key` may be near-duplicates.
+    """
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="instruction_buckets")
+    key = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            # Lookups by key read the recipe ids straight from the index.
+            models.Index(fields=["key", "recipe"], name="instruction_bucket_key_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.recipe_id}: {self.key}"
+
+class NearDuplicate(models.Model):
+    """ A recipe whose instructions nearly match an earlier one's, awaiting moderation. """
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="near_duplicates")
+    original = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="+")
+    similarity = models.FloatField(help_text="Share of the instructions' word sequences the two recipes have in common.")
+    status = models.CharField(max_length=10, choices=DUPLICATE_STATUS_CHOICES, default="pending")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        constraints = [
+            models.UniqueConstraint(fields=["recipe", "original"], name="unique_near_duplicate"),
+        ]
+        indexes = [
+            models.Index(fields=["status", "-created_at"], name="near_duplicate_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.recipe} ≈ {self.original}"
+
 class RecipeImage(models.Model):
     recipe = models.ForeignKey("Recipe", on_delete=models.CASCADE, related_name="images")
     image = models.ImageField(
-        upload_to="recipes/gallery",
-        validators=[FileExtensionValidator(allowed_extensions=["jpg", "jpeg", "png"])]
+        upload_to=ShardedUploadTo("recipes/gallery"),
+        storage=recipe_image_storage,
+        validators=[FileExtensionValidator(allowed_extensions=["jpg", "jpeg", "png"]), validate_image_upload],
+        db_index=True,
     )
+    # Filled in by the image pipeline, like `Recipe.image_width` and friends.
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_placeholder = models.TextField(blank=True, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Resizing happens in the background worker; see `ImageJob`.
+    status = models.CharField(max_length=10, choices=IMAGE_STATUS_CHOICES, default="pending", editable=False)
 
     def __str__(self):
         return f"Image for {self.recipe.title}"
     
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        img_path = self.image.path
-        img = Image.open(img_path)
-        max_size = (800, 800)
-        img.thumbnail(max_size)
-        img.save(img_path)
+        # Only store the original here and leave the processing to the worker,
+        # so the upload request doesn't wait on Pillow.
+        new_upload = bool(self.image) and not self.image._committed
+        if new_upload:
+            self.status = "pending"
+            self.image_width = self.image_height = None
+            self.image_placeholder = ""
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if new_upload:
+                ImageJob.enqueue(self, "image")
+
+class ImageJob(models.Model):
+    """
+    Durable queue entry asking the background worker (`manage.py process_image_jobs`)
+    to process the image stored in `field_name` of the target object.
+    Finished jobs are deleted; failing ones are retried with backoff until they give up.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+    target = GenericForeignKey("content_type", "object_id")
+    field_name = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["run_after", "pk"]
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="imagejob_queue_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.content_type.model} #{self.object_id} {self.field_name} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, instance, field_name):
+        return cls.objects.create(
+            content_type=ContentType.objects.get_for_model(instance),
+            object_id=instance.pk,
+            field_name=field_name,
+        )
+
+class ImageDerivative(models.Model):
+    """
+    A resized, re-encoded copy of an uploaded image, used to build `srcset`s.
+    Derivatives belong to the stored file (`source`) rather than to a model row.
+    """
+    source = models.CharField(max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(max_length=10)
+    file = models.FileField(max_length=255, db_index=True)
+    size = models.PositiveIntegerField(help_text="File size in bytes.")
+    # `recipes.imaging.PIPELINE_FINGERPRINT` when built; a different value means the settings changed.
+    fingerprint = models.CharField(max_length=16, blank=True)
+
+    class Meta:
+        ordering = ["source", "format", "width"]
+        constraints = [
+            models.UniqueConstraint(fields=["source", "format", "width"], name="unique_image_derivative"),
+        ]
+
+    def __str__(self):
+        return f"{self.source} @ {self.width}w ({self.format})"
+
+def media_references(name):
+    """ Number of rows whose image fields point at the stored file `name`. """
+    return Recipe.objects.filter(image=name).count() + RecipeImage.objects.filter(image=name).count()
+
+def delete_media_if_unreferenced(field_file):
+    """
+    Delete a stored image and its derivatives once no row refers to it any more.
+    With content-addressed storage the same file can back several recipes and gallery images.
+    """
+    name = field_file.name
+    if not name or media_references(name):
+        return False
+    field_file.storage.delete(name)
+    derivatives = ImageDerivative.objects.filter(source=name)
+    for derivative in derivatives:
+        derivative.file.delete(save=False)
+    derivatives.delete()
+    return True
 
 @receiver(post_delete, sender=RecipeImage)
 def delete_image_file(sender, instance, **kwargs):
     if instance.image:
-        if os.path.isfile(instance.image.path):
-            os.remove(instance.image.path)
\ No newline at end of file
+        # Count references only once the row is really gone.
+        transaction.on_commit(lambda: delete_media_if_unreferenced(instance.image))
+    # The cached detail page shows the gallery, and the file may be gone with the row.
+    transaction.on_commit(lambda: touch_recipes([instance.recipe_id]))
+
+class ChunkedUpload(models.Model):
+    """
+    A large image sent in pieces through the upload endpoints (see `recipes.uploads`).
+    Chunks are appended to a temp file outside MEDIA_ROOT; `offset` is how many bytes
+    have arrived, so an interrupted upload resumes from there. Once complete, forms
+    can refer to it by id instead of carrying the file in their own request.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="chunked_uploads")
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField(help_text="Total size in bytes.")
+    sha256 = models.CharField(max_length=64, help_text="Expected hex digest of the whole file.")
+    offset = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=UPLOAD_STATUS_CHOICES, default="uploading")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size} bytes, {self.status})"
+
+    @property
+    def path(self):
+        return os.path.join(CHUNKED_UPLOAD_DIR, f"{self.pk}.part")
+
+@receiver(post_delete, sender=ChunkedUpload)
+def delete_chunked_upload_file(sender, instance, **kwargs):
+    def remove():
+        if os.path.exists(instance.path):
+            os.remove(instance.path)
+    transaction.on_commit(remove)
@@ -0,0 +1,99 @@
+"""
+"Goes well with" suggestions: ingredients that recipes use together more often than
+chance would have it.
+
+The co-occurrence counts of every pair of ingredients come from one self-join of the
+`Recipe.ingredients` through table, aggregated by the database, which never has to
+hold the whole sparse matrix in Python. Each pair seen in at least MIN_RECIPES recipes
+is scored by its normalised pointwise mutual information,
+
+    npmi(a, b) = log(p(a, b) / (p(a) p(b))) / -log(p(a, b))
+
+which is 1 for ingredients only ever used together, 0 for independent ones and
+negative for ingredients that avoid each other. Unlike raw counts it doesn't favour
+salt and onions with everything, and unlike plain PMI it doesn't favour rare pairs.
+The TOP_PAIRINGS best pairings per ingredient are stored as `IngredientPairing` rows.
+"""
+import heapq
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+
+# Pairs used together in fewer recipes than this are too rare to judge.
+MIN_RECIPES = getattr(settings, "RECIPE_PAIRING_MIN_RECIPES", 5)
+TOP_PAIRINGS = getattr(settings, "RECIPE_PAIRING_TOP", 20)
+SUGGESTIONS = getattr(settings, "RECIPE_PAIRING_SUGGESTIONS", 8)
+
+def pair_counts(min_recipes=MIN_RECIPES):
+    """ `(ingredient id, other id, recipes using both)` for every pair with `ingredient id < other id`. """
+    from .models import Recipe
+
+    field = Recipe._meta.get_field("ingredients")
+    quote = connection.ops.quote_name
+    table = quote(field.remote_field.through._meta.db_table)
+    recipe, ingredient = quote(field.m2m_column_name()), quote(field.m2m_reverse_name())
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT a.{ingredient}, b.{ingredient}, COUNT(*) FROM {table} a "
+            f"INNER JOIN {table} b ON b.{recipe} = a.{recipe} AND b.{ingredient} > a.{ingredient} "
+            f"GROUP BY a.{ingredient}, b.{ingredient} HAVING COUNT(*) >= %s",
+            [min_recipes],
+        )
+        while rows := cursor.fetchmany(10_000):
+            yield from rows
+
+def compute_pairings(top=TOP_PAIRINGS, min_recipes=MIN_RECIPES):
+    """ Rebuild every `IngredientPairing`. Returns the number of rows stored. """
+    from .models import IngredientPairing, Recipe
+
+    through = Recipe._meta.get_field("ingredients").remote_field.through
+    totals = dict(through.objects.values_list("ingredient_id").annotate(count=Count("*")).order_by())
+    recipes = through.objects.values("recipe_id").distinct().count()
+    if not recipes:
+        return 0
+
+    # Per ingredient, a min-heap of its `top` best `(score, other id, count)` so far.
+    best = defaultdict(list)
+    log_recipes = math.log(recipes)
+    for a, b, count in pair_counts(min_recipes):
+        log_joint = math.log(count) - log_recipes
+        pmi = log_joint - (math.log(totals[a]) - log_recipes) - (math.log(totals[b]) - log_recipes)
+        # A pair in every recipe has log_joint == 0 and no information at all.
+        score = pmi / -log_joint if log_joint < 0 else 0.0
+        if score <= 0:
+            continue
+        for ingredient, other in ((a, b), (b, a)):
+            heap = best[ingredient]
+            if len(heap) < top:
+                heapq.heappush(heap, (score, other, count))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, other, count))
+
+    rows = [(ingredient, other, score, count) for ingredient, heap in best.items() for score, other, count in heap]
+    quote = connection.ops.quote_name
+    table = quote(IngredientPairing._meta.db_table)
+    columns = ", ".join(
+        quote(IngredientPairing._meta.get_field(name).column) for name in ("ingredient", "other", "score", "recipe_count")
+    )
+    # Millions of rows: a model instance each for `bulk_create()` would double the run time.
+    with transaction.atomic(), connection.cursor() as cursor:
+        IngredientPairing.objects.all().delete()
+        cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s, %s, %s)", rows)
+    return len(rows)
+
+def suggest_pairings(ingredient_ids, limit=SUGGESTIONS):
+    """
+    Up to `limit` `(id, name)` of ingredients that go well with all of `ingredient_ids`
+    together, best first, in one query over the `(ingredient, score)` index.
+    """
+    from .models import IngredientPairing
+
+    ingredient_ids = list(ingredient_ids)
+    rows = (
+        IngredientPairing.objects.filter(ingredient_id__in=ingredient_ids).exclude(other_id__in=ingredient_ids)
+        .values("other_id", "other__name").annotate(total=Sum("score")).order_by("-total", "other__name")[:limit]
+    )
+    return [(row["other_id"], row["other__name"]) for row in rows]
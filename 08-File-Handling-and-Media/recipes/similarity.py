@@ -0,0 +1,139 @@
+"""
+"Similar recipes": recipes sharing the most ingredients and tags, found without
+comparing every pair.
+
+Each recipe's set of ingredients and tags gets a MinHash signature: for each of
+NUM_HASHES hash functions, the smallest hash of any item. Two recipes agree on a given
+position with a probability equal to the Jaccard similarity of their sets. The
+signature is cut into BANDS bands, and each band is stored as a hashed bucket key
+(`SimilarityBucket`). Recipes sharing any bucket are candidates; with 20 bands of 3
+rows, recipes with a similarity of 0.7 almost always share one, recipes with 0.5 with
+93% probability and recipes with 0.2 with 15%. A lookup reads the buckets of one recipe through an index, then ranks
+a bounded number of candidates by their exact similarity, so its cost doesn't grow
+with the number of recipes.
+
+Buckets are rebuilt whenever a recipe's ingredients or tags change (see
+`recipes.models.touch_recipe_on_m2m_change`); `manage.py build_similarity_index`
+builds them for existing recipes.
+"""
+import functools
+import hashlib
+import struct
+from array import array
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# Changing these invalidates the stored buckets; run `manage.py build_similarity_index` after.
+NUM_HASHES = 60
+BANDS = 20
+# Recipes shown in a recipe's "Similar recipes" section, at least MIN_SIMILARITY alike.
+RELATED_COUNT = getattr(settings, "RECIPE_RELATED_COUNT", 6)
+RELATED_MIN_SIMILARITY = getattr(settings, "RECIPE_RELATED_MIN_SIMILARITY", 0.2)
+# Bucket rows read per band, and candidates ranked by exact similarity, per lookup.
+# Buckets of very common items can hold a large share of all recipes; these bound the work.
+CANDIDATES_PER_BAND = getattr(settings, "RECIPE_RELATED_CANDIDATES_PER_BAND", 100)
+CANDIDATES = getattr(settings, "RECIPE_RELATED_CANDIDATES", 100)
+
+def item_hashes(item):
+    """
+    The NUM_HASHES 32-bit hashes of a string item (`"i<ingredient id>"`, `"t<tag id>"`, ...):
+    consecutive pieces of one SHAKE-128 digest, so they are independent and the same in
+    every process.
+    """
+    return array("I", hashlib.shake_128(item.encode()).digest(4 * NUM_HASHES))
+
+# Ingredients and tags recur across recipes, so their hashes are worth keeping.
+_cached_item_hashes = functools.lru_cache(maxsize=50_000)(item_hashes)
+
+def minhash(items, cached=True):
+    """ MinHash signature of a non-empty set of items. Pass `cached=False` for items that rarely recur. """
+    return [min(column) for column in zip(*map(_cached_item_hashes if cached else item_hashes, items))]
+
+def bucket_keys(signature, bands=BANDS):
+    """ One signed 64-bit key per band of `signature`, distinct across bands. """
+    keys = set()
+    rows = len(signature) // bands
+    for band in range(bands):
+        values = signature[band * rows:(band + 1) * rows]
+        digest = hashlib.blake2b(struct.pack(f"<H{rows}I", band, *values), digest_size=8).digest()
+        keys.add(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+def recipe_items(pks):
+    """ `{recipe id: set of items}` for the recipes `pks` that have ingredients or tags, in two queries. """
+    from .models import Recipe
+
+    items = defaultdict(set)
+    for field, prefix in (("ingredients", "i"), ("tags", "t")):
+        through = Recipe._meta.get_field(field).remote_field.through
+        other = Recipe._meta.get_field(field).m2m_reverse_name()
+        for recipe_id, other_id in through.objects.filter(recipe_id__in=pks).values_list("recipe_id", other):
+            items[recipe_id].add(f"{prefix}{other_id}")
+    return items
+
+def index_recipes(pks):
+    """ Rebuild the buckets of the recipes `pks` from their current ingredients and tags. """
+    from .models import SimilarityBucket
+
+    pks = list(set(pks))
+    if not pks:
+        return
+    items = recipe_items(pks)
+    rows = [(pk, key) for pk, recipe_set in items.items() for key in bucket_keys(minhash(recipe_set))]
+    # At BANDS rows per recipe, building a model instance per row for `bulk_create()`
+    # would take most of the time of a full rebuild.
+    quote = connection.ops.quote_name
+    table = quote(SimilarityBucket._meta.db_table)
+    columns = ", ".join(quote(SimilarityBucket._meta.get_field(name).column) for name in ("recipe", "key"))
+    with transaction.atomic(), connection.cursor() as cursor:
+        SimilarityBucket.objects.filter(recipe_id__in=pks).delete()
+        cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s)", rows)
+
+def jaccard(a, b):
+    """ Jaccard similarity of two sets: shared items over all items. """
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def _band_members(keys, exclude_pk):
+    """
+    Ids of the recipes in each bucket of `keys` (apart from `exclude_pk`), once per shared
+    bucket, in one query. Each bucket is read on its own with a LIMIT, so a huge bucket
+    can't crowd out the others; the ORM can't express LIMIT inside a UNION on SQLite.
+    """
+    from .models import SimilarityBucket
+
+    quote = connection.ops.quote_name
+    table = quote(SimilarityBucket._meta.db_table)
+    recipe_column = quote(SimilarityBucket._meta.get_field("recipe").column)
+    key_column = quote(SimilarityBucket._meta.get_field("key").column)
+    band = (
+        f"SELECT * FROM (SELECT {recipe_column} FROM {table} "
+        f"WHERE {key_column} = %s AND {recipe_column} <> %s LIMIT %s) AS band{{}}"
+    )
+    sql = " UNION ALL ".join(band.format(index) for index in range(len(keys)))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [value for key in keys for value in (key, exclude_pk, CANDIDATES_PER_BAND)])
+        return [recipe_id for recipe_id, in cursor.fetchall()]
+
+def related_recipes(recipe, count=RELATED_COUNT):
+    """
+    Up to `count` public recipes most similar to `recipe`, as `(recipe, similarity)`
+    pairs, best first. Only their `title` is loaded.
+    """
+    from .models import Recipe, SimilarityBucket
+
+    keys = list(SimilarityBucket.objects.filter(recipe=recipe).values_list("key", flat=True))
+    if not keys:
+        return []
+    shared = Counter(_band_members(keys, recipe.pk))
+    # Recipes sharing more bands are likely more similar; only the best are compared exactly.
+    candidates = [pk for pk, _ in shared.most_common(CANDIDATES)]
+    items = recipe_items([recipe.pk, *candidates])
+    own = items.get(recipe.pk, set())
+    scores = {pk: jaccard(own, items.get(pk, set())) for pk in candidates}
+    ranked = sorted((pk for pk in candidates if scores[pk] >= RELATED_MIN_SIMILARITY), key=lambda pk: -scores[pk])
+
+    # Private recipes are never suggested.
+    public = Recipe.objects.filter(pk__in=ranked, is_public__in=[True]).only("title").in_bulk()
+    return [(public[pk], scores[pk]) for pk in ranked if pk in public][:count]
@@ -0,0 +1,119 @@
+// Turns the ingredient and tag selects of the recipe form (rendered with only their
+// chosen options, see AutocompleteSelectMultiple in recipes/forms.py) into a list of
+// chosen names plus a text box that suggests names from the select's JSON endpoint.
+// Selects with a `data-suggest-url` also offer what goes well with the current choice.
+(function () {
+  const DELAY = 150;
+
+  function setUp(select) {
+    const wrapper = document.createElement("div");
+    const chosen = document.createElement("ul");
+    const input = document.createElement("input");
+    const suggestions = document.createElement("ul");
+    const related = document.createElement("p");
+    input.type = "text";
+    input.placeholder = "Type to search...";
+    input.autocomplete = "off";
+    wrapper.append(chosen, input, suggestions, related);
+    select.hidden = true;
+    select.after(wrapper);
+
+    let latestRelated = 0;
+    async function renderRelated() {
+      if (!select.dataset.suggestUrl) return;
+      const request = ++latestRelated;
+      const ids = Array.from(select.selectedOptions, (option) => option.value);
+      if (!ids.length) {
+        related.replaceChildren();
+        return;
+      }
+      const params = new URLSearchParams(ids.map((id) => ["id", id]));
+      const response = await fetch(`${select.dataset.suggestUrl}?${params}`);
+      const { results } = await response.json();
+      if (request !== latestRelated) return;
+      related.replaceChildren(
+        ...(results.length ? ["Goes well with: "] : []),
+        ...results.map((result) => {
+          const button = document.createElement("button");
+          button.type = "button";
+          button.textContent = `+ ${result.name}`;
+          button.addEventListener("click", () => choose(result));
+          return button;
+        })
+      );
+    }
+
+    function renderChosen() {
+      chosen.replaceChildren(
+        ...Array.from(select.selectedOptions, (option) => {
+          const item = document.createElement("li");
+          const remove = document.createElement("button");
+          remove.type = "button";
+          remove.textContent = "×";
+          remove.setAttribute("aria-label", `Remove ${option.text}`);
+          remove.addEventListener("click", () => {
+            option.remove();
+            renderChosen();
+          });
+          item.append(option.text, " ", remove);
+          return item;
+        })
+      );
+      renderRelated();
+    }
+
+    function choose(result) {
+      if (!select.querySelector(`option[value="${result.id}"]`)) {
+        select.add(new Option(result.name, result.id, true, true));
+      }
+      input.value = "";
+      suggestions.replaceChildren();
+      renderChosen();
+      input.focus();
+    }
+
+    let timer = null;
+    let latest = 0;
+    input.addEventListener("input", () => {
+      clearTimeout(timer);
+      timer = setTimeout(async () => {
+        const query = input.value.trim();
+        const request = ++latest;
+        if (!query) {
+          suggestions.replaceChildren();
+          return;
+        }
+        const response = await fetch(`${select.dataset.autocompleteUrl}?q=${encodeURIComponent(query)}`);
+        const { results } = await response.json();
+        // An answer to an older query may arrive after a newer one's.
+        if (request !== latest) return;
+        suggestions.replaceChildren(
+          ...results.map((result) => {
+            const item = document.createElement("li");
+            item.textContent = result.name;
+            item.tabIndex = 0;
+            item.addEventListener("click", () => choose(result));
+            item.addEventListener("keydown", (event) => {
+              if (event.key === "Enter") {
+                event.preventDefault();
+                choose(result);
+              }
+            });
+            return item;
+          })
+        );
+      }, DELAY);
+    });
+    // Enter picks the first suggestion rather than submitting the form.
+    input.addEventListener("keydown", (event) => {
+      if (event.key !== "Enter") return;
+      event.preventDefault();
+      const first = suggestions.querySelector("li");
+      if (first) first.click();
+    });
+
+    renderChosen();
+  }
+
+  document.querySelectorAll("select[data-autocomplete-url]").forEach(setUp);
+})();
@@ -0,0 +1,80 @@
+// Sends large images on the recipe form through the resumable upload endpoints
+// (see recipes/uploads.py) before the form is submitted, so the form itself only
+// carries their upload ids in the hidden `<name>_upload` fields.
+(function () {
+  const LARGE_FILE = 2 * 1024 * 1024;
+  const MAX_RETRIES = 5;
+
+  const form = document.querySelector("form[data-upload-url]");
+  if (!form) return;
+  const csrfToken = form.querySelector("[name=csrfmiddlewaretoken]").value;
+
+  async function sha256(file) {
+    const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, "0")).join("");
+  }
+
+  // Retries network errors and server errors with backoff; the server keeps every byte it got.
+  async function send(url, options) {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const response = await fetch(url, {
+          ...options,
+          headers: { "X-CSRFToken": csrfToken, ...(options.headers || {}) },
+        });
+        if (response.status < 500 || attempt >= MAX_RETRIES) return response;
+      } catch (error) {
+        if (attempt >= MAX_RETRIES) throw error;
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** attempt));
+    }
+  }
+
+  async function upload(file) {
+    let response = await send(form.dataset.uploadUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ filename: file.name, size: file.size, sha256: await sha256(file) }),
+    });
+    let state = await response.json();
+    if (!response.ok) throw new Error(state.error);
+
+    while (state.offset < state.size) {
+      const end = Math.min(state.offset + state.chunk_size, state.size);
+      response = await send(state.url, {
+        method: "PUT",
+        headers: { "Content-Range": `bytes ${state.offset}-${end - 1}/${state.size}` },
+        body: file.slice(state.offset, end),
+      });
+      const result = await response.json();
+      // A 409 means the server holds a different amount than we thought; resume from its offset.
+      if (!response.ok && response.status !== 409) throw new Error(result.error);
+      state = result;
+    }
+
+    response = await send(state.complete_url, { method: "POST" });
+    state = await response.json();
+    if (!response.ok) throw new Error(state.error);
+    return state.id;
+  }
+
+  form.addEventListener("submit", async (event) => {
+    const inputs = Array.from(form.querySelectorAll("input[type=file]")).filter(
+      (input) => input.files.length && input.files[0].size > LARGE_FILE
+    );
+    if (!inputs.length) return;
+    event.preventDefault();
+    const button = form.querySelector("[type=submit]");
+    button.disabled = true;
+    try {
+      for (const input of inputs) {
+        form.querySelector(`[name="${input.name}_upload"]`).value = await upload(input.files[0]);
+        input.value = "";
+      }
+      form.submit();
+    } catch (error) {
+      alert(`Could not upload the image: ${error.message}`);
+      button.disabled = false;
+    }
+  });
+})();
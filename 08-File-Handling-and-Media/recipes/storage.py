@@ -0,0 +1,102 @@
+"""
+Content-addressed storage for recipe images.
+
+Every file is named after the SHA-256 of its content, which is computed while
+the upload is streamed to disk, and lands in a sharded layout:
+`blobs/ab/cd/abcd1234....jpg`. Uploading a photo that is already stored costs
+no extra disk space, and since a name can never point at different bytes,
+blob URLs can be cached forever.
+
+Several rows may share a blob, so files must only be deleted through
+`delete_media_if_unreferenced()` in `recipes.models`.
+
+With content addressing turned off, uploads keep their names but are spread
+over the same kind of two-level layout by `ShardedUploadTo`.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.utils.deconstruct import deconstructible
+
+BLOB_PREFIX = "blobs"
+
+class ContentAddressedStorage(FileSystemStorage):
+    chunk_size = 64 * 1024
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is only known once the content has been hashed in `_save()`.
+        return name
+
+    def _save(self, name, content):
+        tmp_dir = self.path("tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        tmp = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        try:
+            with tmp:
+                for chunk in content.chunks(self.chunk_size):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+
+            name = self.blob_name(digest.hexdigest(), name)
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                # Already stored: the new upload is a duplicate. Refresh the blob's mtime so
+                # `manage.py collect_media_garbage` treats it as new and can't race this reference.
+                os.remove(tmp.name)
+                os.utime(full_path)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp.name, self.file_permissions_mode)
+                # Atomic, so concurrent uploads of the same file can't leave a partial blob behind.
+                os.replace(tmp.name, full_path)
+        except BaseException:
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+        return name
+
+    @staticmethod
+    def blob_name(hexdigest, original_name):
+        extension = posixpath.splitext(original_name)[1].lower()
+        return posixpath.join(BLOB_PREFIX, hexdigest[:2], hexdigest[2:4], hexdigest + extension)
+
+def is_immutable(name):
+    """ Whether the stored file `name` can never change, so its URL may be cached forever. """
+    return name.startswith(BLOB_PREFIX + "/")
+
+content_addressed_storage = ContentAddressedStorage()
+
+def recipe_image_storage():
+    """ Storage for the recipe image fields; content-addressed unless disabled in settings. """
+    if getattr(settings, "RECIPE_MEDIA_CONTENT_ADDRESSED", True):
+        return content_addressed_storage
+    return default_storage
+
+def shard_path(directory, filename, key):
+    """ `directory/ab/cd/filename`, sharded by the first four digits of the hex string `key`. """
+    return posixpath.join(directory, key[:2], key[2:4], filename)
+
+@deconstructible
+class ShardedUploadTo:
+    """
+    `upload_to` that spreads files over two levels of hex-named subdirectories
+    (`recipes/gallery/3f/a2/photo.jpg`), 65,536 in all, so directories stay small with
+    millions of uploads. The shard is random, so common names like `image.jpg` don't
+    all land in one place.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def __call__(self, instance, filename):
+        return shard_path(self.prefix, filename, uuid.uuid4().hex)
+
+    def __eq__(self, other):
+        return isinstance(other, ShardedUploadTo) and self.prefix == other.prefix
@@ -0,0 +1,59 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from ..imaging import CONTENT_TYPES, DERIVATIVE_FORMATS, get_derivatives
+
+register = template.Library()
+
+def _srcset(derivatives):
+    return ", ".join(f"{d.file.url} {d.width}w" for d in derivatives)
+
+@register.simple_tag
+def picture(field_file, alt="", width=None, sizes=None, style=""):
+    """
+    Render `<picture>` markup for an uploaded image, offering every derivative through
+    `srcset` so the browser downloads the smallest file that fits. `width` is the
+    displayed width in CSS pixels. Images without derivatives yet use the original file.
+    The stored size reserves the image's space up front and the stored placeholder is
+    shown behind it until it loads (see `recipes.imaging.image_metadata()`).
+
+        {% picture recipe.image alt=recipe.title width=200 style="height:auto;" %}
+    """
+    if not field_file:
+        return ""
+    sizes = sizes or (f"{width}px" if width else "100vw")
+    style = f"width:{width}px;{style}" if width else style
+    instance, field_name = field_file.instance, field_file.field.name
+    placeholder = getattr(instance, f"{field_name}_placeholder", "")
+    if placeholder:
+        style = f"background:url({placeholder}) center/cover no-repeat;{style}"
+    # Only the aspect ratio matters; CSS sets the displayed size.
+    size = (getattr(instance, f"{field_name}_width", None), getattr(instance, f"{field_name}_height", None))
+
+    derivatives = get_derivatives(field_file)
+    by_format = {}
+    for derivative in derivatives:
+        by_format.setdefault(derivative.format, []).append(derivative)
+    fallback = [d for fmt, group in by_format.items() if fmt not in DERIVATIVE_FORMATS for d in group]
+    if not fallback:
+        if not all(size):
+            return format_html(
+                '<img src="{}" alt="{}" style="{}" loading="lazy" decoding="async">', field_file.url, alt, style
+            )
+        return format_html(
+            '<img src="{}" width="{}" height="{}" alt="{}" style="{}" loading="lazy" decoding="async">',
+            field_file.url, size[0], size[1], alt, style,
+        )
+
+    fallback.sort(key=lambda d: d.width)
+    src = next((d for d in fallback if width is None or d.width >= int(width)), fallback[-1])
+    if not all(size):
+        size = (src.width, src.height)
+    sources = format_html_join(
+        "", '<source type="{}" srcset="{}" sizes="{}">',
+        ((CONTENT_TYPES[fmt], _srcset(by_format[fmt]), sizes) for fmt in DERIVATIVE_FORMATS if fmt in by_format),
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" style="{}" loading="lazy" decoding="async"></picture>',
+        sources, src.file.url, _srcset(fallback), sizes, size[0], size[1], alt, style,
+    )
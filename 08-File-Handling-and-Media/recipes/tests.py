@@ -1,3 +1,1392 @@
-from django.test import TestCase
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.http import QueryDict
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import ExifTags, Image, ImageCms
+
+from .autocomplete import PrefixIndex, invalidate as invalidate_autocomplete, prefix_index
+from .cache import detail_cache_key, get_chef_for_user, render_recipe_cards
+from .counters import ViewCounter, trending_recipes
+from .duplicates import instruction_keys, shingles
+from .facets import count_facets, normalise_filters
+from .gallery_import import import_gallery_zip
+from .imaging import (
+    DERIVATIVE_FORMATS, PIPELINE_FINGERPRINT, PLACEHOLDER_SIZE, decode_image, derivative_name, generate_derivatives,
+    image_metadata, optimized_copy,
+)
+from .jobs import LOCK_TIMEOUT, MAX_ATTEMPTS, RETRY_DELAY, claim_job, run_job, run_pending_jobs
+from .middleware import ChefMiddleware
+from .management.commands.shard_media import sharded_name
+from .pairings import compute_pairings, suggest_pairings
+from .models import (
+    ChunkedUpload, Chef, ImageDerivative, ImageJob, Ingredient, IngredientPairing, InstructionBucket, NearDuplicate,
+    Recipe, RecipeImage, RecipeQuerySet, Tag,
+)
+from .similarity import jaccard, minhash, related_recipes
+from .storage import ShardedUploadTo
+from .validators import validate_image_upload
+
+def image_upload(name="photo.jpg", size=(64, 48), fmt="JPEG", color=(200, 80, 40)):
+    """ A small, valid image upload. """
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, fmt)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=Image.MIME[fmt])
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class RecipeTestCase(TestCase):
+    """
+    Base for the tests below: an empty cache and MEDIA_ROOT for every test, a chef
+    (alice), another user (bob) and a staff member (carol).
+    """
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        # Views are flushed by a background thread, outside the test's transaction.
+        self.enterContext(mock.patch("recipes.views.record_view"))
+        self.user = User.objects.create_user("alice", password="secret")
+        self.chef = Chef.objects.get(user=self.user)
+        self.chef.name = "Alice"
+        self.chef.save()
+        self.other = User.objects.create_user("bob", password="secret")
+        self.staff = User.objects.create_user("carol", password="secret", is_staff=True)
+
+    def make_recipe(self, **fields):
+        fields.setdefault("title", "Tomato soup")
+        fields.setdefault("instructions", "Simmer.")
+        fields.setdefault("chef", self.chef)
+        return Recipe.objects.create(**fields)
+
+    def recipe_form_data(self, **fields):
+        """ POST data for `RecipeForm`. """
+        data = {
+            "title": "Tomato soup", "chef": self.chef.pk, "instructions": "Simmer.",
+            "cook_time_in_minutes": 20, "difficulty": "E", "is_public": "on",
+        }
+        data.update(fields)
+        return data
+
+class RecipeDetailCacheTests(RecipeTestCase):
+    def test_body_is_served_from_the_cache(self):
+        recipe = self.make_recipe()
+        url = recipe.get_absolute_url()
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(url)
+        recipe.refresh_from_db()
+        self.assertIn("Tomato soup", cache.get(detail_cache_key(recipe.pk, recipe.updated_at)))
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(url)
+        self.assertContains(response, "Tomato soup")
+        self.assertLess(len(second), len(first))
+
+    def test_edit_shows_up(self):
+        recipe = self.make_recipe()
+        self.client.get(recipe.get_absolute_url())
+        recipe.title = "Leek soup"
+        recipe.save()
+        self.assertContains(self.client.get(recipe.get_absolute_url()), "Leek soup")
+
+    def test_ingredient_and_tag_changes_show_up(self):
+        recipe = self.make_recipe()
+        url = recipe.get_absolute_url()
+        leek = Ingredient.objects.create(name="Leek")
+        vegan = Tag.objects.create(name="Vegan")
+        self.client.get(url)
+        recipe.ingredients.add(leek)
+        self.assertContains(self.client.get(url), "Leek")
+        # From the other side of the relation too.
+        vegan.recipes.add(recipe)
+        self.assertContains(self.client.get(url), "Vegan")
+        leek.recipes.clear()
+        self.assertNotContains(self.client.get(url), "Leek")
+
+    def test_private_recipe_is_checked_before_the_cache(self):
+        recipe = self.make_recipe(is_public=False)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(recipe.get_absolute_url()).status_code, 200)
+        self.client.logout()
+        self.assertEqual(self.client.get(recipe.get_absolute_url()).status_code, 404)
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(recipe.get_absolute_url()).status_code, 404)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(recipe.get_absolute_url()).status_code, 200)
+
+    def test_delete_drops_the_cached_body(self):
+        recipe = self.make_recipe()
+        self.client.get(recipe.get_absolute_url())
+        recipe.refresh_from_db()
+        key = detail_cache_key(recipe.pk, recipe.updated_at)
+        recipe.delete()
+        self.assertIsNone(cache.get(key))
+
+class RecipeCardCacheTests(RecipeTestCase):
+    def test_warm_cards_skip_the_ingredient_query(self):
+        recipe = self.make_recipe()
+        recipe.ingredients.add(Ingredient.objects.create(name="Basil"))
+        self.assertContains(self.client.get("/"), "Basil")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/")
+        self.assertContains(response, "Basil")
+        self.assertFalse(any("recipes_recipe_ingredients" in query["sql"] for query in queries))
+
+    def test_cards_are_fetched_in_one_round_trip(self):
+        recipes = [self.make_recipe(title=f"Recipe {i}") for i in range(3)]
+        render_recipe_cards(recipes)
+        with mock.patch("recipes.cache.cache.get_many", wraps=cache.get_many) as get_many:
+            cards = render_recipe_cards(recipes)
+        get_many.assert_called_once()
+        self.assertEqual([f"Recipe {i}" in card for i, card in enumerate(cards)], [True] * 3)
+
+    def test_chef_rename_and_ingredient_changes_show_up(self):
+        recipe = self.make_recipe()
+        self.client.get("/")
+        self.chef.name = "Alice B."
+        self.chef.save()
+        self.assertContains(self.client.get("/"), "Alice B.")
+        recipe.ingredients.add(Ingredient.objects.create(name="Fennel"))
+        self.assertContains(self.client.get("/"), "Fennel")
+
+class ViewCounterTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        # No flusher thread; the tests flush by hand.
+        self.enterContext(mock.patch.object(ViewCounter, "_start"))
+        self.counter = ViewCounter(interval=3600, threshold=3)
+
+    def test_flush_adds_pending_views(self):
+        soup, stew = self.make_recipe(), self.make_recipe(title="Stew")
+        Recipe.objects.filter(pk=soup.pk).update(view_count=10)
+        self.counter.record(soup.pk)
+        self.counter.record(soup.pk)
+        self.counter.record(stew.pk)
+        self.assertEqual(self.counter.flush(), 3)
+        self.assertEqual(self.counter.flush(), 0)
+        counts = dict(Recipe.objects.values_list("title", "view_count"))
+        self.assertEqual(counts, {"Tomato soup": 12, "Stew": 1})
+
+    def test_threshold_wakes_the_flusher(self):
+        recipe = self.make_recipe()
+        self.counter.record(recipe.pk)
+        self.counter.record(recipe.pk)
+        self.assertFalse(self.counter._wake.is_set())
+        self.counter.record(recipe.pk)
+        self.assertTrue(self.counter._wake.is_set())
+
+    def test_failed_flush_keeps_the_views(self):
+        recipe = self.make_recipe()
+        self.counter.record(recipe.pk, views=4)
+        with mock.patch.object(RecipeQuerySet, "update", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.counter.flush()
+        self.assertEqual(self.counter.flush(), 4)
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.view_count, 4)
+
+    def test_trending_ranks_recent_views_of_public_recipes(self):
+        old = self.make_recipe(title="Old")
+        new = self.make_recipe(title="New")
+        private = self.make_recipe(title="Private", is_public=False)
+        with mock.patch("recipes.counters.time.time", return_value=1_750_000_000):
+            self.counter.record(old.pk, views=5)
+            self.counter.record(private.pk, views=50)
+            self.counter.flush()
+        # Two days later, two half-lives by default: 3 views outweigh 5 old ones.
+        with mock.patch("recipes.counters.time.time", return_value=1_750_000_000 + 2 * 24 * 60 * 60):
+            self.counter.record(new.pk, views=3)
+            self.counter.flush()
+        self.assertEqual([recipe["title"] for recipe in trending_recipes()], ["New", "Old"])
+
+class VisibleToTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        other_chef = Chef.objects.get(user=self.other)
+        self.public = self.make_recipe(title="Public")
+        self.own_private = self.make_recipe(title="Alice's secret", is_public=False)
+        self.others_private = self.make_recipe(title="Bob's secret", is_public=False, chef=other_chef)
+
+    def titles(self, user):
+        return {recipe.title for recipe in Recipe.objects.visible_to(user)}
+
+    def test_anonymous_users_see_public_recipes(self):
+        self.assertEqual(self.titles(AnonymousUser()), {"Public"})
+
+    def test_owners_also_see_their_private_recipes(self):
+        self.assertEqual(self.titles(self.user), {"Public", "Alice's secret"})
+        self.assertEqual(self.titles(self.other), {"Public", "Bob's secret"})
+
+    def test_staff_see_everything(self):
+        self.assertEqual(self.titles(self.staff), {"Public", "Alice's secret", "Bob's secret"})
+
+    def test_ordering_slicing_and_counting(self):
+        newer = self.make_recipe(title="Newer")
+        visible = Recipe.objects.visible_to(self.user)
+        self.assertEqual(visible.count(), 3)
+        self.assertEqual([recipe.pk for recipe in visible[:2]], [newer.pk, self.own_private.pk])
+        self.assertEqual(Recipe.objects.filter(title__startswith="N").visible_to(self.user).count(), 1)
+
+    def test_recipe_list_and_stats_hide_other_users_private_recipes(self):
+        self.client.force_login(self.user)
+        for url in ("/", "/stats/"):
+            response = self.client.get(url)
+            self.assertContains(response, "Alice&#x27;s secret")
+            self.assertNotContains(response, "Bob&#x27;s secret")
+
+class ChefMiddlewareTests(RecipeTestCase):
+    def chef_of(self, user):
+        request = RequestFactory().get("/")
+        request.user = user
+        ChefMiddleware(lambda request: request)(request)
+        return request.chef
+
+    def test_chef_is_resolved_once_and_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.chef_of(self.user).pk, self.chef.pk)
+        with self.assertNumQueries(0):
+            chef = self.chef_of(self.user)
+            self.assertEqual(chef.pk, self.chef.pk)
+            self.assertEqual(chef.name, "Alice")
+
+    def test_anonymous_users_have_no_chef(self):
+        with self.assertNumQueries(0):
+            # A lazy object wrapping None.
+            self.assertEqual(self.chef_of(AnonymousUser()), None)
+
+    def test_chef_changes_clear_the_cache(self):
+        get_chef_for_user(self.user)
+        self.chef.name = "Alice B."
+        self.chef.save()
+        self.assertEqual(get_chef_for_user(self.user).name, "Alice B.")
+        self.chef.delete()
+        # Accounts without a chef get one on first use.
+        self.assertNotEqual(get_chef_for_user(self.user).pk, self.chef.pk)
+
+    def test_views_check_ownership_against_request_chef(self):
+        recipe = self.make_recipe()
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(f"/recipes/{recipe.pk}/edit/").status_code, 403)
+        self.assertEqual(self.client.post(f"/recipes/{recipe.pk}/delete/").status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(f"/recipes/{recipe.pk}/edit/").status_code, 200)
+        self.assertContains(self.client.get("/my-recipes/"), "Tomato soup")
+
+class ImageJobTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.make_recipe()
+        self.image = RecipeImage.objects.create(recipe=self.recipe, image=image_upload())
+
+    def test_upload_is_queued(self):
+        self.assertEqual(self.image.status, "pending")
+        job = ImageJob.objects.get()
+        self.assertEqual((job.target, job.field_name, job.status), (self.image, "image", "pending"))
+
+    def test_a_job_is_claimed_once(self):
+        job = claim_job()
+        self.assertEqual((job.status, job.attempts), ("running", 1))
+        self.assertIsNone(claim_job())
+
+    def test_abandoned_jobs_are_claimed_again(self):
+        job = claim_job()
+        ImageJob.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(seconds=LOCK_TIMEOUT + 1))
+        self.assertEqual(claim_job().attempts, 2)
+
+    def test_jobs_that_keep_killing_the_worker_fail(self):
+        stale = timezone.now() - timedelta(seconds=LOCK_TIMEOUT + 1)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            job = claim_job()
+            self.assertEqual(job.attempts, attempt)
+            # The worker dies without recording anything.
+            ImageJob.objects.filter(pk=job.pk).update(locked_at=stale)
+        with self.assertLogs("recipes.jobs", "ERROR"):
+            self.assertIsNone(claim_job())
+        job = ImageJob.objects.get()
+        self.assertEqual((job.status, job.locked_at), ("failed", None))
+        self.assertIn("worker stopped", job.last_error)
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.status, "failed")
+
+    def test_successful_job_processes_the_image(self):
+        self.assertEqual(run_pending_jobs(), (1, 0))
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.status, "ready")
+        self.assertEqual((self.image.image_width, self.image.image_height), (64, 48))
+        self.assertTrue(self.image.image_placeholder.startswith("data:image/webp;base64,"))
+        self.assertTrue(ImageDerivative.objects.filter(source=self.image.image.name).exists())
+        self.assertFalse(ImageJob.objects.exists())
+
+    def test_failed_jobs_back_off_then_give_up(self):
+        failing = mock.patch("recipes.jobs.process_image", side_effect=OSError("disk full"))
+        with failing, self.assertLogs("recipes.jobs", "ERROR"):
+            before = timezone.now()
+            self.assertFalse(run_job(claim_job()))
+            job = ImageJob.objects.get()
+            self.assertEqual(job.status, "pending")
+            self.assertIn("disk full", job.last_error)
+            self.assertGreaterEqual(job.run_after, before + timedelta(seconds=RETRY_DELAY))
+            # Not runnable again before its delay.
+            self.assertIsNone(claim_job())
+            for _ in range(2, MAX_ATTEMPTS + 1):
+                ImageJob.objects.update(run_after=timezone.now())
+                run_job(claim_job())
+        self.assertEqual(ImageJob.objects.get().status, "failed")
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.status, "failed")
+
+    def test_job_of_a_deleted_image_is_dropped(self):
+        job = claim_job()
+        RecipeImage.objects.all().delete()
+        self.assertTrue(run_job(job))
+        self.assertFalse(ImageJob.objects.exists())
+
+class ImageDerivativeTests(RecipeTestCase):
+    def test_derivatives_cover_every_width_and_format_without_upscaling(self):
+        recipe = self.make_recipe(image=image_upload(size=(500, 300)))
+        generate_derivatives(recipe.image)
+        derivatives = ImageDerivative.objects.filter(source=recipe.image.name)
+        self.assertEqual(
+            {(d.format, d.width, d.height) for d in derivatives},
+            {(fmt, width, round(300 * width / 500)) for fmt in DERIVATIVE_FORMATS + ["jpeg"] for width in (200, 400, 500)},
+        )
+        self.assertEqual({d.fingerprint for d in derivatives}, {PIPELINE_FINGERPRINT})
+        for derivative in derivatives:
+            with Image.open(derivative.file) as img:
+                self.assertEqual(img.size, (derivative.width, derivative.height))
+
+    def test_transparent_images_fall_back_to_png(self):
+        buffer = io.BytesIO()
+        Image.new("RGBA", (300, 200), (0, 0, 0, 0)).save(buffer, "PNG")
+        recipe = self.make_recipe(image=SimpleUploadedFile("logo.png", buffer.getvalue()))
+        generate_derivatives(recipe.image)
+        formats = set(ImageDerivative.objects.values_list("format", flat=True))
+        self.assertEqual(formats, set(DERIVATIVE_FORMATS) | {"png"})
+
+    def test_picture_tag(self):
+        recipe = self.make_recipe(image=image_upload(size=(500, 300)))
+        template = Template("{% load recipe_images %}{% picture recipe.image alt='Soup' width=200 %}")
+        plain = template.render(Context({"recipe": recipe}))
+        self.assertIn(f'<img src="{recipe.image.url}"', plain)
+        generate_derivatives(recipe.image)
+        recipe = Recipe.objects.get(pk=recipe.pk)
+        html = template.render(Context({"recipe": recipe}))
+        self.assertTrue(html.startswith("<picture>"))
+        for fmt in DERIVATIVE_FORMATS:
+            self.assertIn(f'<source type="image/{fmt}"', html)
+        self.assertIn(" 400w", html)
+        self.assertIn('sizes="200px"', html)
+
+    def test_deleted_gallery_images_leave_the_cached_page(self):
+        recipe = self.make_recipe()
+        image = RecipeImage.objects.create(recipe=recipe, image=image_upload())
+        url = recipe.get_absolute_url()
+        self.assertContains(self.client.get(url), image.image.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+        self.assertNotContains(self.client.get(url), image.image.url)
+        self.assertFalse(default_storage.exists(image.image.name))
+
+class ContentAddressedStorageTests(RecipeTestCase):
+    def test_identical_uploads_share_one_blob(self):
+        upload = image_upload()
+        digest = hashlib.sha256(upload.read()).hexdigest()
+        upload.seek(0)
+        first = self.make_recipe(image=upload)
+        second = self.make_recipe(image=image_upload(name="copy.JPG"))
+        self.assertEqual(first.image.name, f"blobs/{digest[:2]}/{digest[2:4]}/{digest}.jpg")
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(first.image.read(), image_upload().read())
+
+    def test_blob_is_deleted_with_its_last_reference(self):
+        recipe = self.make_recipe(image=image_upload())
+        # The same photo as cover and in the gallery: one file, two references.
+        RecipeImage.objects.create(recipe=recipe, image=image_upload())
+        storage, name = recipe.image.storage, recipe.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.delete()
+        self.assertFalse(RecipeImage.objects.exists())
+        self.assertFalse(storage.exists(name))
+
+    def test_shared_blob_survives_while_referenced(self):
+        first = self.make_recipe(image=image_upload())
+        second = self.make_recipe(image=image_upload())
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(second.image.storage.exists(second.image.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(second.image.storage.exists(second.image.name))
+
+class ChunkedUploadTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+        self.enterContext(mock.patch("recipes.models.CHUNKED_UPLOAD_DIR", upload_dir))
+        self.enterContext(mock.patch("recipes.uploads.CHUNKED_UPLOAD_DIR", upload_dir))
+        self.client.force_login(self.user)
+        self.data = image_upload(size=(300, 200)).read()
+
+    def start(self, data=None, sha256=None):
+        data = self.data if data is None else data
+        response = self.client.post("/uploads/", {
+            "filename": "big.jpg", "size": len(data), "sha256": sha256 or hashlib.sha256(data).hexdigest(),
+        }, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put(self, state, start, end, data=None):
+        data = self.data if data is None else data
+        return self.client.put(
+            state["url"], data[start:end + 1], content_type="application/octet-stream",
+            headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"},
+        )
+
+    def test_chunks_resume_from_the_offset(self):
+        state = self.start()
+        middle = len(self.data) // 2
+        self.assertEqual(self.put(state, 0, middle - 1).json()["offset"], middle)
+        # After a dropped connection the client asks where to carry on.
+        self.assertEqual(self.client.get(state["url"]).json()["offset"], middle)
+        self.assertEqual(self.put(state, middle, len(self.data) - 1).json()["offset"], len(self.data))
+        self.assertEqual(self.client.post(state["complete_url"]).json()["status"], "complete")
+        with open(ChunkedUpload.objects.get().path, "rb") as part:
+            self.assertEqual(part.read(), self.data)
+
+    def test_out_of_order_and_oversized_chunks_are_refused(self):
+        state = self.start()
+        response = self.put(state, 10, 19)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 0)
+        response = self.client.put(
+            state["url"], b"x", content_type="application/octet-stream",
+            headers={"Content-Range": f"bytes 0-0/{len(self.data) + 1}"},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post(state["complete_url"]).status_code, 409)
+
+    def test_digest_mismatch_resets_the_upload(self):
+        state = self.start(sha256="0" * 64)
+        self.put(state, 0, len(self.data) - 1)
+        response = self.client.post(state["complete_url"])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((response.json()["offset"], response.json()["status"]), (0, "uploading"))
+
+    def test_uploads_are_private_to_their_user(self):
+        state = self.start()
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(state["url"]).status_code, 404)
+        self.assertEqual(self.put(state, 0, 9).status_code, 404)
+
+    def test_recipe_form_takes_the_image_from_a_completed_upload(self):
+        state = self.start()
+        self.put(state, 0, len(self.data) - 1)
+        self.client.post(state["complete_url"])
+        response = self.client.post("/recipes/add/", {
+            **self.recipe_form_data(), "image_upload": state["id"],
+            "form-TOTAL_FORMS": 0, "form-INITIAL_FORMS": 0,
+        })
+        recipe = Recipe.objects.get()
+        self.assertRedirects(response, recipe.get_absolute_url(), fetch_redirect_response=False)
+        self.assertEqual(recipe.image.read(), self.data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+class MediaServingTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.make_recipe(image=image_upload(size=(300, 200)), is_public=False)
+        self.url = f"/media/{self.recipe.image.name}"
+        self.data = self.recipe.image.read()
+
+    def get(self, url=None, user=None, **headers):
+        if user:
+            self.client.force_login(user)
+        response = self.client.get(url or self.url, headers=headers)
+        self.addCleanup(response.close)
+        return response
+
+    def test_private_images_are_hidden_from_other_users(self):
+        self.assertEqual(self.get().status_code, 404)
+        self.assertEqual(self.get(user=self.other).status_code, 404)
+        for user in (self.user, self.staff):
+            response = self.get(user=user)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.data)
+            self.assertTrue(response["Cache-Control"].startswith("private,"))
+
+    def test_public_blobs_are_cached_forever(self):
+        Recipe.objects.filter(pk=self.recipe.pk).update(is_public=True)
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+
+    def test_derivatives_follow_their_source(self):
+        generate_derivatives(self.recipe.image)
+        derivative = ImageDerivative.objects.filter(source=self.recipe.image.name).first()
+        url = f"/media/{derivative.file.name}"
+        self.assertEqual(self.get(url).status_code, 404)
+        response = self.get(url, user=self.user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+    def test_range_requests(self):
+        response = self.get(user=self.user, Range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.data)}")
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        response = self.get(Range="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), self.data[-5:])
+        response = self.get(Range=f"bytes={len(self.data)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.data)}")
+
+    def test_etag_revalidation_and_if_range(self):
+        etag = self.get(user=self.user)["ETag"]
+        self.assertEqual(self.get(If_None_Match=etag).status_code, 304)
+        # A stale If-Range gets the whole, current file.
+        response = self.get(Range="bytes=0-9", If_Range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(Range="bytes=0-9", If_Range=etag).status_code, 206)
+
+    def test_paths_outside_media_root_are_not_found(self):
+        self.client.force_login(self.staff)
+        for path in ("/media/../manage.py", "/media/blobs/../../manage.py", "/media/blobs/"):
+            self.assertEqual(self.client.get(path).status_code, 404)
+
+    def test_sendfile_offload(self):
+        with mock.patch("recipes.media.SENDFILE", "x-accel-redirect"):
+            response = self.get(user=self.user)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.recipe.image.name}")
+        self.assertEqual(response.content, b"")
+
+class RegenerateImagesTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.make_recipe(image=image_upload(size=(300, 200)))
+        self.image = RecipeImage.objects.create(recipe=self.recipe, image=image_upload(size=(400, 300), color=(0, 90, 200)))
+        run_pending_jobs()
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir, ignore_errors=True)
+        self.checkpoint = f"{checkpoint_dir}/regenerate_images.checkpoint"
+
+    def regenerate(self, **options):
+        output = io.StringIO()
+        call_command("regenerate_images", workers=1, checkpoint=self.checkpoint, stdout=output, **options)
+        return output.getvalue()
+
+    def test_current_images_are_left_alone(self):
+        self.recipe.refresh_from_db()
+        self.image.refresh_from_db()
+        output = self.regenerate()
+        # Cached pages keyed by `updated_at` stay valid.
+        self.assertEqual(Recipe.objects.get(pk=self.recipe.pk).updated_at, self.recipe.updated_at)
+        self.assertEqual(RecipeImage.objects.get(pk=self.image.pk).image.name, self.image.image.name)
+        self.assertIn("0 shrunk, 0 derivatives written, 1 unchanged", output)
+
+    def test_gallery_images_are_shrunk_to_a_smaller_box(self):
+        self.recipe.refresh_from_db()
+        with mock.patch("recipes.management.commands.regenerate_images.GALLERY_MAX_SIZE", (200, 200)):
+            output = self.regenerate()
+        self.assertIn("1 shrunk", output)
+        image = RecipeImage.objects.get(pk=self.image.pk)
+        self.assertNotEqual(image.image.name, self.image.image.name)
+        self.assertEqual((image.image_width, image.image_height), (200, 150))
+        self.assertTrue(ImageDerivative.objects.filter(source=image.image.name).exists())
+        self.assertGreater(Recipe.objects.get(pk=self.recipe.pk).updated_at, self.recipe.updated_at)
+
+    def test_missing_placeholders_are_filled_in(self):
+        Recipe.objects.filter(pk=self.recipe.pk).update(image_placeholder="")
+        RecipeImage.objects.filter(pk=self.image.pk).update(image_placeholder="")
+        self.regenerate()
+        self.assertTrue(Recipe.objects.get(pk=self.recipe.pk).image_placeholder)
+        self.assertTrue(RecipeImage.objects.get(pk=self.image.pk).image_placeholder)
+
+class MediaGarbageTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.make_recipe(image=image_upload())
+        generate_derivatives(self.recipe.image)
+        self.derivatives = list(ImageDerivative.objects.values_list("file", flat=True))
+        self.orphan = default_storage.save("recipes/orphan.jpg", ContentFile(b"orphan"))
+        self.young_orphan = default_storage.save("recipes/young.jpg", ContentFile(b"young"))
+        # Everything but the young orphan is older than the grace period.
+        long_ago = time.time() - 48 * 60 * 60
+        for name in [self.recipe.image.name, self.orphan, *self.derivatives]:
+            os.utime(default_storage.path(name), (long_ago, long_ago))
+
+    def collect(self, *args):
+        output = io.StringIO()
+        call_command("collect_media_garbage", *args, workers=2, stdout=output)
+        return output.getvalue()
+
+    def test_unreferenced_old_files_are_removed(self):
+        self.assertIn("Removed 1 unreferenced file(s)", self.collect())
+        self.assertFalse(default_storage.exists(self.orphan))
+        for name in [self.recipe.image.name, self.young_orphan, *self.derivatives]:
+            self.assertTrue(default_storage.exists(name), name)
+
+    def test_derivatives_of_unreferenced_images_are_removed(self):
+        Recipe.objects.filter(pk=self.recipe.pk).update(image="")
+        self.collect()
+        self.assertFalse(default_storage.exists(self.recipe.image.name))
+        self.assertFalse(any(default_storage.exists(name) for name in self.derivatives))
+        self.assertFalse(ImageDerivative.objects.exists())
+
+    def test_dry_run_and_quarantine(self):
+        self.assertIn("Would remove recipes/orphan.jpg", self.collect("--dry-run"))
+        self.assertTrue(default_storage.exists(self.orphan))
+        quarantine = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, quarantine, ignore_errors=True)
+        self.collect("--quarantine", quarantine)
+        self.assertFalse(default_storage.exists(self.orphan))
+        self.assertTrue(os.path.exists(os.path.join(quarantine, "recipes", "orphan.jpg")))
+
+    def test_replaced_and_cleared_covers_are_deleted(self):
+        old_name = self.recipe.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.image = image_upload(color=(10, 10, 10))
+            self.recipe.save()
+        self.assertFalse(default_storage.exists(old_name))
+        self.assertFalse(ImageDerivative.objects.filter(source=old_name).exists())
+        new_name = self.recipe.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.image = None
+            self.recipe.save()
+        self.assertFalse(default_storage.exists(new_name))
+
+class ImageUploadValidationTests(RecipeTestCase):
+    def assertRefused(self, upload, code):
+        with self.assertRaises(ValidationError) as caught:
+            validate_image_upload(upload)
+        self.assertEqual(caught.exception.code, code)
+
+    def test_uploads_are_checked_from_their_header(self):
+        validate_image_upload(image_upload())
+        self.assertRefused(SimpleUploadedFile("photo.jpg", b"not an image"), "invalid_image")
+        self.assertRefused(image_upload("photo.gif", fmt="GIF"), "invalid_format")
+        self.assertRefused(image_upload("photo.png"), "extension_mismatch")
+        with mock.patch("recipes.validators.MAX_PIXELS", 64 * 48 - 1):
+            self.assertRefused(image_upload(), "too_many_pixels")
+
+    def test_recipe_form_refuses_disguised_files(self):
+        self.client.force_login(self.user)
+        data = self.recipe_form_data(image=SimpleUploadedFile("photo.jpg", b"<?php echo 1; ?>"))
+        response = self.client.post("/recipes/add/", data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("image", response.context["form"].errors)
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_stored_images_are_not_checked_again(self):
+        recipe = self.make_recipe(image=image_upload())
+        default_storage.delete(recipe.image.name)
+        self.client.force_login(self.user)
+        response = self.client.post(f"/recipes/{recipe.pk}/edit/", self.recipe_form_data(title="Renamed"))
+        self.assertRedirects(response, recipe.get_absolute_url(), fetch_redirect_response=False)
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).title, "Renamed")
+
+    def test_decode_image_scales_jpegs_down_while_decoding(self):
+        upload = image_upload(size=(800, 600))
+        self.assertEqual(decode_image(upload, (100, 75)).size, (100, 75))
+        upload.seek(0)
+        self.assertEqual(decode_image(upload).size, (800, 600))
+        with mock.patch("recipes.validators.MAX_PIXELS", 1000):
+            upload.seek(0)
+            with self.assertRaises(ValidationError):
+                decode_image(upload)
+
+class InlineGalleryProcessingTests(RecipeTestCase):
+    def create_with_gallery(self, *uploads):
+        data = self.recipe_form_data(**{
+            "form-TOTAL_FORMS": "3", "form-INITIAL_FORMS": "0",
+            "form-MIN_NUM_FORMS": "0", "form-MAX_NUM_FORMS": "1000",
+        })
+        for i, upload in enumerate(uploads):
+            data[f"form-{i}-image"] = upload
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.post("/recipes/add/", data).status_code, 302)
+        return Recipe.objects.get()
+
+    def test_queue_mode_leaves_images_to_the_worker(self):
+        recipe = self.create_with_gallery(image_upload(), image_upload(color=(0, 0, 0)))
+        self.assertEqual(sorted(recipe.images.values_list("status", flat=True)), ["pending", "pending"])
+        self.assertEqual(ImageJob.objects.count(), 2)
+
+    def test_inline_mode_stores_finished_images(self):
+        self.enterContext(mock.patch("recipes.views.GALLERY_PROCESSING", "inline"))
+        recipe = self.create_with_gallery(
+            image_upload(size=(1600, 1200)), image_upload(color=(0, 0, 0)), image_upload(color=(0, 0, 0)),
+        )
+        images = list(recipe.images.order_by("pk"))
+        self.assertEqual([image.status for image in images], ["ready"] * 3)
+        self.assertEqual((images[0].image_width, images[0].image_height), (800, 600))
+        self.assertTrue(all(image.image_placeholder for image in images))
+        # Identical uploads share one file and one set of derivatives.
+        self.assertEqual(images[1].image.name, images[2].image.name)
+        self.assertEqual(
+            set(ImageDerivative.objects.values_list("source", flat=True)), {images[0].image.name, images[1].image.name},
+        )
+        rows = ImageDerivative.objects.values_list("source", "width", "format")
+        self.assertEqual(len(rows), len(set(rows)))
+        self.assertFalse(ImageJob.objects.exists())
+
+class OptimizedCopyTests(RecipeTestCase):
+    def noisy_png(self):
+        """ An RGB PNG of four colours, which compresses far better as a palette image. """
+        rng = random.Random(1)
+        colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+        img = Image.new("RGB", (64, 48))
+        img.putdata([rng.choice(colours) for _ in range(64 * 48)])
+        buffer = io.BytesIO()
+        img.save(buffer, "PNG")
+        return SimpleUploadedFile("photo.png", buffer.getvalue(), content_type="image/png")
+
+    def tagged_jpeg(self, orientation=1, size=(64, 48)):
+        """ A JPEG with a GPS location, an EXIF orientation and an ICC profile. """
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = orientation
+        gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        gps[ExifTags.GPS.GPSLatitudeRef] = "N"
+        gps[ExifTags.GPS.GPSLatitude] = (51.0, 30.0, 0.0)
+        icc = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+        buffer = io.BytesIO()
+        Image.new("RGB", size, (200, 80, 40)).save(buffer, "JPEG", exif=exif, icc_profile=icc)
+        return SimpleUploadedFile("photo.jpg", buffer.getvalue(), content_type="image/jpeg")
+
+    def test_jpegs_that_fit_are_kept_byte_for_byte(self):
+        upload = image_upload(size=(800, 600))
+        self.assertIsNone(optimized_copy(upload, (800, 800)))
+        self.assertIsNone(optimized_copy(upload))
+
+    def test_metadata_is_cut_out_of_jpegs_that_fit(self):
+        upload = self.tagged_jpeg()
+        original = upload.read()
+        copy = optimized_copy(upload, (800, 800)).read()
+        # Only the metadata segment went; the compressed image is untouched.
+        self.assertLess(len(copy), len(original))
+        self.assertTrue(original.endswith(copy[copy.index(b"\xff\xda"):]))
+        with Image.open(io.BytesIO(copy)) as img, Image.open(io.BytesIO(original)) as before:
+            self.assertEqual(len(img.getexif()), 0)
+            self.assertEqual(img.info["icc_profile"], before.info["icc_profile"])
+            self.assertEqual(img.tobytes(), before.tobytes())
+        self.assertIsNone(optimized_copy(SimpleUploadedFile("photo.jpg", copy)))
+
+    def test_rotated_jpegs_are_turned_upright(self):
+        copy = optimized_copy(self.tagged_jpeg(orientation=6), (800, 800))
+        with Image.open(copy) as img:
+            self.assertEqual(img.size, (48, 64))
+            self.assertEqual(len(img.getexif()), 0)
+
+    def test_stored_uploads_have_no_location(self):
+        recipe = self.make_recipe(image=self.tagged_jpeg())
+        image = RecipeImage.objects.create(recipe=recipe, image=self.tagged_jpeg(size=(32, 32)))
+        run_pending_jobs()
+        for row in (Recipe.objects.get(pk=recipe.pk), RecipeImage.objects.get(pk=image.pk)):
+            with default_storage.open(row.image.name) as file, Image.open(file) as img:
+                self.assertEqual(img.getexif().get_ifd(ExifTags.IFD.GPSInfo), {})
+
+    def test_oversized_images_are_shrunk(self):
+        copy = optimized_copy(image_upload(size=(1600, 1200)), (800, 800))
+        self.assertEqual(Image.open(copy).size, (800, 600))
+
+    def test_pngs_are_palettized_without_losing_colour(self):
+        upload = self.noisy_png()
+        copy = optimized_copy(upload)
+        self.assertLess(copy.size, upload.size)
+        upload.seek(0)
+        with Image.open(upload) as original, Image.open(copy) as palettized:
+            self.assertEqual(palettized.mode, "P")
+            self.assertEqual(list(palettized.convert("RGB").getdata()), list(original.getdata()))
+
+    def test_recompress_images_leaves_jpegs_alone(self):
+        recipe = self.make_recipe(image=image_upload(size=(800, 600)))
+        with default_storage.open(recipe.image.name) as file:
+            before = file.read()
+        output = io.StringIO()
+        call_command("recompress_images", workers=1, stdout=output)
+        with default_storage.open(recipe.image.name) as file:
+            self.assertEqual(file.read(), before)
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).image.name, recipe.image.name)
+
+class ShardedMediaTests(RecipeTestCase):
+    def test_uploads_are_spread_over_random_shards(self):
+        upload_to = ShardedUploadTo("recipes")
+        names = {upload_to(None, "image.jpg") for _ in range(20)}
+        self.assertEqual(len(names), 20)
+        for name in names:
+            self.assertRegex(name, r"^recipes/[0-9a-f]{2}/[0-9a-f]{2}/image\.jpg$")
+
+    def flat_recipe(self, name):
+        recipe = self.make_recipe()
+        default_storage.save(name, ContentFile(b"flat"))
+        Recipe.objects.filter(pk=recipe.pk).update(image=name)
+        return recipe
+
+    def shard(self, *args):
+        output = io.StringIO()
+        call_command("shard_media", *args, stdout=output)
+        return output.getvalue()
+
+    def test_flat_files_and_their_derivatives_move_to_shards(self):
+        recipe = self.flat_recipe("recipes/flat.jpg")
+        image = RecipeImage.objects.create(recipe=recipe, image="recipes/flat.jpg", status="ready")
+        old_derivative = derivative_name("recipes/flat.jpg", 200, "webp")
+        default_storage.save(old_derivative, ContentFile(b"derivative"))
+        ImageDerivative.objects.create(
+            source="recipes/flat.jpg", width=200, height=150, format="webp", file=old_derivative, size=10,
+            fingerprint=PIPELINE_FINGERPRINT,
+        )
+        missing = self.flat_recipe("recipes/missing.jpg")
+        default_storage.delete("recipes/missing.jpg")
+
+        self.assertIn("for 3 row(s)", self.shard("--dry-run"))
+        self.assertTrue(default_storage.exists("recipes/flat.jpg"))
+
+        self.assertIn("1 missing file(s)", self.shard())
+        new_name = sharded_name("recipes/flat.jpg")
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).image.name, new_name)
+        self.assertEqual(RecipeImage.objects.get(pk=image.pk).image.name, new_name)
+        derivative = ImageDerivative.objects.get()
+        self.assertEqual((derivative.source, derivative.file.name), (new_name, derivative_name(new_name, 200, "webp")))
+        self.assertTrue(default_storage.exists(new_name))
+        self.assertTrue(default_storage.exists(derivative.file.name))
+        self.assertFalse(default_storage.exists("recipes/flat.jpg"))
+        self.assertFalse(default_storage.exists(old_derivative))
+        self.assertEqual(Recipe.objects.get(pk=missing.pk).image.name, "recipes/missing.jpg")
+
+        # Nothing is left to do on a second run.
+        self.assertIn("Moved 0 file(s)", self.shard())
+
+class ImagePlaceholderTests(RecipeTestCase):
+    def test_metadata_is_the_displayed_size_and_a_tiny_preview(self):
+        img = Image.new("RGB", (640, 480), (200, 80, 40))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotated 90° clockwise.
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", exif=exif)
+        name = default_storage.save("photo.jpg", ContentFile(buffer.getvalue()))
+
+        width, height, placeholder = image_metadata(default_storage, name)
+        self.assertEqual((width, height), (480, 640))
+        prefix = "data:image/webp;base64,"
+        self.assertTrue(placeholder.startswith(prefix))
+        self.assertLess(len(placeholder), 1000)
+        preview = Image.open(io.BytesIO(base64.b64decode(placeholder[len(prefix):])))
+        self.assertEqual(preview.format, "WEBP")
+        self.assertLessEqual(max(preview.size), PLACEHOLDER_SIZE)
+        self.assertGreater(preview.height, preview.width)
+
+    def test_picture_tag_reserves_space_and_paints_the_placeholder(self):
+        recipe = self.make_recipe(image=image_upload())
+        Recipe.objects.filter(pk=recipe.pk).update(
+            image_width=640, image_height=480, image_placeholder="data:image/webp;base64,AA",
+        )
+        recipe.refresh_from_db()
+        template = Template("{% load recipe_images %}{% picture recipe.image width=200 %}")
+        html = template.render(Context({"recipe": recipe}))
+        self.assertIn('width="640" height="480"', html)
+        self.assertIn("background:url(data:image/webp;base64,AA) center/cover no-repeat;width:200px;", html)
+
+    def test_new_cover_clears_stale_metadata(self):
+        recipe = self.make_recipe(image=image_upload())
+        run_pending_jobs()
+        recipe.refresh_from_db()
+        self.assertEqual((recipe.image_width, recipe.image_height), (64, 48))
+        self.assertTrue(recipe.image_placeholder)
+
+        recipe.image = image_upload(size=(32, 32))
+        recipe.save()
+        self.assertEqual((recipe.image_width, recipe.image_height, recipe.image_placeholder), (None, None, ""))
+        run_pending_jobs()
+        recipe.refresh_from_db()
+        self.assertEqual((recipe.image_width, recipe.image_height), (32, 32))
+
+class ExportTests(RecipeTestCase):
+    def export(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/my-recipes/export/")
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertIn("attachment;", response["Content-Disposition"])
+        return zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_archive_holds_own_recipes_and_their_images(self):
+        soup = self.make_recipe(image=image_upload(), is_public=False)
+        soup.tags.add(Tag.objects.create(name="Starter"))
+        soup.ingredients.add(Ingredient.objects.create(name="Tomato"))
+        gallery = RecipeImage.objects.create(recipe=soup, image=image_upload(color=(0, 0, 0)))
+        # The same photo again is stored, and exported, once.
+        RecipeImage.objects.create(recipe=soup, image=image_upload())
+        self.make_recipe(title="Bob's stew", chef=self.other.chef, image=image_upload(color=(1, 2, 3)))
+
+        archive = self.export()
+        self.assertEqual(json.loads(archive.read("chef.json"))["name"], "Alice")
+        [data] = json.loads(archive.read("recipes.json"))
+        self.assertEqual((data["title"], data["is_public"]), ("Tomato soup", False))
+        self.assertEqual((data["ingredients"], data["tags"]), (["Tomato"], ["Starter"]))
+        self.assertEqual(data["image"], f"images/{soup.image.name}")
+        images = sorted(name for name in archive.namelist() if name.startswith("images/"))
+        self.assertEqual(images, sorted([f"images/{soup.image.name}", f"images/{gallery.image.name}"]))
+        with default_storage.open(soup.image.name) as file:
+            self.assertEqual(archive.read(data["image"]), file.read())
+
+    def test_missing_files_are_skipped(self):
+        recipe = self.make_recipe(image=image_upload())
+        default_storage.delete(recipe.image.name)
+        archive = self.export()
+        self.assertEqual(len(json.loads(archive.read("recipes.json"))), 1)
+        self.assertEqual(archive.namelist(), ["chef.json", "recipes.json"])
+
+    def test_login_required(self):
+        self.assertEqual(self.client.get("/my-recipes/export/").status_code, 302)
+
+class ImportRecipesTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(path, mode) as file:
+            file.write(content)
+        return path
+
+    def run_import(self, path, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_recipes", path, "--chef", "alice", *args, workers=2, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_rows_are_imported_and_bad_ones_reported(self):
+        Ingredient.objects.create(name="Tomato")
+        self.write("soup.jpg", image_upload().read())
+        path = self.write("recipes.csv", (
+            "title,instructions,cook_time_in_minutes,difficulty,is_public,ingredients,tags,image\n"
+            "Soup,Simmer.,20,Easy,no,tomato; Basil;basil,Starter,soup.jpg\n"
+            ",No title.,5,E,yes,,,\n"
+            "Stew,Braise.,90,Impossible,yes,,,\n"
+            "Salad,Toss.,,h,,Basil,,\n"
+        ))
+        with self.captureOnCommitCallbacks(execute=True):
+            out, err = self.run_import(path, "--images", self.dir, "--batch-size", "2")
+        self.assertIn("Imported 2 recipe(s)", out)
+        self.assertIn("2 row(s) failed. Created 1 ingredient(s) and 1 tag(s).", out)
+        self.assertIn("Record 2: The title must have", err)
+        self.assertIn("Record 3: Unknown difficulty “Impossible”.", err)
+
+        soup = Recipe.objects.get(title="Soup")
+        self.assertEqual(
+            (soup.chef, soup.cook_time_in_minutes, soup.difficulty, soup.is_public), (self.chef, 20, "E", False),
+        )
+        self.assertEqual(sorted(soup.ingredients.values_list("name", flat=True)), ["Basil", "Tomato"])
+        self.assertEqual(list(soup.tags.values_list("name", flat=True)), ["Starter"])
+        self.assertTrue(default_storage.exists(soup.image.name))
+        self.assertEqual(ImageJob.objects.get().target, soup)
+        salad = Recipe.objects.get(title="Salad")
+        self.assertEqual((salad.cook_time_in_minutes, salad.difficulty, salad.is_public), (0, "H", True))
+
+    def test_json_arrays_and_lines_are_streamed(self):
+        records = [{"title": f"Recipe {i}", "instructions": "Mix.", "tags": ["Quick"]} for i in range(5)]
+        array = self.write("recipes.json", json.dumps(records, indent=2))
+        lines = self.write("recipes.jsonl", "\n".join(json.dumps(record) for record in records) + "\n")
+        with mock.patch("recipes.management.commands.import_recipes.READ_SIZE", 16):
+            self.assertIn("Imported 5 recipe(s)", self.run_import(array)[0])
+            self.assertIn("Imported 5 recipe(s)", self.run_import(lines, "--format", "json")[0])
+        self.assertEqual(Recipe.objects.filter(tags__name="Quick").count(), 10)
+
+    def test_bad_input_is_reported(self):
+        path = self.write("recipes.json", '[{"title": "A", "instructions": "B", "image": "a.jpg"}, 1]')
+        out, err = self.run_import(path)
+        self.assertIn("Record 1: has an image but no --images directory was given.", err)
+        self.assertIn("Record 2: not an object.", err)
+        self.write("fake.jpg", b"not an image")
+        path = self.write("recipes.csv", "title,instructions,image\nA,B,fake.jpg\n")
+        out, err = self.run_import(path, "--images", self.dir)
+        self.assertIn("Record 1: image: The file is not an image", err)
+        self.assertFalse(Recipe.objects.exists())
+        with self.assertRaisesMessage(CommandError, "Invalid JSON"):
+            self.run_import(self.write("broken.json", '[{"title": "A"'))
+        with self.assertRaisesMessage(CommandError, "No chef with the username"):
+            call_command("import_recipes", path, "--chef", "nobody")
+
+class GalleryZipImportTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.make_recipe()
+
+    def archive(self, files):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for name, data in files.items():
+                archive.writestr(name, data)
+        return SimpleUploadedFile("photos.zip", buffer.getvalue(), content_type="application/zip")
+
+    def test_images_are_imported_and_other_entries_refused(self):
+        archive = self.archive({
+            "b.jpg": image_upload(size=(1600, 1200)).read(),
+            "holiday/a.png": image_upload("a.png", fmt="PNG").read(),
+            "notes.txt": b"not an image",
+            "__MACOSX/._b.jpg": b"",
+            ".DS_Store": b"",
+        })
+        with self.captureOnCommitCallbacks(execute=True):
+            images, failures = import_gallery_zip(self.recipe, archive)
+        [(name, message)] = failures
+        self.assertEqual(name, "notes.txt")
+        self.assertIn("File extension “txt” is not allowed.", message)
+        self.assertEqual([(image.image_width, image.image_height) for image in images], [(800, 600), (64, 48)])
+        self.assertEqual(list(self.recipe.images.values_list("status", flat=True)), ["pending", "pending"])
+        self.assertEqual(ImageJob.objects.count(), 2)
+        self.assertTrue(all(image.image_placeholder for image in images))
+
+    def test_inline_mode_builds_derivatives_right_away(self):
+        self.enterContext(mock.patch("recipes.gallery_import.GALLERY_PROCESSING", "inline"))
+        images, failures = import_gallery_zip(self.recipe, self.archive({"a.jpg": image_upload().read()}))
+        self.assertEqual((images[0].status, failures), ("ready", []))
+        self.assertTrue(ImageDerivative.objects.filter(source=images[0].image.name).exists())
+        self.assertFalse(ImageJob.objects.exists())
+
+    def test_unusable_archives_are_refused(self):
+        for archive, code in [
+            (SimpleUploadedFile("photos.zip", b"not a zip"), "invalid_zip"),
+            (self.archive({"__MACOSX/": b""}), "empty_zip"),
+            (self.archive({f"{i}.jpg": b"" for i in range(3)}), "too_many_files"),
+        ]:
+            with mock.patch("recipes.gallery_import.ZIP_MAX_FILES", 2), self.assertRaises(ValidationError) as caught:
+                import_gallery_zip(self.recipe, archive)
+            self.assertEqual(caught.exception.code, code)
+
+    def test_oversized_entries_are_refused(self):
+        with mock.patch("recipes.gallery_import.ZIP_MAX_ENTRY_SIZE", 100):
+            images, failures = import_gallery_zip(self.recipe, self.archive({"a.jpg": image_upload().read()}))
+        self.assertEqual((images, [name for name, _ in failures]), ([], ["a.jpg"]))
+
+    def test_view_is_for_the_recipe_owner(self):
+        url = f"/recipes/{self.recipe.pk}/gallery/import/"
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.post(url, {"archive": self.archive({})}).status_code, 403)
+        self.client.force_login(self.user)
+        response = self.client.post(url, {"archive": self.archive({"a.jpg": image_upload().read()})})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["images"]), 1)
+        self.assertEqual(self.recipe.images.count(), 1)
+
+class RelatedRecipesTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.names = [Ingredient.objects.create(name=f"Ingredient {i}") for i in range(10)]
+
+    def recipe_with(self, title, ingredients, **fields):
+        recipe = self.make_recipe(title=title, **fields)
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.ingredients.set(ingredients)
+        return recipe
+
+    def test_minhash_estimates_jaccard_similarity(self):
+        a, b = {f"i{n}" for n in range(100)}, {f"i{n}" for n in range(50, 150)}
+        self.assertAlmostEqual(jaccard(a, b), 1 / 3)
+        agreement = sum(x == y for x, y in zip(minhash(a), minhash(b))) / len(minhash(a))
+        self.assertAlmostEqual(agreement, 1 / 3, delta=0.2)
+        self.assertEqual(minhash(a), minhash(set(a), cached=False))
+
+    def test_similar_public_recipes_best_first(self):
+        soup = self.recipe_with("Soup", self.names[:5])
+        close = self.recipe_with("Close", self.names[:5])
+        nearly = self.recipe_with("Nearly", self.names[:4])
+        self.recipe_with("Unrelated", self.names[6:])
+        self.recipe_with("Private copy", self.names[:5], is_public=False)
+        self.assertEqual(
+            [(recipe.pk, round(score, 2)) for recipe, score in related_recipes(soup)],
+            [(close.pk, 1.0), (nearly.pk, 0.8)],
+        )
+        response = self.client.get(soup.get_absolute_url())
+        self.assertEqual([recipe.title for recipe, _ in response.context["related"]], ["Close", "Nearly"])
+
+    def test_index_follows_ingredient_changes(self):
+        soup = self.recipe_with("Soup", self.names[:5])
+        other = self.recipe_with("Other", self.names[5:])
+        self.assertEqual(related_recipes(soup), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            other.ingredients.set(self.names[:5])
+        self.assertEqual([recipe.pk for recipe, _ in related_recipes(soup)], [other.pk])
+        self.assertEqual(related_recipes(self.make_recipe(title="Bare")), [])
+
+class NearDuplicateTests(RecipeTestCase):
+    TEXT = " ".join(f"step{i} stir the pot" for i in range(15))
+    OTHER_TEXT = " ".join(f"phase{i} knead the dough" for i in range(15))
+
+    def flags(self):
+        return set(NearDuplicate.objects.values_list("recipe_id", "original_id"))
+
+    def test_a_cluster_of_copies_is_flagged_once_per_copy(self):
+        original, *copies = [self.make_recipe(title=f"Copy {i}", instructions=self.TEXT) for i in range(30)]
+        self.assertEqual(self.flags(), {(copy.pk, original.pk) for copy in copies})
+        self.make_recipe(instructions="Too short to compare.")
+        self.make_recipe(instructions=self.OTHER_TEXT)
+        self.assertEqual(NearDuplicate.objects.count(), 29)
+
+    def test_a_crowded_bucket_does_not_hide_copies(self):
+        fillers = Recipe.objects.bulk_create(
+            Recipe(title=f"Filler {i}", instructions="Mix.", chef=self.chef) for i in range(120)
+        )
+        original = self.make_recipe(instructions=self.TEXT)
+        # Boilerplate shared by many recipes fills one of the text's buckets, ahead of the original.
+        hot_key = min(instruction_keys(shingles(self.TEXT)))
+        InstructionBucket.objects.bulk_create(InstructionBucket(recipe=filler, key=hot_key) for filler in fillers)
+        with mock.patch("recipes.duplicates.MAX_CANDIDATES", 10), mock.patch("recipes.duplicates.KEYS_PER_QUERY", 3):
+            copy = self.make_recipe(instructions=self.TEXT)
+        self.assertEqual(self.flags(), {(copy.pk, original.pk)})
+
+    def test_copies_are_flagged_against_the_closest_original(self):
+        first = self.make_recipe(instructions=self.TEXT)
+        edited_text = self.TEXT.replace("step3 stir", "step3 whisk").replace("step9 stir", "step9 whisk")
+        edited = self.make_recipe(instructions=edited_text)
+        copy = self.make_recipe(instructions=edited_text)
+        self.assertEqual(self.flags(), {(edited.pk, first.pk), (copy.pk, edited.pk)})
+        self.assertLess(NearDuplicate.objects.get(recipe=edited).similarity, 1)
+
+    def test_command_flags_existing_recipes_once(self):
+        recipes = Recipe.objects.bulk_create(
+            Recipe(title=f"Copy {i}", instructions=self.TEXT, chef=self.chef) for i in range(20)
+        )
+        for _ in range(2):
+            call_command("find_duplicate_recipes", batch_size=7, stdout=io.StringIO())
+            self.assertEqual(self.flags(), {(recipe.pk, recipes[0].pk) for recipe in recipes[1:]})
+
+    def test_edits_clear_pending_flags_on_both_sides(self):
+        original = self.make_recipe(instructions=self.TEXT)
+        reviewed, copy, other_copy = [self.make_recipe(instructions=self.TEXT) for _ in range(3)]
+        NearDuplicate.objects.filter(recipe=reviewed).update(status="distinct")
+
+        copy.instructions = self.OTHER_TEXT
+        copy.save()
+        self.assertEqual(self.flags(), {(reviewed.pk, original.pk), (other_copy.pk, original.pk)})
+
+        original.instructions = " ".join(f"part{i} fold the batter" for i in range(15))
+        original.save()
+        # The reviewed flag stays; the pending one went with the old text, and the copy
+        # is flagged against the next recipe it copies.
+        self.assertEqual(self.flags(), {(reviewed.pk, original.pk), (other_copy.pk, reviewed.pk)})
+        copy.instructions = self.TEXT
+        copy.save()
+        self.assertEqual(
+            self.flags(), {(reviewed.pk, original.pk), (other_copy.pk, reviewed.pk), (copy.pk, reviewed.pk)},
+        )
+
+    def test_admin_actions(self):
+        original = self.make_recipe(instructions=self.TEXT)
+        copy = self.make_recipe(instructions=self.TEXT)
+        flag = NearDuplicate.objects.get()
+        self.client.force_login(User.objects.create_superuser("admin", password="secret"))
+
+        def run(action):
+            response = self.client.post(
+                "/admin/recipes/nearduplicate/", {"action": action, "_selected_action": [flag.pk]},
+            )
+            self.assertEqual(response.status_code, 302)
+
+        run("mark_duplicate")
+        self.assertEqual(NearDuplicate.objects.get().status, "duplicate")
+        self.assertTrue(Recipe.objects.get(pk=copy.pk).is_public)
+        run("mark_duplicate_and_make_private")
+        self.assertFalse(Recipe.objects.get(pk=copy.pk).is_public)
+        self.assertTrue(Recipe.objects.get(pk=original.pk).is_public)
+
+class AutocompleteTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("Olive oil", "Oregano", "Sesame oil", "Onion", "Extra-virgin olive oil"):
+            Ingredient.objects.create(name=name)
+        Tag.objects.create(name="Vegan")
+        # The indexes live as long as the process; start these tests from the rows above.
+        invalidate_autocomplete(Ingredient)
+        invalidate_autocomplete(Tag)
+
+    def names(self, prefix, **kwargs):
+        return [name for _, name in prefix_index(Ingredient).search(prefix, **kwargs)]
+
+    def test_prefixes_of_names_and_of_words_in_them(self):
+        # In the order of the matching keys, each name once.
+        self.assertEqual(self.names("o"), ["Olive oil", "Sesame oil", "Extra-virgin olive oil", "Onion", "Oregano"])
+        self.assertEqual(self.names("  OLIVE "), ["Olive oil", "Extra-virgin olive oil"])
+        self.assertEqual(self.names("virgin"), ["Extra-virgin olive oil"])
+        self.assertEqual(self.names("o", limit=2), ["Olive oil", "Sesame oil"])
+        self.assertEqual(self.names(""), [])
+
+    def test_lookups_are_answered_from_memory(self):
+        self.names("o")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names("ses"), ["Sesame oil"])
+
+    def test_changes_rebuild_the_index(self):
+        self.assertEqual(self.names("on"), ["Onion"])
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name="Spring onion")
+        self.assertEqual(self.names("on"), ["Onion", "Spring onion"])
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.get(name="Onion").delete()
+        self.assertEqual(self.names("on"), ["Spring onion"])
+
+    def test_stale_indexes_are_rebuilt_after_max_age(self):
+        index = PrefixIndex(Ingredient)
+        self.assertEqual(len(index.search("on")), 1)
+        Ingredient.objects.create(name="Red onion")
+        self.assertEqual(len(index.search("on")), 1)
+        with mock.patch("recipes.autocomplete.MAX_AGE", -1):
+            self.assertEqual(len(index.search("on")), 2)
+
+    def test_views(self):
+        self.assertEqual(self.client.get("/ingredients/autocomplete/?q=ol").status_code, 302)
+        self.client.force_login(self.user)
+        response = self.client.get("/ingredients/autocomplete/?q=ol")
+        olive = Ingredient.objects.get(name="Olive oil")
+        self.assertEqual(response.json()["results"][0], {"id": olive.pk, "name": "Olive oil"})
+        self.assertEqual(self.client.get("/tags/autocomplete/?q=veg").json()["results"][0]["name"], "Vegan")
+
+class IngredientPairingTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        names = ("Pasta", "Tomato", "Basil", "Salt", "Chocolate", "Sugar")
+        self.ingredients = {name: Ingredient.objects.create(name=name) for name in names}
+        # Salt is in every recipe, so it tells nothing about what goes with what.
+        for names in [("Pasta", "Tomato", "Basil")] * 6 + [("Chocolate", "Sugar")] * 6 + [()] * 8:
+            recipe = self.make_recipe()
+            recipe.ingredients.set([self.ingredients[name] for name in (*names, "Salt")])
+
+    def ids(self, *names):
+        return [self.ingredients[name].pk for name in names]
+
+    def names(self, *names):
+        return [name for _, name in suggest_pairings(self.ids(*names))]
+
+    def test_ingredients_used_together_are_paired(self):
+        self.assertEqual(compute_pairings(), 8)
+        pasta = IngredientPairing.objects.filter(ingredient=self.ingredients["Pasta"])
+        self.assertEqual(sorted(pasta.values_list("other__name", "recipe_count")), [("Basil", 6), ("Tomato", 6)])
+        self.assertAlmostEqual(pasta.first().score, 1.0)
+        self.assertFalse(IngredientPairing.objects.filter(other=self.ingredients["Salt"]).exists())
+
+    def test_suggestions_go_with_every_chosen_ingredient(self):
+        compute_pairings()
+        self.assertEqual(self.names("Pasta"), ["Basil", "Tomato"])
+        self.assertEqual(self.names("Pasta", "Tomato"), ["Basil"])
+        self.assertEqual(self.names("Pasta", "Chocolate"), ["Basil", "Sugar", "Tomato"])
+        self.assertEqual(self.names("Salt"), [])
+
+    def test_rare_pairs_and_top_pairings_are_left_out(self):
+        self.assertEqual(compute_pairings(min_recipes=7), 0)
+        self.assertEqual(compute_pairings(top=1), 5)
+        self.assertEqual(len(self.names("Pasta")), 1)
+
+    def test_view(self):
+        compute_pairings()
+        self.client.force_login(self.user)
+        pasta, tomato, basil = self.ids("Pasta", "Tomato", "Basil")
+        response = self.client.get(f"/ingredients/pairings/?id={pasta}&id={tomato}&id=oops")
+        self.assertEqual(response.json(), {"results": [{"id": basil, "name": "Basil"}]})
+        self.assertEqual(self.client.get("/ingredients/pairings/").json(), {"results": []})
+
+class FacetTests(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vegan = Tag.objects.create(name="Vegan")
+        quick = Tag.objects.create(name="Quick")
+        for minutes, difficulty, tags in [(10, "E", [self.vegan, quick]), (25, "E", [self.vegan]), (90, "H", [])]:
+            self.make_recipe(cook_time_in_minutes=minutes, difficulty=difficulty).tags.set(tags)
+        self.private = self.make_recipe(cook_time_in_minutes=45, difficulty="M", is_public=False)
+        self.private.tags.set([self.vegan])
+
+    def facets(self, user, query=""):
+        filters = normalise_filters(QueryDict(query))
+        recipes = Recipe.objects.all()
+        if "tag" in filters:
+            recipes = recipes.filter(tags__name__iexact=filters["tag"]).distinct()
+        return count_facets(recipes, filters, user)
+
+    def test_filters_are_normalised(self):
+        self.assertEqual(
+            normalise_filters(QueryDict("tag=+Vegan+&q=SOUP&difficulty=e&time=15-30&chef=&page=2")),
+            {"tag": "vegan", "q": "soup", "difficulty": "E", "time": "15-30"},
+        )
+        self.assertEqual(normalise_filters(QueryDict("difficulty=X&time=forever")), {})
+
+    def test_counts_cover_what_each_user_may_see(self):
+        self.assertEqual(self.facets(AnonymousUser()), {
+            "tag": {"Vegan": 2, "Quick": 1},
+            "difficulty": {"E": 2, "H": 1},
+            "time": {"under-15": 1, "15-30": 1, "over-60": 1},
+        })
+        for user in (self.user, self.staff):
+            counts = self.facets(user)
+            self.assertEqual((counts["tag"]["Vegan"], counts["difficulty"]["M"], counts["time"]["30-60"]), (3, 1, 1))
+        self.assertNotIn("M", self.facets(self.other)["difficulty"])
+        self.assertEqual(self.facets(AnonymousUser(), "tag=vegan")["difficulty"], {"E": 2})
+
+    def test_counts_are_cached_until_a_recipe_changes(self):
+        self.facets(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.facets(self.user)["tag"]["Vegan"], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.private.is_public = True
+            self.private.save()
+        self.assertEqual(self.facets(AnonymousUser())["tag"]["Vegan"], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.private.tags.clear()
+        self.assertEqual(self.facets(AnonymousUser())["tag"]["Vegan"], 2)
+
+    def test_changes_outside_the_facets_keep_the_counts(self):
+        self.facets(AnonymousUser())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.private.instructions = "Simmer for longer."
+            self.private.image = image_upload()
+            self.private.save()
+            Tag.objects.create(name="Unused")
+            Ingredient.objects.create(name="Leek")
+        with self.assertNumQueries(0):
+            self.facets(AnonymousUser())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.private.cook_time_in_minutes = 5
+            self.private.save()
+        with self.assertNumQueries(3):
+            self.facets(AnonymousUser())
+
+    def test_outdated_counts_are_served_while_another_request_recounts(self):
+        self.facets(AnonymousUser())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.private.is_public = True
+            self.private.save()
+        with mock.patch("recipes.facets.cache.add", return_value=False), self.assertNumQueries(0):
+            self.assertEqual(self.facets(AnonymousUser())["tag"]["Vegan"], 2)
+        self.assertEqual(self.facets(AnonymousUser())["tag"]["Vegan"], 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.facets(AnonymousUser())["tag"]["Vegan"], 3)
+
+    def test_recipe_list_sidebar(self):
+        response = self.client.get("/", {"tag": "VEGAN", "page": "2"})
+        facets = dict(response.context["facets"])
+        label, count, url, selected = facets["Tags"][0]
+        self.assertEqual((label, count, selected), ("Vegan", 2, True))
+        # Selected values link back to the list without them, and every link starts on page 1.
+        self.assertEqual(url, "?")
+        self.assertEqual(facets["Difficulty"], [("Easy", 2, "?tag=VEGAN&difficulty=E", False)])
@@ -0,0 +1,148 @@
+"""
+Resumable chunked uploads for large recipe photos.
+
+A client starts an upload with the file's name, size and SHA-256, then PUTs
+the bytes in order, each request carrying a `Content-Range` header. Every
+chunk is streamed from the request straight into the upload's temp file, so
+memory use doesn't grow with the file and a worker is only tied up for one
+chunk at a time. After a dropped connection the client asks for the upload's
+`offset` and carries on from there. Completing the upload re-hashes the file
+and checks it against the announced digest.
+
+The finished file is then referenced by id from `RecipeForm` or the gallery
+formset (see `ChunkedImageMixin` in `recipes.forms`) and stored like any other
+upload.
+"""
+import hashlib
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.utils import timezone
+
+from .models import CHUNKED_UPLOAD_DIR, ChunkedUpload
+
+MAX_SIZE = getattr(settings, "RECIPE_CHUNKED_UPLOAD_MAX_SIZE", 50 * 1024 * 1024)
+CHUNK_SIZE = getattr(settings, "RECIPE_CHUNKED_UPLOAD_CHUNK_SIZE", 1024 * 1024)
+EXPIRY = getattr(settings, "RECIPE_CHUNKED_UPLOAD_EXPIRY", 24 * 60 * 60)
+READ_SIZE = 64 * 1024
+
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class UploadError(Exception):
+    """ A request the upload can't accept; `status` is the HTTP status to answer with. """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class AssembledUpload(UploadedFile):
+    """ The file of a completed upload. Like Django's temporary uploads, it is read from disk, not memory. """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+def start_upload(user, filename, size, sha256):
+    """ Create an empty upload of `size` bytes for `user`. """
+    filename = os.path.basename(str(filename or ""))
+    if not filename:
+        raise UploadError("A file name is required.")
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError("The size must be a positive number of bytes.")
+    if size > MAX_SIZE:
+        raise UploadError(f"Files may be at most {MAX_SIZE} bytes.", 413)
+    sha256 = str(sha256 or "").lower()
+    if not SHA256_RE.match(sha256):
+        raise UploadError("The SHA-256 digest must be 64 hex digits.")
+
+    expire_uploads()
+    upload = ChunkedUpload.objects.create(user=user, filename=filename[-255:], size=size, sha256=sha256)
+    os.makedirs(CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(upload.path, "wb").close()
+    return upload
+
+def parse_content_range(header):
+    match = CONTENT_RANGE_RE.match(header or "")
+    if not match:
+        raise UploadError("Chunks need a `Content-Range: bytes <start>-<end>/<size>` header.")
+    start, end, total = (int(group) for group in match.groups())
+    if end < start:
+        raise UploadError("The chunk's range is empty.")
+    return start, end, total
+
+def append_chunk(upload, stream, content_range):
+    """
+    Append the chunk described by `content_range` to the upload, reading it from
+    `stream` (usually the request) in small pieces. Chunks must arrive in order.
+    """
+    if upload.status != "uploading":
+        raise UploadError("The upload is already complete.", 409)
+    start, end, total = parse_content_range(content_range)
+    if total != upload.size or end >= total:
+        raise UploadError(f"The chunk doesn't fit a file of {upload.size} bytes.")
+    if start != upload.offset:
+        raise UploadError(f"Expected a chunk starting at byte {upload.offset}.", 409)
+    length = end - start + 1
+    if length > CHUNK_SIZE:
+        raise UploadError(f"Chunks may be at most {CHUNK_SIZE} bytes.", 413)
+
+    written = 0
+    try:
+        with open(upload.path, "r+b") as part:
+            # Drop anything past `offset` left by an earlier attempt at this chunk.
+            part.seek(start)
+            part.truncate()
+            while written < length:
+                data = stream.read(min(READ_SIZE, length - written))
+                if not data:
+                    break
+                part.write(data)
+                written += len(data)
+    finally:
+        # Keep whatever arrived, even from a broken connection: the client resumes after it.
+        # Conditional, so of two racing requests for the same chunk only one moves `offset`.
+        if written and ChunkedUpload.objects.filter(pk=upload.pk, offset=start).update(offset=start + written):
+            upload.offset = start + written
+        else:
+            upload.refresh_from_db(fields=["offset"])
+    if upload.offset != start + written:
+        raise UploadError(f"Expected a chunk starting at byte {upload.offset}.", 409)
+    if written < length:
+        raise UploadError(f"The chunk ended after {written} of {length} bytes.")
+    return upload
+
+def complete_upload(upload):
+    """ Check the assembled file against the announced digest and mark the upload complete. """
+    if upload.status == "complete":
+        return upload
+    if upload.offset != upload.size:
+        raise UploadError(f"Only {upload.offset} of {upload.size} bytes have been received.", 409)
+
+    digest = hashlib.sha256()
+    with open(upload.path, "rb") as part:
+        for data in iter(lambda: part.read(READ_SIZE), b""):
+            digest.update(data)
+    if digest.hexdigest() != upload.sha256:
+        # There's no telling which chunk got corrupted, so start over.
+        open(upload.path, "wb").close()
+        upload.offset = 0
+        upload.save(update_fields=["offset"])
+        raise UploadError("The file doesn't match its SHA-256 digest; the upload has been reset.")
+
+    upload.status = "complete"
+    upload.save(update_fields=["status"])
+    return upload
+
+def upload_file(upload):
+    """ The assembled file of a completed upload, ready to be assigned to an image field. """
+    return AssembledUpload(
+        open(upload.path, "rb"), name=upload.filename, content_type=None, size=upload.size,
+    )
+
+def expire_uploads():
+    """ Delete uploads (and their temp files) that were started more than EXPIRY seconds ago. """
+    for upload in ChunkedUpload.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=EXPIRY)):
+        upload.delete()
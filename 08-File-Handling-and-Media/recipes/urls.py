@@ -7,8 +7,16 @@ urlpatterns = [
     path("recipes/<int:pk>/", views.recipe_detail, name="recipe_detail"),
     path("recipes/add/", views.recipe_create, name="recipe_create"),
     path("recipes/<int:pk>/edit/", views.recipe_edit, name="recipe_edit"),
+    path("recipes/<int:pk>/gallery/import/", views.recipe_gallery_import, name="recipe_gallery_import"),
     path("recipes/<int:pk>/delete/", views.recipe_delete, name="recipe_delete"),
+    path("ingredients/autocomplete/", views.ingredient_autocomplete, name="ingredient_autocomplete"),
+    path("ingredients/pairings/", views.ingredient_pairings, name="ingredient_pairings"),
+    path("tags/autocomplete/", views.tag_autocomplete, name="tag_autocomplete"),
     path("my-recipes/", views.my_recipes, name="my_recipes"),
+    path("my-recipes/export/", views.export_data, name="export_data"),
+    path("uploads/", views.upload_start, name="upload_start"),
+    path("uploads/<uuid:upload_id>/", views.upload_detail, name="upload_detail"),
+    path("uploads/<uuid:upload_id>/complete/", views.upload_complete, name="upload_complete"),
     path("stats/", views.stats_dashboard, name="recipes_stats"),
     path("signup/", views.signup_view, name="signup"),
 ]
\ No newline at end of file
@@ -0,0 +1,61 @@
+import posixpath
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from PIL import Image, UnidentifiedImageError
+
+# Images with more pixels than this are refused before anything is decoded.
+MAX_PIXELS = getattr(settings, "RECIPE_IMAGE_MAX_PIXELS", 100_000_000)
+# Formats accepted for uploads, with the file extensions each may carry.
+IMAGE_FORMATS = {
+    "JPEG": ["jpg", "jpeg"],
+    "PNG": ["png"],
+    "WEBP": ["webp"],
+}
+
+def read_image_header(file):
+    """
+    Return `(format, (width, height))` read from the header of an image file. Pillow only
+    parses the header on open; no pixels are decoded.
+    """
+    position = file.tell() if hasattr(file, "tell") else None
+    try:
+        with Image.open(file) as img:
+            return img.format, img.size
+    finally:
+        if position is not None:
+            file.seek(position)
+
+def check_pixels(size):
+    if size[0] * size[1] > MAX_PIXELS:
+        raise ValidationError(
+            "The image is %(width)s×%(height)s pixels; images may have at most %(max)s megapixels.",
+            params={"width": size[0], "height": size[1], "max": f"{MAX_PIXELS / 1_000_000:g}"},
+            code="too_many_pixels",
+        )
+
+def validate_image_upload(value):
+    """
+    Check what an uploaded image really is from its header, rather than trusting its name:
+    the format must be one of IMAGE_FORMATS and match the extension (which decides the
+    stored file's name and `Content-Type`), and the pixel count must be within MAX_PIXELS.
+    Files already in storage were checked when they were uploaded, and are left alone.
+    """
+    if getattr(value, "_committed", False):
+        return
+    try:
+        img_format, size = read_image_header(value)
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise ValidationError("The file is not an image Pillow can read.", code="invalid_image")
+    if img_format not in IMAGE_FORMATS:
+        raise ValidationError(
+            "%(format)s images are not supported.", params={"format": img_format}, code="invalid_format",
+        )
+    extension = posixpath.splitext(value.name)[1].lstrip(".").lower()
+    if extension not in IMAGE_FORMATS[img_format]:
+        raise ValidationError(
+            "The file is a %(format)s image but is named “.%(extension)s”.",
+            params={"format": img_format, "extension": extension},
+            code="extension_mismatch",
+        )
+    check_pixels(size)
@@ -1,13 +1,33 @@
+import json
+
 from django.shortcuts import render, get_object_or_404, redirect
-from django.db.models import Count, Avg, Q
+from django.db.models import Count, Avg
 from django.core.paginator import Paginator
 from django.contrib.auth import login
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import HttpResponseForbidden
-from .models import Recipe, RecipeImage, Chef, Ingredient, Tag
-from .forms import RecipeForm, RecipeImageFormSet, SignUpForm
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import HttpResponseForbidden, Http404, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.http import require_http_methods, require_POST, require_safe
+from .autocomplete import prefix_index
+from .cache import DETAIL_CACHE_TIMEOUT, detail_cache_key, render_recipe_cards
+from .counters import record_view, trending_recipes
+from .export import export_chef
+from .facets import cook_time_bounds, count_facets, facet_links, normalise_filters
+from .gallery_import import import_gallery_zip
+from .imaging import GALLERY_PROCESSING, attach_derivatives, process_gallery_uploads, save_gallery_images
+from .media import serve_media
+from .models import Recipe, RecipeImage, Chef, Ingredient, Tag, ChunkedUpload
+from .pairings import suggest_pairings
+from .similarity import related_recipes
+from .uploads import CHUNK_SIZE, UploadError, append_chunk, complete_upload, start_upload
+from .forms import GalleryZipForm, RecipeForm, RecipeImageFormSet, SignUpForm
 
 # ADMIN DASHBOARD.
 @staff_member_required
@@ -42,28 +62,17 @@ def signup_view(request):
 
 # READ: Display All Recipes.
 def recipe_list(request):
-    # Base queryset on recipe data.
-    qs = Recipe.objects.select_related("chef").prefetch_related("ingredients", "tags")
-
-    # Staff members should see all relevant queried data.
-    if request.user.is_authenticated and request.user.is_staff:
-        qs = qs.all()
-    # Other authenticated users should only see user-owned and other public data.
-    elif request.user.is_authenticated:
-        try:
-            chef = Chef.objects.get(user=request.user)
-            qs = qs.filter(Q(is_public=True) | Q(chef=chef))
-        except Chef.DoesNotExist:
-            qs = qs.filter(is_public=True)
-    # Anonymous users should only see public data.
-    else:
-        qs = qs.filter(is_public=True)
+    # Base queryset on recipe data. Ingredients are only loaded for cards missing from the cache.
+    qs = Recipe.objects.select_related("chef")
 
-    # Simple filters via GET params.
-    tag = request.GET.get("tag")
-    ingredient = request.GET.get("ingredient")
-    chef = request.GET.get("chef")
-    q = request.GET.get("q")
+    # Simple filters via GET params, normalised so that equivalent requests share facet counts.
+    filters = normalise_filters(request.GET)
+    tag = filters.get("tag")
+    ingredient = filters.get("ingredient")
+    chef = filters.get("chef")
+    q = filters.get("q")
+    difficulty = filters.get("difficulty")
+    cook_time = filters.get("time")
 
     if tag:
         qs = qs.filter(tags__name__iexact=tag)
@@ -73,37 +82,86 @@ def recipe_list(request):
         qs = qs.filter(chef__name__icontains=chef)
     if q:
         qs = qs.filter(title__icontains=q)
+    if difficulty:
+        qs = qs.filter(difficulty=difficulty)
+    if cook_time:
+        fewest, most = cook_time_bounds(cook_time)
+        qs = qs.filter(cook_time_in_minutes__gte=fewest)
+        if most is not None:
+            qs = qs.filter(cook_time_in_minutes__lte=most)
 
     # Distinct because of JOINs.
-    qs = qs.distinct()
+    if tag or ingredient:
+        qs = qs.distinct()
+
+    # Counts per tag, difficulty and cook time of the results, for the sidebar.
+    facets = facet_links(request.GET, filters, count_facets(qs, filters, request.user))
+
+    # Staff see everything, other users public data plus their own, anonymous users public data only.
+    # Applied last, since the resulting query can't be filtered further.
+    qs = qs.visible_to(request.user)
 
     # Basic pagination.
     paginator = Paginator(qs, 8)
     page_number = request.GET.get("page")
     page_obj = paginator.get_page(page_number)
+    cards = render_recipe_cards(page_obj.object_list)
 
-    return render(request, "recipes/recipe_list.html", {"page_obj": page_obj})
+    return render(request, "recipes/recipe_list.html", {
+        "page_obj": page_obj,
+        "cards": cards,
+        "facets": facets,
+        "trending": trending_recipes(),
+    })
 
 # READ: Display Individual Recipe by ID.
 def recipe_detail(request, pk):
-    recipe = get_object_or_404(Recipe.objects.select_related("chef").prefetch_related("ingredients", "tags"), pk=pk)
-    return render(request, "recipes/recipe_detail.html", {"recipe": recipe})
+    # Only load what's needed for the visibility check and the cache key.
+    recipe = get_object_or_404(
+        Recipe.objects.select_related("chef").only("title", "is_public", "updated_at", "chef__user"), pk=pk
+    )
+    if not recipe.is_visible_to(request.user):
+        raise Http404("No Recipe matches the given query.")
+    record_view(recipe.pk)
+
+    # The body doesn't depend on the viewer, so it is shared once visibility is checked.
+    cache_key = detail_cache_key(recipe.pk, recipe.updated_at)
+    body = cache.get(cache_key)
+    if body is None:
+        full_recipe = Recipe.objects.select_related("chef").prefetch_related("ingredients", "tags", "images").get(pk=pk)
+        attach_derivatives([full_recipe.image] + [image.image for image in full_recipe.images.all()])
+        body = render_to_string("recipes/recipe_detail_body.html", {"recipe": full_recipe})
+        cache.set(cache_key, body, DETAIL_CACHE_TIMEOUT)
+    # Not part of the cached body: other recipes' edits change it.
+    related = related_recipes(recipe)
+    return render(request, "recipes/recipe_detail.html", {"recipe": recipe, "body": body, "related": related})
 
 # CREATE: Add New Recipe. (Requires user authorization.)
 @login_required
 def recipe_create(request):
     if request.method == "POST":
-        form = RecipeForm(request.POST, request.FILES)
-        formset = RecipeImageFormSet(request.POST, request.FILES, queryset=RecipeImage.objects.none())
+        form = RecipeForm(request.POST, request.FILES, user=request.user)
+        formset = RecipeImageFormSet(
+            request.POST, request.FILES, queryset=RecipeImage.objects.none(), form_kwargs={"user": request.user},
+        )
         if form.is_valid() and formset.is_valid():
-            new_recipe = form.save(commit=False)
-            new_recipe.chef = Chef.objects.get(user=request.user)
-            new_recipe.save()
-            form.save_m2m()
-            for formdata in formset.cleaned_data:
-                if formdata:
-                    image = formdata["image"]
-                    RecipeImage.objects.create(recipe=new_recipe, image=image)
+            image_forms = [image_form for image_form in formset if image_form.cleaned_data]
+            uploads = [image_form.cleaned_data["image"] for image_form in image_forms]
+            if GALLERY_PROCESSING == "inline":
+                # Process the images before the transaction, so it only holds the writes.
+                names, metadata, derivatives = process_gallery_uploads(uploads)
+            with transaction.atomic():
+                new_recipe = form.save(commit=False)
+                new_recipe.chef = request.chef
+                new_recipe.save()
+                form.save_m2m()
+                if GALLERY_PROCESSING == "inline":
+                    save_gallery_images(new_recipe, names, metadata, derivatives)
+                else:
+                    for upload in uploads:
+                        RecipeImage.objects.create(recipe=new_recipe, image=upload)
+            for chunked_form in [form, *image_forms]:
+                chunked_form.discard_upload()
             return redirect(new_recipe.get_absolute_url())
     else:
         form = RecipeForm()
@@ -113,36 +171,138 @@ def recipe_create(request):
 # READ: Display User's Recipes. (Requires user authorization.)
 @login_required
 def my_recipes(request):
-    chef = Chef.objects.get(user=request.user)
-    my_recipes = Recipe.objects.filter(chef=chef).select_related("chef")
-    return render(request, "recipes/my_recipes.html", {"recipes": my_recipes})
+    my_recipes = Recipe.objects.filter(chef_id=request.chef.pk).select_related("chef")
+    return render(request, "recipes/my_recipes.html", {"cards": render_recipe_cards(my_recipes)})
+
+# READ: Download the User's Recipes and Images as a Zip Archive. (Requires user authorization.)
+@login_required
+@require_safe
+def export_data(request):
+    # Streamed as it is built; see `recipes.export`.
+    response = StreamingHttpResponse(export_chef(request.chef), content_type="application/zip")
+    response["Content-Disposition"] = f'attachment; filename="cookbook-{request.user.pk}-{timezone.now():%Y%m%d}.zip"'
+    return response
+
+# READ: Ingredient and Tag Name Suggestions for the Recipe Form. (Requires user authorization.)
+def _name_suggestions(request, model):
+    results = prefix_index(model).search(request.GET.get("q", ""))
+    return JsonResponse({"results": [{"id": pk, "name": name} for pk, name in results]})
+
+@login_required
+@require_safe
+def ingredient_autocomplete(request):
+    return _name_suggestions(request, Ingredient)
+
+@login_required
+@require_safe
+def tag_autocomplete(request):
+    return _name_suggestions(request, Tag)
+
+# READ: Ingredients That Go Well With the Chosen Ones, as JSON. (Requires user authorization.)
+@login_required
+@require_safe
+def ingredient_pairings(request):
+    ids = [value for value in request.GET.getlist("id") if value.isdigit()]
+    results = suggest_pairings(ids) if ids else []
+    return JsonResponse({"results": [{"id": pk, "name": name} for pk, name in results]})
 
 # UPDATE: Edit Existing Recipe by ID. (Requires user authorization.)
 @login_required
 def recipe_edit(request, pk):
     recipe = get_object_or_404(Recipe, pk=pk)
-    if recipe.chef.user != request.user:
+    if recipe.chef_id != request.chef.pk:
         return HttpResponseForbidden("You do not have permission to edit this recipe.")
     if request.method == "POST":
-        form = RecipeForm(request.POST, request.FILES, instance=recipe)
+        form = RecipeForm(request.POST, request.FILES, instance=recipe, user=request.user)
         if form.is_valid():
             form.save()
+            form.discard_upload()
             return redirect(recipe.get_absolute_url())
     else:
         form = RecipeForm(instance=recipe)
     return render(request, "recipes/recipe_form.html", {"form": form, "action": "Edit"})
 
+# CREATE: Add Gallery Images to a Recipe from a Zip Archive. (Requires user authorization.)
+@login_required
+@require_http_methods(["GET", "POST"])
+def recipe_gallery_import(request, pk):
+    recipe = get_object_or_404(Recipe, pk=pk)
+    if recipe.chef_id != request.chef.pk:
+        return HttpResponseForbidden("You do not have permission to edit this recipe.")
+    images, failures = None, []
+    if request.method == "POST":
+        form = GalleryZipForm(request.POST, request.FILES)
+        if form.is_valid():
+            try:
+                images, failures = import_gallery_zip(recipe, form.cleaned_data["archive"])
+            except ValidationError as error:
+                form.add_error("archive", error)
+    else:
+        form = GalleryZipForm()
+    return render(request, "recipes/recipe_gallery_import.html", {
+        "recipe": recipe,
+        "form": form,
+        "images": images,
+        "failures": failures,
+    })
+
 # DELETE: Delete Existing Recipe by ID. (Requires user authorization.)
 @login_required
 def recipe_delete(request, pk):
     recipe = get_object_or_404(Recipe, pk=pk)
-    if recipe.chef.user != request.user:
+    if recipe.chef_id != request.chef.pk:
         return HttpResponseForbidden("You cannot delete another user's recipe.")
     if request.method == "POST":
         recipe.delete()
         return redirect("recipe_list")
     return render(request, "recipes/recipe_confirm_delete.html", {"recipe": recipe})
 
+# UPLOAD: Resumable chunked uploads of large images, referenced by id from the recipe forms. (Requires user authorization.)
+def _upload_state(upload):
+    return {
+        "id": str(upload.pk),
+        "offset": upload.offset,
+        "size": upload.size,
+        "status": upload.status,
+        "chunk_size": CHUNK_SIZE,
+        "url": reverse("upload_detail", args=[upload.pk]),
+        "complete_url": reverse("upload_complete", args=[upload.pk]),
+    }
+
+@login_required
+@require_POST
+def upload_start(request):
+    try:
+        data = json.loads(request.body)
+        upload = start_upload(request.user, data.get("filename"), data.get("size"), data.get("sha256"))
+    except (ValueError, AttributeError):
+        return JsonResponse({"error": "Expected a JSON object with filename, size and sha256."}, status=400)
+    except UploadError as error:
+        return JsonResponse({"error": str(error)}, status=error.status)
+    return JsonResponse(_upload_state(upload), status=201)
+
+@login_required
+@require_http_methods(["GET", "PUT"])
+def upload_detail(request, upload_id):
+    """ GET reports how far the upload got; PUT appends the next chunk, streamed from the request body. """
+    upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+    if request.method == "PUT":
+        try:
+            append_chunk(upload, request, request.headers.get("Content-Range"))
+        except UploadError as error:
+            return JsonResponse({"error": str(error), **_upload_state(upload)}, status=error.status)
+    return JsonResponse(_upload_state(upload))
+
+@login_required
+@require_POST
+def upload_complete(request, upload_id):
+    upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+    try:
+        complete_upload(upload)
+    except UploadError as error:
+        return JsonResponse({"error": str(error), **_upload_state(upload)}, status=error.status)
+    return JsonResponse(_upload_state(upload))
+
 # Aggregations / Advanced examples for dashboards
 def stats_dashboard(request):
     # Number of recipes per chef (annotate)
@@ -152,10 +312,19 @@ def stats_dashboard(request):
     avg_cook_time = Recipe.objects.aggregate(avg_time=Avg("cook_time_in_minutes"))["avg_time"]
 
     # Top 5 recipes with most ingredients
-    top_recipes_by_ingredients = Recipe.objects.annotate(num_ingredients=Count("ingredients")).order_by("-num_ingredients")[:5]
+    top_recipes_by_ingredients = (
+        Recipe.objects.annotate(num_ingredients=Count("ingredients"))
+        .visible_to(request.user)
+        .order_by("-num_ingredients")[:5]
+    )
 
     return render(request, "recipes/stats.html", {
         "chefs_counts": chefs_counts,
         "avg_cook_time": avg_cook_time,
         "top_recipes_by_ingredients": top_recipes_by_ingredients,
-    })
\ No newline at end of file
+    })
+
+# MEDIA: Serve uploaded files; images of private recipes only to their chef.
+@require_safe
+def media_file(request, path):
+    return serve_media(request, path)